@@ -5,7 +5,12 @@ This module and all its dependencies will be interpreted under Python 2.7
 and must be compatible.
 They should provide mediation between the AWS Lambda interface and
 standard Django requests.
+
+The handler modules are only imported when one of their handlers is first
+invoked, so that each Lambda function only pays for the imports it needs on
+a cold start. See scripts/lambda_import_times.py to measure them.
 """
+import importlib
 import logging
 import os; os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hsreplaynet.settings")
 import django; django.setup()
@@ -15,6 +20,29 @@ from django.conf import settings  # noqa
 lambdas_logger = logging.getLogger("hsreplaynet")
 lambdas_logger.setLevel(logging.DEBUG)
 
-# Make sure django.setup() has already been invoked to import handlers
-from hsreplaynet.lambdas.uploads import *  # noqa
-from hsreplaynet.lambdas.crons import * # noqa
+
+# The module defining each handler.
+# Every instrumentation.lambda_handler must be listed here.
+LAMBDA_HANDLERS = {
+	"process_replay_upload_stream_handler": "hsreplaynet.lambdas.uploads",
+	"process_single_replay_upload_stream_handler": "hsreplaynet.lambdas.uploads",
+	"process_s3_create_handler": "hsreplaynet.lambdas.uploads",
+	"reap_orphan_descriptors_handler": "hsreplaynet.lambdas.crons",
+	"archive_processed_raw_uploads_handler": "hsreplaynet.lambdas.crons",
+}
+
+
+def load_handler(name):
+	module = importlib.import_module(LAMBDA_HANDLERS[name])
+	return getattr(module, name)
+
+
+def _lazy_handler(name):
+	def handler(event, context):
+		return load_handler(name)(event, context)
+	handler.__name__ = name
+	return handler
+
+
+for _name in LAMBDA_HANDLERS:
+	globals()[_name] = _lazy_handler(_name)
@@ -3,6 +3,7 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.urls import reverse
 from hsreplaynet.games.models import Visibility
+from hsreplaynet.utils import batched_file_deletion
 from hsreplaynet.utils.fields import IntEnumField
 
 
@@ -82,6 +83,7 @@ class AccountDeleteRequest(models.Model):
 		if self.user.last_login > self.updated:
 			# User logged back in since the request was filed. Request no longer valid.
 			return
-		if self.delete_replay_data:
-			self.user.delete_replays()
-		self.user.delete()
+		with batched_file_deletion():
+			if self.delete_replay_data:
+				self.user.delete_replays()
+			self.user.delete()
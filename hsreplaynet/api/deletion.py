@@ -0,0 +1,160 @@
+"""
+Bulk removal of the tokens, uploads and replays belonging to an API key.
+
+Rows are walked by primary key in bounded chunks and removed with raw DELETEs,
+so memory use stays flat and no per-row signals are fired. Files are cleaned up
+through batched storage deletion jobs once each chunk has been committed.
+"""
+import time
+from collections import Counter
+from django.db import connection, transaction
+from django.db.models import Count
+from hsreplaynet.accounts.models import AccountClaim
+from hsreplaynet.games.models import (
+	GameReplay, GlobalGame, GlobalGamePlayer, RecentDeckReplay
+)
+from hsreplaynet.uploads.models import UploadEvent, UploadEventStatus
+from hsreplaynet.utils import delete_files_async
+from .models import AuthToken
+
+
+class DeletionError(Exception):
+	pass
+
+
+def _delete_in(cursor, model, column, values, cast=""):
+	sql = "DELETE FROM %s WHERE %s = ANY(%%s%s)" % (model._meta.db_table, column, cast)
+	cursor.execute(sql, [list(values)])
+	return cursor.rowcount
+
+
+def _set_null_in(cursor, model, column, values, cast=""):
+	sql = "UPDATE %s SET %s = NULL WHERE %s = ANY(%%s%s)" % (
+		model._meta.db_table, column, column, cast
+	)
+	cursor.execute(sql, [list(values)])
+
+
+class APIKeyDataRemover(object):
+	"""
+	Deletes all AuthTokens created with an API key, their UploadEvents and the
+	GameReplays attached to them. A GlobalGame is deleted along with its players
+	once none of its replays are left.
+
+	Uploads which are still processing are deleted, but their replays are kept.
+	"""
+	def __init__(self, api_key, chunk_size=1000, token_chunk_size=100, progress=None):
+		self.api_key = api_key
+		self.chunk_size = chunk_size
+		self.token_chunk_size = token_chunk_size
+		self.progress = progress or (lambda msg: None)
+
+		self.deleted_tokens = 0
+		self.deleted_uploads = 0
+		self.deleted_replays = 0
+		self.deleted_global_games = 0
+		self.skipped_replays = 0
+		self.start_time = None
+
+	def run(self):
+		self.start_time = time.time()
+		for token_keys in self._iterate_token_chunks():
+			for uploads in self._iterate_upload_chunks(token_keys):
+				self._delete_uploads(uploads)
+				self.report()
+			self._delete_tokens(token_keys)
+			self.report()
+
+	def report(self):
+		elapsed = time.time() - self.start_time
+		rate = self.deleted_uploads / elapsed if elapsed else 0.0
+		self.progress(
+			"Deleted %i uploads, %i replays, %i global games and %i tokens "
+			"(%i replays skipped, %.1f uploads/s)" % (
+				self.deleted_uploads, self.deleted_replays, self.deleted_global_games,
+				self.deleted_tokens, self.skipped_replays, rate
+			)
+		)
+
+	def _iterate_token_chunks(self):
+		tokens = AuthToken.objects.filter(creation_apikey=self.api_key).order_by("key")
+		last_key = None
+		while True:
+			chunk = tokens if last_key is None else tokens.filter(key__gt=last_key)
+			keys = list(chunk.values_list("key", flat=True)[:self.token_chunk_size])
+			if not keys:
+				return
+			yield [str(key) for key in keys]
+			last_key = keys[-1]
+
+	def _iterate_upload_chunks(self, token_keys):
+		uploads = UploadEvent.objects.filter(token_id__in=token_keys).order_by("id")
+		fields = ("id", "status", "game_id", "file", "descriptor")
+		last_id = 0
+		while True:
+			chunk = list(uploads.filter(id__gt=last_id).values_list(*fields)[:self.chunk_size])
+			if not chunk:
+				return
+			yield chunk
+			last_id = chunk[-1][0]
+
+	def _delete_uploads(self, uploads):
+		processing_statuses = UploadEventStatus.processing_statuses()
+		upload_ids = []
+		replay_ids = set()
+		file_names = []
+
+		for id, status, game_id, file, descriptor in uploads:
+			upload_ids.append(id)
+			file_names += [name for name in (file, descriptor) if name]
+
+			if status in processing_statuses:
+				if game_id:
+					self.skipped_replays += 1
+			elif game_id:
+				replay_ids.add(game_id)
+			elif status == UploadEventStatus.SUCCESS:
+				raise DeletionError("status=SUCCESS but no replay attached on UploadEvent %r" % (id))
+
+		replays = list(
+			GameReplay.objects.filter(id__in=replay_ids)
+			.values_list("id", "global_game_id", "replay_xml")
+		)
+		file_names += [replay_xml for _, _, replay_xml in replays if replay_xml]
+		global_game_ids = self._get_orphaned_global_game_ids(replays)
+
+		with transaction.atomic(), connection.cursor() as cursor:
+			self.deleted_uploads += _delete_in(cursor, UploadEvent, "id", upload_ids)
+
+			if replay_ids:
+				# Uploads from other tokens may point at the same replays
+				_set_null_in(cursor, UploadEvent, "game_id", replay_ids)
+				_delete_in(cursor, RecentDeckReplay, "replay_id", replay_ids)
+				self.deleted_replays += _delete_in(cursor, GameReplay, "id", replay_ids)
+
+			if global_game_ids:
+				_delete_in(cursor, GlobalGamePlayer, "game_id", global_game_ids)
+				self.deleted_global_games += _delete_in(cursor, GlobalGame, "id", global_game_ids)
+
+		delete_files_async(file_names)
+
+	def _get_orphaned_global_game_ids(self, replays):
+		"""
+		Return the ids of the GlobalGames whose replays are all about to be deleted.
+		"""
+		deleted_counts = Counter(global_game_id for _, global_game_id, _ in replays)
+		total_counts = dict(
+			GameReplay.objects.filter(global_game_id__in=deleted_counts.keys())
+			.order_by().values_list("global_game_id").annotate(count=Count("id"))
+		)
+
+		return [
+			global_game_id for global_game_id, count in deleted_counts.items()
+			if total_counts.get(global_game_id) == count
+		]
+
+	def _delete_tokens(self, token_keys):
+		with transaction.atomic(), connection.cursor() as cursor:
+			_set_null_in(cursor, GameReplay, "upload_token_id", token_keys, cast="::uuid[]")
+			_delete_in(cursor, AccountClaim, "token_id", token_keys, cast="::uuid[]")
+			self.deleted_tokens += _delete_in(cursor, AuthToken, "key", token_keys, cast="::uuid[]")
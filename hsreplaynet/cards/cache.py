@@ -0,0 +1,28 @@
+"""
+Shared invalidation of the card data cached by each process.
+
+Processes cache card sets in memory (see CardManager), tagged with the card
+version stored in the Django cache. load_cards bumps the version whenever
+cards change, so every process reloads its sets on their next use.
+"""
+import time
+from django.core.cache import cache
+
+
+CARDS_VERSION_CACHE_KEY = "cards:version"
+
+
+def get_cards_version():
+	version = cache.get(CARDS_VERSION_CACHE_KEY)
+	if version is None:
+		# add() so that concurrent processes agree on the first version
+		cache.add(CARDS_VERSION_CACHE_KEY, "%f" % (time.time()), None)
+		version = cache.get(CARDS_VERSION_CACHE_KEY)
+	return version
+
+
+def invalidate_cards_cache():
+	"""
+	Invalidate the card sets cached by all processes. Called by load_cards.
+	"""
+	cache.set(CARDS_VERSION_CACHE_KEY, "%f" % (time.time()), None)
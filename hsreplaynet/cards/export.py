@@ -0,0 +1,133 @@
+"""
+Streaming export of the decks played in recent games.
+
+Rows are read through a named (server-side) cursor and written out as they
+arrive, so exports of long time windows don't have to fit in memory.
+"""
+import csv
+import gzip
+from array import array
+from importlib import import_module
+from hearthstone.enums import CardClass
+from hsreplaynet.utils import iterate_server_side_cursor
+
+
+EXPORT_DECKS_QUERY = """
+SELECT
+	c.card_class AS "player_class",
+	array_agg(ci.card_id ORDER BY ci.card_id)
+		FILTER (WHERE ci.card_id IS NOT NULL) AS "card_ids",
+	array_agg(ci.count ORDER BY ci.card_id)
+		FILTER (WHERE ci.card_id IS NOT NULL) AS "counts"
+FROM games_globalgameplayer gp
+JOIN games_globalgame gg ON gp.game_id = gg.id
+JOIN card c ON gp.hero_id = c.id
+LEFT JOIN cards_include ci ON ci.deck_id = gp.deck_list_id
+WHERE gp.is_ai = FALSE
+AND gg.match_start > now() - %s * INTERVAL '1 hour'
+GROUP BY gp.id, c.card_class
+"""
+
+EXPORT_FORMATS = ("text", "csv", "npz")
+
+
+def is_format_available(format):
+	"""
+	The npz format requires numpy, which is only installed on the web servers.
+	"""
+	if format == "npz":
+		try:
+			import_module("numpy")
+		except ImportError:
+			return False
+	return True
+
+
+def iterate_exported_decks(lookback, itersize=10000):
+	"""
+	Yield (player_class, card_ids, counts) for every non-AI player of the
+	games started in the last `lookback` hours.
+	"""
+	rows = iterate_server_side_cursor(EXPORT_DECKS_QUERY, [lookback], itersize=itersize)
+	for player_class, card_ids, counts in rows:
+		yield player_class, card_ids or [], counts or []
+
+
+def format_deck_list(card_ids, counts):
+	return ", ".join(
+		card_id for card_id, count in zip(card_ids, counts) for i in range(count)
+	)
+
+
+def _open(path, compress):
+	if compress:
+		return gzip.open(path, mode="wt")
+	return open(path, mode="wt")
+
+
+def write_text(rows, path, compress=False):
+	with _open(path, compress) as out:
+		for player_class, card_ids, counts in rows:
+			out.write("%s:%s\n" % (CardClass(player_class).name, format_deck_list(card_ids, counts)))
+
+
+def write_csv(rows, path, compress=False):
+	with _open(path, compress) as out:
+		writer = csv.writer(out)
+		writer.writerow(("player_class", "deck_list"))
+		for player_class, card_ids, counts in rows:
+			writer.writerow((CardClass(player_class).name, format_deck_list(card_ids, counts)))
+
+
+def write_npz(rows, path, compress=True):
+	"""
+	Write the decks as a set of columnar NumPy arrays:
+
+	- player_class: the CardClass of each deck
+	- deck_offsets: deck i is cards[deck_offsets[i]:deck_offsets[i + 1]]
+	- cards, counts: index into card_ids and number of copies of each card
+	- card_ids: the card id for each card index
+	"""
+	import numpy as np
+
+	# Accumulate into compact typed arrays rather than lists of Python objects
+	player_classes = array("B")
+	deck_offsets = array("L", [0])
+	cards = array("H")
+	card_counts = array("B")
+	card_indices = {}
+
+	for player_class, card_ids, counts in rows:
+		player_classes.append(int(player_class))
+		for card_id, count in zip(card_ids, counts):
+			if card_id not in card_indices:
+				card_indices[card_id] = len(card_indices)
+			cards.append(card_indices[card_id])
+			card_counts.append(count)
+		deck_offsets.append(len(cards))
+
+	card_ids = sorted(card_indices, key=card_indices.get)
+	save = np.savez_compressed if compress else np.savez
+	with open(path, mode="wb") as out:
+		save(
+			out,
+			player_class=np.frombuffer(player_classes, dtype=np.uint8),
+			deck_offsets=np.frombuffer(deck_offsets, dtype=np.dtype("L")).astype(np.uint64),
+			cards=np.frombuffer(cards, dtype=np.uint16),
+			counts=np.frombuffer(card_counts, dtype=np.uint8),
+			card_ids=np.array(card_ids, dtype=str),
+		)
+
+	return len(player_classes)
+
+
+def export_decks(path, lookback, format="text", compress=False, itersize=10000):
+	rows = iterate_exported_decks(lookback, itersize=itersize)
+	if format == "text":
+		write_text(rows, path, compress)
+	elif format == "csv":
+		write_csv(rows, path, compress)
+	elif format == "npz":
+		write_npz(rows, path, compress)
+	else:
+		raise ValueError("Unknown export format: %r" % (format))
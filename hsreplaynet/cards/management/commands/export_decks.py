@@ -1,26 +1,5 @@
-from django.core.management.base import BaseCommand
-from django.db import connection
-from hearthstone.enums import CardClass
-
-QUERY = """
-SELECT
-	c.card_class AS "player_class", (
-		SELECT string_agg(
-			CASE WHEN ci.count > 1 THEN
-				left(repeat(concat(ci.card_id, ', '), ci.count), -2)
-			ELSE
-				ci.card_id END, ', '
-			) AS "deck_list"
-		FROM cards_deck cd
-		JOIN cards_include ci ON ci.deck_id = cd.id
-		WHERE cd.id = gp.deck_list_id
-	) AS "deck_list"
-FROM games_globalgameplayer gp
-JOIN games_globalgame gg ON gp.game_id = gg.id
-JOIN card c ON gp.hero_id = c.id
-WHERE gp.is_ai = FALSE
-AND gg.match_start > now()- INTERVAL '%s hour'
-"""
+from django.core.management.base import BaseCommand, CommandError
+from hsreplaynet.cards.export import EXPORT_FORMATS, export_decks, is_format_available
 
 
 class Command(BaseCommand):
@@ -33,13 +12,29 @@ class Command(BaseCommand):
 			"--out", default="decks.csv",
 			help="The file where we will write the decks"
 		)
+		parser.add_argument(
+			"--format", default="text", choices=EXPORT_FORMATS,
+			help="text (CLASS:card, card, ...), csv or npz (columnar NumPy arrays)"
+		)
+		parser.add_argument(
+			"--gzip", action="store_true", default=False,
+			help="Compress the output (implied by a .gz extension, always on for npz)"
+		)
+		parser.add_argument(
+			"--itersize", default=10000, type=int,
+			help="The number of rows fetched from the database at a time"
+		)
 
 	def handle(self, *args, **options):
-		cursor = connection.cursor()
-		lookback = options["lookback"]
-		cursor.execute(QUERY % lookback)
+		out = options["out"]
+		format = options["format"]
+		compress = options["gzip"] or out.endswith(".gz") or format == "npz"
 
-		with open(options["out"], mode="wt") as out:
-			for row in cursor.fetchall():
-				record = "%s:%s\n" % (CardClass(row[0]).name, row[1])
-				out.write(record)
+		if not is_format_available(format):
+			raise CommandError("The %s format requires numpy to be installed." % (format))
+
+		export_decks(
+			out, options["lookback"], format=format, compress=compress,
+			itersize=options["itersize"]
+		)
+		self.stdout.write("Wrote %s" % (out))
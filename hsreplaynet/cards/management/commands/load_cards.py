@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from hearthstone import cardxml
 from ...models import Card
 
@@ -13,11 +14,35 @@ class Command(BaseCommand):
 		db, _ = cardxml.load(path, locale=options["locale"])
 		self.stdout.write("%i cards available" % (len(db)))
 
-		qs = Card.objects.all().values_list("id")
-		known_ids = [item[0] for item in qs]
-		missing = [id for id in db if id not in known_ids]
-		self.stdout.write("%i known cards" % (len(known_ids)))
+		fields = [f.attname for f in Card._meta.concrete_fields if not f.primary_key]
+
+		# Compare cards by a hash of all their fields, rather than field by field
+		known_hashes = {
+			row[0]: hash(tuple(row[1:]))
+			for row in Card.objects.values_list("id", *fields)
+		}
+		self.stdout.write("%i known cards" % (len(known_hashes)))
+
+		new_cards = []
+		changed_cards = []
+		for id, card in db.items():
+			obj = Card.from_cardxml(card)
+			if id not in known_hashes:
+				new_cards.append(obj)
+			elif hash(tuple(getattr(obj, field) for field in fields)) != known_hashes[id]:
+				changed_cards.append(obj)
+
+		with transaction.atomic():
+			Card.objects.bulk_create(new_cards)
+
+			# Django 1.10 has no bulk_update(); only cards which changed are updated.
+			for obj in changed_cards:
+				Card.objects.filter(id=obj.id).update(
+					**{field: getattr(obj, field) for field in fields}
+				)
+
+		if new_cards or changed_cards:
+			Card.objects.clear_cache()
 
-		new_cards = [Card.from_cardxml(db[id]) for id in missing]
-		Card.objects.bulk_create(new_cards)
 		self.stdout.write("%i new cards" % (len(new_cards)))
+		self.stdout.write("%i updated cards" % (len(changed_cards)))
@@ -0,0 +1,156 @@
+"""
+Head-to-head matchup statistics and expected win rates.
+
+The expected win rate of a deck is the sum of its win rates against every
+other deck, weighted by how often each opponent is encountered (see
+scripts/deck_recommendations.py). With the win rates stored as a matrix this
+is a single matrix-vector product for all decks at once.
+"""
+from django.core.cache import cache
+from .matrix import DeckMatrix
+
+
+MATCHUP_CACHE_TIMEOUT = 60 * 60
+
+MATCHUP_GROUPINGS = ("deck", "class")
+
+
+class MatchupMatrix:
+	"""
+	Win rates between archetypes, where an archetype is either a deck
+	(archetypes are Deck ids) or a player class (archetypes are CardClass values).
+
+	Only the observed matchups are stored, as aligned arrays of
+	(pair_rows, pair_cols, pair_games, pair_wins), where the rows and columns
+	are indices into `archetypes` and the wins are those of the row archetype.
+	Matchups with fewer than `min_games` games are treated as even (.5).
+	"""
+	def __init__(self, archetypes, pair_rows, pair_cols, pair_games, pair_wins, min_games=1):
+		self.archetypes = archetypes
+		self.pair_rows = pair_rows
+		self.pair_cols = pair_cols
+		self.pair_games = pair_games
+		self.pair_wins = pair_wins
+		self.min_games = min_games
+
+	def __len__(self):
+		return len(self.archetypes)
+
+	@classmethod
+	def from_deck_matrix(cls, deck_matrix, mask=None, by="deck", min_games=1):
+		"""
+		Compute the matchups between the players selected by `mask`.
+		Games where only one of the players is selected are ignored.
+		"""
+		import numpy as np
+
+		if by == "deck":
+			labels = deck_matrix.deck_ids[deck_matrix.player_decks]
+		elif by == "class":
+			labels = deck_matrix.player_classes
+		else:
+			raise ValueError("Unknown matchup grouping: %r" % (by))
+
+		players = np.arange(len(labels)) if mask is None else np.flatnonzero(mask)
+		# Sort the players by game so that both players of a game are adjacent
+		players = players[np.argsort(deck_matrix.game_ids[players], kind="mergesort")]
+		_, starts, counts = np.unique(
+			deck_matrix.game_ids[players], return_index=True, return_counts=True
+		)
+		starts = starts[counts == 2]
+		first, second = players[starts], players[starts + 1]
+
+		# Count every game once from each player's point of view
+		player, opponent = np.concatenate((first, second)), np.concatenate((second, first))
+		archetypes, indices = np.unique(
+			np.concatenate((labels[player], labels[opponent])), return_inverse=True
+		)
+		rows, cols = indices[:len(player)], indices[len(player):]
+
+		pairs, pair_indices = np.unique(rows * len(archetypes) + cols, return_inverse=True)
+		pair_games = np.bincount(pair_indices)
+		pair_wins = np.bincount(pair_indices, weights=deck_matrix.won[player])
+
+		return cls(
+			archetypes,
+			pair_rows=pairs // len(archetypes),
+			pair_cols=pairs % len(archetypes),
+			pair_games=pair_games,
+			pair_wins=pair_wins,
+			min_games=min_games,
+		)
+
+	def index(self, archetype):
+		import numpy as np
+
+		index = np.searchsorted(self.archetypes, archetype)
+		if index == len(self.archetypes) or self.archetypes[index] != archetype:
+			raise KeyError(archetype)
+		return index
+
+	def frequencies(self):
+		"""
+		The share of all games played by each archetype (sums to 1).
+		"""
+		import numpy as np
+
+		games = np.bincount(self.pair_rows, weights=self.pair_games, minlength=len(self))
+		total = games.sum()
+		return games / total if total else games
+
+	def win_rate_deltas(self):
+		"""
+		Sparse archetype x archetype matrix of (win rate - .5).
+		Even, unknown and mirror matchups are left out.
+		"""
+		from scipy.sparse import csr_matrix
+
+		keep = (self.pair_games >= self.min_games) & (self.pair_rows != self.pair_cols)
+		deltas = self.pair_wins[keep] / self.pair_games[keep] - 0.5
+		return csr_matrix(
+			(deltas, (self.pair_rows[keep], self.pair_cols[keep])),
+			shape=(len(self), len(self)),
+		)
+
+	def win_rates(self):
+		"""
+		Dense archetype x archetype win rate matrix.
+		Prefer expected_win_rates() for large numbers of archetypes.
+		"""
+		return self.win_rate_deltas().toarray() + 0.5
+
+	def expected_win_rates(self, frequencies=None):
+		"""
+		The expected win rate of every archetype against a field of
+		opponents with the given frequencies (by default, the observed ones).
+		"""
+		if frequencies is None:
+			frequencies = self.frequencies()
+		return 0.5 * frequencies.sum() + self.win_rate_deltas().dot(frequencies)
+
+
+def get_matchup_matrix(
+	start, end, game_type=None, min_rank=None, max_rank=None, by="deck", min_games=1
+):
+	"""
+	Return the MatchupMatrix for the games played between `start` and `end`,
+	cached per game type and rank range.
+	"""
+	cache_key = "matchups:%s:%s:%s:%s:%s:%s:%s" % (
+		by,
+		start.strftime("%Y%m%d%H%M"),
+		end.strftime("%Y%m%d%H%M"),
+		"" if game_type is None else int(game_type),
+		"" if min_rank is None else min_rank,
+		"" if max_rank is None else max_rank,
+		min_games,
+	)
+	matchups = cache.get(cache_key)
+
+	if matchups is None:
+		deck_matrix = DeckMatrix.load_or_build(start, end)
+		mask = deck_matrix.player_mask(game_type, min_rank, max_rank)
+		matchups = MatchupMatrix.from_deck_matrix(deck_matrix, mask, by, min_games)
+		cache.set(cache_key, matchups, MATCHUP_CACHE_TIMEOUT)
+
+	return matchups
@@ -0,0 +1,291 @@
+"""
+Vectorized deck analytics.
+
+A DeckMatrix holds every deck played in a time window as rows of a sparse
+deck x card count matrix, along with one entry per (non-AI) player for each
+game played in that window. Statistics are then computed with NumPy / SciPy
+array operations instead of one SQL query per question.
+
+Matrices are cached on disk as .npy files and memory-mapped on load, so that
+several processes can share them without each holding a copy.
+"""
+import os
+import shutil
+import tempfile
+from array import array
+from django.conf import settings
+from hearthstone.enums import PlayState
+from hsreplaynet.utils import iterate_server_side_cursor, log
+
+
+PLAYERS_QUERY = """
+SELECT gp.game_id, gp.deck_list_id, gp.final_state, c.card_class, gg.game_type, gp.rank
+FROM games_globalgameplayer gp
+JOIN games_globalgame gg ON gp.game_id = gg.id
+JOIN card c ON gp.hero_id = c.id
+WHERE gp.is_ai = FALSE
+AND gg.match_start >= %(start)s AND gg.match_start < %(end)s
+"""
+
+INCLUDES_QUERY = """
+SELECT ci.deck_id, ci.card_id, ci.count
+FROM cards_include ci
+WHERE ci.deck_id IN (
+	SELECT DISTINCT gp.deck_list_id
+	FROM games_globalgameplayer gp
+	JOIN games_globalgame gg ON gp.game_id = gg.id
+	WHERE gp.is_ai = FALSE
+	AND gg.match_start >= %(start)s AND gg.match_start < %(end)s
+)
+"""
+
+# Arrays making up a DeckMatrix, as stored in the cache directory
+DECK_MATRIX_ARRAYS = (
+	"deck_ids", "card_ids", "data", "indices", "indptr",
+	"game_ids", "player_decks", "won", "player_classes", "game_types", "ranks",
+)
+
+
+def get_deck_matrix_cache_dir(start, end):
+	name = "decks-%s-%s" % (start.strftime("%Y%m%d%H%M"), end.strftime("%Y%m%d%H%M"))
+	return os.path.join(settings.DECK_MATRIX_CACHE_DIR, name)
+
+
+class DeckMatrix:
+	"""
+	Decks and player outcomes for the games played between `start` and `end`.
+
+	- deck_ids: the Deck id of each row in `counts`
+	- card_ids: the Card id of each column in `counts`
+	- counts: sparse (CSR) deck x card matrix of card counts
+	- game_ids, player_decks, won, player_classes, game_types, ranks:
+	  one entry per player. player_decks are row indices into `counts`.
+	  Missing game types and ranks are -1.
+	"""
+	def __init__(self, arrays):
+		from scipy.sparse import csr_matrix
+
+		self.deck_ids = arrays["deck_ids"]
+		self.card_ids = arrays["card_ids"]
+		self.counts = csr_matrix(
+			(arrays["data"], arrays["indices"], arrays["indptr"]),
+			shape=(len(self.deck_ids), len(self.card_ids)),
+			copy=False,
+		)
+		self.game_ids = arrays["game_ids"]
+		self.player_decks = arrays["player_decks"]
+		self.won = arrays["won"]
+		self.player_classes = arrays["player_classes"]
+		self.game_types = arrays["game_types"]
+		self.ranks = arrays["ranks"]
+
+	def __len__(self):
+		return len(self.deck_ids)
+
+	@classmethod
+	def build(cls, start, end, itersize=10000):
+		"""
+		Build the matrix for the games played between `start` and `end`.
+		"""
+		import numpy as np
+		from scipy.sparse import coo_matrix
+
+		params = {"start": start, "end": end}
+
+		game_ids = array("q")
+		player_deck_ids = array("q")
+		won = array("B")
+		player_classes = array("B")
+		game_types = array("h")
+		ranks = array("b")
+		rows = iterate_server_side_cursor(PLAYERS_QUERY, params, itersize=itersize)
+		for game_id, deck_id, final_state, card_class, game_type, rank in rows:
+			game_ids.append(game_id)
+			player_deck_ids.append(deck_id)
+			won.append(final_state == PlayState.WON)
+			player_classes.append(card_class)
+			game_types.append(-1 if game_type is None else game_type)
+			ranks.append(-1 if rank is None else rank)
+
+		player_deck_ids = np.frombuffer(player_deck_ids, dtype=np.int64)
+		deck_ids, player_decks = np.unique(player_deck_ids, return_inverse=True)
+
+		include_decks = array("q")
+		include_cards = array("l")
+		include_counts = array("B")
+		card_indices = {}
+		rows = iterate_server_side_cursor(INCLUDES_QUERY, params, itersize=itersize)
+		for deck_id, card_id, count in rows:
+			if card_id not in card_indices:
+				card_indices[card_id] = len(card_indices)
+			include_decks.append(deck_id)
+			include_cards.append(card_indices[card_id])
+			include_counts.append(count)
+
+		card_ids = np.array(sorted(card_indices, key=card_indices.get), dtype=str)
+		deck_rows = np.searchsorted(deck_ids, np.frombuffer(include_decks, dtype=np.int64))
+		counts = coo_matrix(
+			(
+				np.frombuffer(include_counts, dtype=np.uint8),
+				(deck_rows, np.frombuffer(include_cards, dtype=np.dtype("l"))),
+			),
+			shape=(len(deck_ids), len(card_ids)),
+		).tocsr()
+
+		return cls({
+			"deck_ids": deck_ids,
+			"card_ids": card_ids,
+			"data": counts.data,
+			"indices": counts.indices,
+			"indptr": counts.indptr,
+			"game_ids": np.frombuffer(game_ids, dtype=np.int64),
+			"player_decks": player_decks.astype(np.int32),
+			"won": np.frombuffer(won, dtype=np.uint8).astype(bool),
+			"player_classes": np.frombuffer(player_classes, dtype=np.uint8),
+			"game_types": np.frombuffer(game_types, dtype=np.int16),
+			"ranks": np.frombuffer(ranks, dtype=np.int8),
+		})
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Load a matrix saved with save(), memory-mapping its arrays.
+		"""
+		import numpy as np
+
+		arrays = {}
+		for name in DECK_MATRIX_ARRAYS:
+			arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+		return cls(arrays)
+
+	@classmethod
+	def load_or_build(cls, start, end):
+		"""
+		Return the cached matrix for `start`..`end`, building it if needed.
+		"""
+		path = get_deck_matrix_cache_dir(start, end)
+		if os.path.exists(path):
+			return cls.load(path)
+
+		log.info("Building deck matrix for %s - %s", start, end)
+		matrix = cls.build(start, end)
+		matrix.save(path)
+		return cls.load(path)
+
+	def save(self, path):
+		import numpy as np
+
+		arrays = {
+			"deck_ids": self.deck_ids,
+			"card_ids": self.card_ids,
+			"data": self.counts.data,
+			"indices": self.counts.indices,
+			"indptr": self.counts.indptr,
+			"game_ids": self.game_ids,
+			"player_decks": self.player_decks,
+			"won": self.won,
+			"player_classes": self.player_classes,
+			"game_types": self.game_types,
+			"ranks": self.ranks,
+		}
+
+		# Write to a temporary directory first so that readers never see
+		# a partially written matrix.
+		parent = os.path.dirname(path)
+		os.makedirs(parent, exist_ok=True)
+		tmp = tempfile.mkdtemp(dir=parent)
+		try:
+			for name, values in arrays.items():
+				np.save(os.path.join(tmp, name + ".npy"), values)
+			os.rename(tmp, path)
+		except OSError:
+			shutil.rmtree(tmp, ignore_errors=True)
+			if not os.path.exists(path):
+				raise
+
+	def player_mask(self, game_type=None, min_rank=None, max_rank=None):
+		"""
+		Return a boolean mask over players, for filtering the statistics below.
+		Ranks are 0 (legend) through 25; players without a rank never match
+		a rank filter.
+		"""
+		import numpy as np
+
+		mask = np.ones(len(self.player_decks), dtype=bool)
+		if game_type is not None:
+			mask &= self.game_types == int(game_type)
+		if min_rank is not None:
+			mask &= self.ranks >= min_rank
+		if max_rank is not None:
+			mask &= (self.ranks <= max_rank) & (self.ranks >= 0)
+		return mask
+
+	def deck_games(self, mask=None):
+		"""
+		The number of games played with each deck.
+		"""
+		import numpy as np
+
+		decks = self.player_decks if mask is None else self.player_decks[mask]
+		return np.bincount(decks, minlength=len(self))
+
+	def deck_wins(self, mask=None):
+		"""
+		The number of games won with each deck.
+		"""
+		import numpy as np
+
+		decks = self.player_decks if mask is None else self.player_decks[mask]
+		won = self.won if mask is None else self.won[mask]
+		return np.bincount(decks, weights=won, minlength=len(self))
+
+	def deck_win_rates(self, mask=None):
+		"""
+		The win rate of each deck, NaN for decks without games.
+		"""
+		import numpy as np
+
+		with np.errstate(divide="ignore", invalid="ignore"):
+			return self.deck_wins(mask) / self.deck_games(mask)
+
+	def card_inclusion(self):
+		"""
+		Sparse deck x card matrix of 1 where a deck contains a card.
+		"""
+		inclusion = self.counts.copy()
+		inclusion.data = (inclusion.data > 0).astype("uint8")
+		return inclusion
+
+	def card_popularity(self, mask=None):
+		"""
+		The fraction of players whose deck contains each card.
+		"""
+		import numpy as np
+
+		games = self.deck_games(mask)
+		total = games.sum()
+		if not total:
+			return np.zeros(len(self.card_ids))
+		return self.card_inclusion().T.dot(games) / float(total)
+
+	def card_win_rates(self, mask=None):
+		"""
+		The win rate of the players whose deck contains each card.
+		"""
+		import numpy as np
+
+		inclusion = self.card_inclusion().T
+		with np.errstate(divide="ignore", invalid="ignore"):
+			return inclusion.dot(self.deck_wins(mask)) / inclusion.dot(self.deck_games(mask))
+
+	def card_cooccurrence(self, mask=None):
+		"""
+		Sparse card x card matrix of the number of players whose deck
+		contained both cards. The diagonal is the number of players with
+		each card.
+		"""
+		from scipy.sparse import diags
+
+		inclusion = self.card_inclusion().astype("int64")
+		weighted = diags(self.deck_games(mask), dtype="int64").dot(inclusion)
+		return inclusion.T.dot(weighted)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+CREATE_TABLE_DECK_MATCHUP_STATS = """
+	CREATE TABLE deck_matchup_stats (
+		epoch_seconds	int8 NOT NULL,
+		loser_deck_id	int8 NOT NULL REFERENCES cards_deck (id),
+		winner_deck_id	int8 NOT NULL REFERENCES cards_deck (id),
+		game_type		int2 NOT NULL,
+		rank_bucket		int2 NOT NULL DEFAULT -1,
+		games			int4 NOT NULL DEFAULT 0,
+		PRIMARY KEY (loser_deck_id, epoch_seconds, game_type, rank_bucket, winner_deck_id)
+	);
+"""
+
+DROP_TABLE_DECK_MATCHUP_STATS = """
+	DROP TABLE deck_matchup_stats;
+"""
+
+# The contribution of each game to deck_matchup_stats, so that it can be
+# taken back out even when the players are no longer there to recompute it
+# (eg. both players deleted by the same statement).
+CREATE_TABLE_DECK_MATCHUP_STATS_GAME = """
+	CREATE TABLE deck_matchup_stats_game (
+		game_id			int8 PRIMARY KEY,
+		epoch_seconds	int8 NOT NULL,
+		loser_deck_id	int8 NOT NULL,
+		winner_deck_id	int8 NOT NULL,
+		game_type		int2 NOT NULL,
+		rank_bucket		int2 NOT NULL
+	);
+"""
+
+DROP_TABLE_DECK_MATCHUP_STATS_GAME = """
+	DROP TABLE deck_matchup_stats_game;
+"""
+
+CREATE_REFRESH_DECK_MATCHUP_STATS_FUNCTION = """
+	CREATE OR REPLACE FUNCTION refresh_deck_matchup_stats(game int8) RETURNS void AS $$
+	DECLARE
+		previous deck_matchup_stats_game%ROWTYPE;
+		contribution deck_matchup_stats_game%ROWTYPE;
+		counted boolean;
+	BEGIN
+		-- Serialize the refreshes of a game, so that two transactions writing
+		-- each of its players can't both miss the other one. NO KEY UPDATE
+		-- doesn't conflict with the KEY SHARE locks of the foreign key checks.
+		PERFORM 1 FROM games_globalgame WHERE id = game FOR NO KEY UPDATE;
+
+		-- A game is counted once both its winner and loser decks are known
+		SELECT
+			gg.id,
+			round(date_part('epoch', date_trunc('hour', gg.match_start))),
+			lost.deck_list_id,
+			won.deck_list_id,
+			gg.game_type,
+			COALESCE(lost.rank, -1)
+		INTO contribution
+		FROM games_globalgame gg
+		JOIN games_globalgameplayer lost
+			ON lost.game_id = gg.id AND lost.final_state = 5
+		JOIN games_globalgameplayer won
+			ON won.game_id = gg.id AND won.final_state = 4
+		WHERE gg.id = game
+			AND gg.match_start IS NOT NULL
+			AND gg.game_type IS NOT NULL
+			AND lost.deck_list_id IS NOT NULL
+			AND won.deck_list_id IS NOT NULL
+		ORDER BY lost.id, won.id
+		LIMIT 1;
+		counted = FOUND;
+
+		SELECT * INTO previous
+		FROM deck_matchup_stats_game
+		WHERE game_id = game;
+
+		IF FOUND THEN
+			IF counted AND previous = contribution THEN
+				RETURN;
+			END IF;
+
+			DELETE FROM deck_matchup_stats_game WHERE game_id = game;
+
+			UPDATE deck_matchup_stats
+			SET games = games - 1
+			WHERE loser_deck_id = previous.loser_deck_id
+				AND epoch_seconds = previous.epoch_seconds
+				AND game_type = previous.game_type
+				AND rank_bucket = previous.rank_bucket
+				AND winner_deck_id = previous.winner_deck_id;
+		END IF;
+
+		IF NOT counted THEN
+			RETURN;
+		END IF;
+
+		INSERT INTO deck_matchup_stats_game SELECT contribution.*;
+
+		INSERT INTO deck_matchup_stats (
+			epoch_seconds,
+			loser_deck_id,
+			winner_deck_id,
+			game_type,
+			rank_bucket,
+			games
+		)
+		VALUES (
+			contribution.epoch_seconds,
+			contribution.loser_deck_id,
+			contribution.winner_deck_id,
+			contribution.game_type,
+			contribution.rank_bucket,
+			1
+		) ON CONFLICT (loser_deck_id, epoch_seconds, game_type, rank_bucket, winner_deck_id)
+		DO UPDATE SET games = deck_matchup_stats.games + 1;
+	END;
+	$$ LANGUAGE plpgsql;
+"""
+
+DROP_REFRESH_DECK_MATCHUP_STATS_FUNCTION = """
+	DROP FUNCTION refresh_deck_matchup_stats(game int8);
+"""
+
+CREATE_MAINT_DECK_MATCHUP_STATS_FUNCTION = """
+	CREATE OR REPLACE FUNCTION maint_deck_matchup_stats() RETURNS TRIGGER AS $$
+	BEGIN
+		IF (TG_OP = 'DELETE') THEN
+
+			PERFORM refresh_deck_matchup_stats(OLD.game_id);
+
+		ELSIF (TG_OP = 'UPDATE') THEN
+
+			-- Most updates (eg. linking a user) don't affect the matchup
+			IF (OLD.game_id, OLD.deck_list_id, OLD.final_state, OLD.rank)
+			IS DISTINCT FROM (NEW.game_id, NEW.deck_list_id, NEW.final_state, NEW.rank) THEN
+				IF (OLD.game_id != NEW.game_id) THEN
+					PERFORM refresh_deck_matchup_stats(OLD.game_id);
+				END IF;
+				PERFORM refresh_deck_matchup_stats(NEW.game_id);
+			END IF;
+
+		ELSIF (TG_OP = 'INSERT') THEN
+
+			PERFORM refresh_deck_matchup_stats(NEW.game_id);
+
+		END IF;
+
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+"""
+
+DROP_MAINT_DECK_MATCHUP_STATS_FUNCTION = """
+	DROP FUNCTION maint_deck_matchup_stats();
+"""
+
+CREATE_DECK_MATCHUP_STATS_TRIGGER = """
+	CREATE TRIGGER maint_deck_matchup_stats
+	AFTER INSERT OR UPDATE OR DELETE ON games_globalgameplayer
+		FOR EACH ROW EXECUTE PROCEDURE maint_deck_matchup_stats();
+"""
+
+DROP_DECK_MATCHUP_STATS_TRIGGER = """
+	DROP TRIGGER IF EXISTS maint_deck_matchup_stats ON games_globalgameplayer;
+"""
+
+# Runs before the trigger is created, in the same transaction. The lock keeps
+# players from being written in between, which would be missed by both.
+BACKFILL_DECK_MATCHUP_STATS = """
+	LOCK TABLE games_globalgameplayer IN SHARE MODE;
+
+	INSERT INTO deck_matchup_stats_game (
+		game_id,
+		epoch_seconds,
+		loser_deck_id,
+		winner_deck_id,
+		game_type,
+		rank_bucket
+	)
+	SELECT DISTINCT ON (gg.id)
+		gg.id,
+		round(date_part('epoch', date_trunc('hour', gg.match_start))),
+		lost.deck_list_id,
+		won.deck_list_id,
+		gg.game_type,
+		COALESCE(lost.rank, -1)
+	FROM games_globalgame gg
+	JOIN games_globalgameplayer lost
+		ON lost.game_id = gg.id AND lost.final_state = 5
+	JOIN games_globalgameplayer won
+		ON won.game_id = gg.id AND won.final_state = 4
+	WHERE gg.match_start IS NOT NULL
+		AND gg.game_type IS NOT NULL
+		AND lost.deck_list_id IS NOT NULL
+		AND won.deck_list_id IS NOT NULL
+	ORDER BY gg.id, lost.id, won.id;
+
+	INSERT INTO deck_matchup_stats (
+		epoch_seconds,
+		loser_deck_id,
+		winner_deck_id,
+		game_type,
+		rank_bucket,
+		games
+	)
+	SELECT
+		epoch_seconds,
+		loser_deck_id,
+		winner_deck_id,
+		game_type,
+		rank_bucket,
+		count(*)
+	FROM deck_matchup_stats_game
+	GROUP BY 1, 2, 3, 4, 5;
+"""
+
+CLEAR_DECK_MATCHUP_STATS = """
+	TRUNCATE deck_matchup_stats, deck_matchup_stats_game;
+"""
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('cards', '0003_auto_20161008_1520'),
+		('games', '0012_auto_20161002_0229'),
+	]
+
+	operations = [
+		migrations.RunSQL(
+			CREATE_TABLE_DECK_MATCHUP_STATS,
+			DROP_TABLE_DECK_MATCHUP_STATS
+		),
+		migrations.RunSQL(
+			CREATE_TABLE_DECK_MATCHUP_STATS_GAME,
+			DROP_TABLE_DECK_MATCHUP_STATS_GAME
+		),
+		migrations.RunSQL(
+			CREATE_REFRESH_DECK_MATCHUP_STATS_FUNCTION,
+			DROP_REFRESH_DECK_MATCHUP_STATS_FUNCTION
+		),
+		migrations.RunSQL(
+			CREATE_MAINT_DECK_MATCHUP_STATS_FUNCTION,
+			DROP_MAINT_DECK_MATCHUP_STATS_FUNCTION
+		),
+		migrations.RunSQL(
+			BACKFILL_DECK_MATCHUP_STATS,
+			CLEAR_DECK_MATCHUP_STATS
+		),
+		migrations.RunSQL(
+			CREATE_DECK_MATCHUP_STATS_TRIGGER,
+			DROP_DECK_MATCHUP_STATS_TRIGGER
+		),
+	]
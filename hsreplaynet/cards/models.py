@@ -27,12 +27,25 @@ class CardManager(models.Manager):
 			return random.choice(cards)
 
 	def get_valid_deck_list_card_set(self):
-		if not hasattr(self, "_usable_cards"):
+		from .cache import get_cards_version
+
+		version = get_cards_version()
+		if getattr(self, "_usable_cards_version", None) != version:
 			card_list = Card.objects.filter(collectible=True).exclude(type=enums.CardType.HERO)
 			self._usable_cards = set(c[0] for c in card_list.values_list("id"))
+			self._usable_cards_version = version
 
 		return self._usable_cards
 
+	def clear_cache(self):
+		"""
+		Clear the cached card sets in every process, eg. after cards have been loaded.
+		"""
+		from .cache import invalidate_cards_cache
+
+		invalidate_cards_cache()
+		self._usable_cards_version = None
+
 	def get_by_partial_name(self, name):
 		"""Makes a best guess attempt to return a card based on a full or partial name."""
 		return Card.objects.filter(collectible=True).filter(name__icontains=name).first()
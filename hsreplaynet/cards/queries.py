@@ -119,25 +119,32 @@ class DeckWinRateQueryBuilder:
 
 
 class CardCountersQueryBuilder:
+	"""
+	Finds the decks which most often beat decks containing the given cards.
+
+	Reads from deck_matchup_stats, which is maintained by a trigger on
+	games_globalgameplayer (see cards migration 0004), so this is an index
+	lookup on the losing decks rather than a scan of all games.
+	"""
 	query_template = """
 		SELECT
-			ggp_won.deck_list_id,
-			COUNT(*)
+			dms.winner_deck_id,
+			sum(dms.games)
 		FROM ( %s ) decks_i_want_to_beat
-		JOIN games_globalgameplayer ggp_lost
-			ON ggp_lost.deck_list_id = decks_i_want_to_beat.deck_id
-			AND ggp_lost.final_state = 5
-			AND ggp_lost.rank <= 15
-		JOIN games_globalgame gg ON gg.id = ggp_lost.game_id
-		JOIN games_globalgameplayer ggp_won
-			ON ggp_won.game_id = gg.id AND ggp_won.final_state = 4
-		GROUP BY ggp_won.deck_list_id
-		ORDER BY count(*) DESC
-		LIMIT 20;
+		JOIN deck_matchup_stats dms
+			ON dms.loser_deck_id = decks_i_want_to_beat.deck_id
+		WHERE true %s
+		GROUP BY dms.winner_deck_id
+		ORDER BY sum(dms.games) DESC
+		LIMIT %s;
 	"""
 
 	def __init__(self):
 		self.cards = None
+		self.max_rank = 15
+		self.game_type = None
+		self.lookback_days = None
+		self.limit = 20
 
 	def _inner_decks_query(self, cards):
 		card_groups = groupby(sorted(cards, key=lambda c: c.id), key=lambda c: c.id)
@@ -155,9 +162,27 @@ class CardCountersQueryBuilder:
 				query += join_template % (cardid, count, index, index)
 		return query
 
+	def _generate_filters(self):
+		filters = ""
+
+		if self.max_rank is not None:
+			# Games with an unknown rank have rank_bucket = -1
+			filters += " AND dms.rank_bucket BETWEEN 0 AND %i" % int(self.max_rank)
+
+		if self.game_type:
+			filters += " AND dms.game_type = %i" % int(self.game_type)
+
+		if self.lookback_days:
+			filters += " AND dms.epoch_seconds >= " \
+				"date_part('epoch', now() - INTERVAL '%i days')" % int(self.lookback_days)
+
+		return filters
+
 	def _generate_final_query(self):
 		columns = ("deck", "win_count")
-		query = self.query_template % self._inner_decks_query(self.cards)
+		query = self.query_template % (
+			self._inner_decks_query(self.cards), self._generate_filters(), int(self.limit)
+		)
 		return columns, query
 
 	def result(self):
@@ -93,6 +93,32 @@ def counters(request):
 	context["cards"] = cards
 	query_builder.cards = context["cards"]
 
+	player_rank_param = request.GET.get("player_rank", "")
+	if player_rank_param:
+		if not player_rank_param.isnumeric():
+			return HttpResponseBadRequest("'player_rank' must be numeric")
+		else:
+			query_builder.max_rank = int(player_rank_param)
+	context["max_rank"] = query_builder.max_rank
+
+	game_type_param = request.GET.get("game_type", "").upper()
+	if game_type_param:
+		if game_type_param not in BnetGameType.__members__:
+			return HttpResponseBadRequest(
+				"'game_type' must be a value like 'bgt_ranked_standard'"
+			)
+		else:
+			context["game_type"] = BnetGameType[game_type_param].name
+			query_builder.game_type = BnetGameType[game_type_param].value
+
+	days_param = request.GET.get("days", "")
+	if days_param:
+		if not days_param.isnumeric():
+			return HttpResponseBadRequest("'days' must be numeric")
+		else:
+			context["lookback_days"] = int(days_param)
+			query_builder.lookback_days = context["lookback_days"]
+
 	columns, counters_by_match_count = query_builder.result()
 
 	context["counter_deck_columns"] = columns
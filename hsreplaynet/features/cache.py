@@ -0,0 +1,107 @@
+"""
+In-process cache of the Feature table.
+
+Every process keeps a snapshot of all Features, reloaded after
+settings.FEATURE_CACHE_SECONDS. Saving or deleting a Feature publishes a
+message on a Redis channel which all processes listen to, so changes
+(eg. turning a feature OFF) still apply immediately everywhere.
+If Redis is unavailable, the snapshot simply expires with its TTL.
+"""
+import threading
+import time
+from django.conf import settings
+from hsreplaynet.utils import log
+
+
+FEATURE_INVALIDATION_CHANNEL = "hsreplaynet:features:invalidate"
+
+# How long to wait before reconnecting to Redis after a failure
+REDIS_RETRY_SECONDS = 30
+
+
+def _get_redis():
+	# Imported here, as redis is not available on Lambda
+	from redis import Redis
+	return Redis()
+
+
+class FeatureSnapshotCache:
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._features = None
+		self._expires = 0
+		self._pubsub = None
+		self._redis_retry_at = 0
+
+	def get(self, name):
+		"""
+		Return the Feature called `name`.
+		Raises Feature.DoesNotExist, like Feature.objects.get(name=name).
+		"""
+		try:
+			return self.snapshot()[name]
+		except KeyError:
+			from .models import Feature
+			raise Feature.DoesNotExist("No such feature: %r" % (name))
+
+	def snapshot(self):
+		with self._lock:
+			invalidated = self._poll_invalidations()
+			if invalidated or self._features is None or time.time() >= self._expires:
+				from .models import Feature
+
+				self._features = {f.name: f for f in Feature.objects.all()}
+				self._expires = time.time() + self.ttl
+
+			return self._features
+
+	def invalidate(self):
+		"""
+		Drop this process's snapshot and notify all other processes.
+		"""
+		with self._lock:
+			self._features = None
+
+		try:
+			_get_redis().publish(FEATURE_INVALIDATION_CHANNEL, "1")
+		except Exception as e:
+			log.warning("Could not publish feature cache invalidation: %s", e)
+
+	def _poll_invalidations(self):
+		"""
+		Read any pending invalidation messages without blocking.
+		Returns True if the snapshot should be reloaded.
+		"""
+		if self._pubsub is None:
+			if time.time() < self._redis_retry_at:
+				return False
+			try:
+				pubsub = _get_redis().pubsub()
+				pubsub.subscribe(FEATURE_INVALIDATION_CHANNEL)
+			except Exception as e:
+				log.warning("Could not subscribe to feature cache invalidations: %s", e)
+				self._redis_retry_at = time.time() + REDIS_RETRY_SECONDS
+				return False
+			self._pubsub = pubsub
+			# Anything may have changed while we were not listening
+			return True
+
+		invalidated = False
+		try:
+			while True:
+				message = self._pubsub.get_message()
+				if message is None:
+					break
+				if message["type"] == "message":
+					invalidated = True
+		except Exception as e:
+			log.warning("Lost feature cache invalidation channel: %s", e)
+			self._pubsub = None
+			self._redis_retry_at = time.time() + REDIS_RETRY_SECONDS
+			return True
+
+		return invalidated
+
+
+feature_cache = FeatureSnapshotCache(ttl=settings.FEATURE_CACHE_SECONDS)
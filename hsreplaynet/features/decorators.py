@@ -1,6 +1,7 @@
 from functools import wraps
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from .cache import feature_cache
 from .models import Feature
 from hsreplaynet.utils.instrumentation import error_handler
 
@@ -16,7 +17,7 @@ def view_requires_feature_access(feature_name):
 				return view_func(request, *args, **kwargs)
 
 			try:
-				feature = Feature.objects.get(name=feature_name)
+				feature = feature_cache.get(feature_name)
 				is_enabled = feature.enabled_for_user(request.user)
 			except Feature.DoesNotExist as e:
 				error_handler(e)
@@ -48,6 +48,21 @@ class FeatureStatus(IntEnum):
 	AUTHORIZED_ONLY = 4
 
 
+def get_user_group_names(user):
+	"""
+	Return the names of the groups the user is in.
+	The result is memoized on the user object, so it is looked up once per request.
+	"""
+	if not user.is_authenticated:
+		return frozenset()
+
+	group_names = getattr(user, "_feature_group_names", None)
+	if group_names is None:
+		group_names = frozenset(user.groups.values_list("name", flat=True))
+		user._feature_group_names = group_names
+	return group_names
+
+
 class Feature(models.Model):
 	"""
 	A Feature is any logical chunk of functionality whose visibility should be
@@ -92,13 +107,13 @@ class Feature(models.Model):
 			return False
 
 		if self.status == FeatureStatus.IN_PROGRESS:
-			return user.groups.filter(name=self.preview_group_name).exists()
+			return self.preview_group_name in get_user_group_names(user)
 
 		if self.status == FeatureStatus.PUBLIC:
 			return True
 
 		if self.status == FeatureStatus.AUTHORIZED_ONLY:
-			return user.groups.filter(name=self.authorized_group_name).exists()
+			return self.authorized_group_name in get_user_group_names(user)
 
 	def add_user_to_preview_group(self, user):
 		user.groups.add(self.preview_group)
@@ -128,3 +143,11 @@ def create_feature_membership_groups(sender, instance, **kwargs):
 
 	Group.objects.get_or_create(name=instance.preview_group_name)
 	Group.objects.get_or_create(name=instance.authorized_group_name)
+
+
+@receiver(models.signals.post_save, sender=Feature)
+@receiver(models.signals.post_delete, sender=Feature)
+def invalidate_feature_cache(sender, instance, **kwargs):
+	from .cache import feature_cache
+
+	feature_cache.invalidate()
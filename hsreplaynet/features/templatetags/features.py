@@ -1,5 +1,6 @@
 from django import template
 from django.conf import settings
+from hsreplaynet.features.cache import feature_cache
 from hsreplaynet.features.models import Feature
 from hsreplaynet.utils.instrumentation import error_handler
 
@@ -30,7 +31,7 @@ def feature(context, feature_name):
 	user = context["request"].user
 
 	try:
-		feature = Feature.objects.get(name=feature_name)
+		feature = feature_cache.get(feature_name)
 	except Feature.DoesNotExist as e:
 		error_handler(e)
 		# Missing features are treated as if they are set to FeatureStatus.STAFF_ONLY
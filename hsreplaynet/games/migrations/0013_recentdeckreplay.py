@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0004_deck_matchup_stats'),
+        ('games', '0012_auto_20161002_0229'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecentDeckReplay',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('account_lo', models.BigIntegerField(blank=True, help_text='The account ID of the player who played the deck', null=True)),
+                ('opponent_account_lo', models.BigIntegerField(blank=True, help_text='The account ID of the other player', null=True)),
+                ('match_start', models.DateTimeField(null=True)),
+                ('deck', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cards.Deck')),
+                ('replay', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='games.GameReplay')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='recentdeckreplay',
+            unique_together=set([('deck', 'replay')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='recentdeckreplay',
+            index_together=set([('deck', 'match_start')]),
+        ),
+    ]
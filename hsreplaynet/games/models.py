@@ -376,6 +376,66 @@ class GameReplay(models.Model):
 		return recommend_related_replays(self, num)
 
 
+class RecentDeckReplayManager(models.Manager):
+	def add_replay(self, replay, players):
+		"""
+		Index a replay under the decks of both of its players.
+		Only the `settings.RECENT_DECK_REPLAYS_PER_DECK` most recent replays
+		are kept for each deck.
+		"""
+		if replay.visibility != Visibility.Public or replay.is_deleted:
+			return
+
+		if len(players) != 2:
+			return
+
+		match_start = replay.global_game.match_start
+		player1, player2 = players
+		for player, opponent in ((player1, player2), (player2, player1)):
+			self.get_or_create(deck_id=player.deck_list_id, replay=replay, defaults={
+				"account_lo": player.account_lo,
+				"opponent_account_lo": opponent.account_lo,
+				"match_start": match_start,
+			})
+			self.trim(player.deck_list_id)
+
+	def trim(self, deck_id):
+		entries = self.filter(deck_id=deck_id).order_by("-match_start", "-id")
+		stale = entries.values_list("id", flat=True)[settings.RECENT_DECK_REPLAYS_PER_DECK:]
+		stale = list(stale)
+		if stale:
+			self.filter(id__in=stale).delete()
+
+
+class RecentDeckReplay(models.Model):
+	"""
+	An index of the most recent public replays played with each deck,
+	used to recommend related replays without searching all replays.
+
+	Maintained when replays are processed (see RecentDeckReplayManager.add_replay).
+	Visibility may change after a replay is indexed, so it must be checked
+	again when reading.
+	"""
+	id = models.BigAutoField(primary_key=True)
+	deck = models.ForeignKey(Deck, on_delete=models.CASCADE, related_name="+")
+	replay = models.ForeignKey(GameReplay, on_delete=models.CASCADE, related_name="+")
+	account_lo = models.BigIntegerField(
+		null=True, blank=True,
+		help_text="The account ID of the player who played the deck"
+	)
+	opponent_account_lo = models.BigIntegerField(
+		null=True, blank=True,
+		help_text="The account ID of the other player"
+	)
+	match_start = models.DateTimeField(null=True)
+
+	objects = RecentDeckReplayManager()
+
+	class Meta:
+		unique_together = ("deck", "replay")
+		index_together = ("deck", "match_start")
+
+
 @receiver(models.signals.post_delete, sender=GameReplay)
 def cleanup_hsreplay_file(sender, instance, **kwargs):
 	from hsreplaynet.utils import delete_file_async
@@ -7,14 +7,14 @@ from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from hearthstone.enums import CardType, GameTag
-from hearthstone.hslog.export import EntityTreeExporter
-from hsreplay.document import HSReplayDocument
 from hsreplaynet.cards.models import Card, Deck
 from hsreplaynet.utils import guess_ladder_season, log
 from hsreplaynet.utils.influx import influx_metric
 from hsreplaynet.uploads.models import UploadEventStatus
 from .metrics import InfluxInstrumentedParser
-from .models import GameReplay, GlobalGame, GlobalGamePlayer, _generate_upload_path
+from .models import (
+	GameReplay, GlobalGame, GlobalGamePlayer, RecentDeckReplay, _generate_upload_path
+)
 
 
 class ProcessingError(Exception):
@@ -52,6 +52,8 @@ def get_valid_match_start(match_start, upload_date):
 
 
 def create_hsreplay_document(parser, entity_tree, meta, global_game):
+	from hsreplay.document import HSReplayDocument
+
 	hsreplay_doc = HSReplayDocument.from_parser(parser, build=meta["build"])
 	game_xml = hsreplay_doc.games[0]
 	game_xml.game_type = global_game.game_type
@@ -215,6 +217,8 @@ def handle_upload_event_exception(e):
 	The status will be set on the UploadEvent.
 	If reraise is True, the exception will bubble up.
 	"""
+	from hearthstone.hslog.export import EntityTreeExporter
+
 	if isinstance(e, ParsingError):
 		return UploadEventStatus.PARSING_ERROR, True
 	elif isinstance(e, (GameTooShort, EntityTreeExporter.EntityNotFound)):
@@ -227,10 +231,12 @@ def handle_upload_event_exception(e):
 		return UploadEventStatus.SERVER_ERROR, True
 
 
-def process_upload_event(upload_event):
+def process_upload_event(upload_event, log_bytes=None):
 	"""
 	Wrapper around do_process_upload_event() to set the event's
 	status and error/traceback as needed.
+
+	If log_bytes is provided, it is parsed instead of the UploadEvent's file.
 	"""
 	upload_event.error = ""
 	upload_event.traceback = ""
@@ -239,7 +245,7 @@ def process_upload_event(upload_event):
 		upload_event.save()
 
 	try:
-		replay = do_process_upload_event(upload_event)
+		replay = do_process_upload_event(upload_event, log_bytes)
 	except Exception as e:
 		upload_event.error = str(e)
 		upload_event.traceback = traceback.format_exc()
@@ -282,20 +288,22 @@ def capture_class_distribution_stats(replay):
 	influx_metric("replay_outcome_stats", fields=fields, **tags)
 
 
-def parse_upload_event(upload_event, meta):
+def parse_upload_event(upload_event, meta, log_bytes=None):
 	orig_match_start = dateutil_parse(meta["match_start"])
 	match_start = get_valid_match_start(orig_match_start, upload_event.created)
 	if match_start != orig_match_start:
 		upload_event.tainted = True
 		upload_event.save()
 
-	upload_event.file.open(mode="rb")
-	log_bytes = upload_event.file.read()
+	if log_bytes is None:
+		upload_event.file.open(mode="rb")
+		log_bytes = upload_event.file.read()
+		upload_event.file.close()
+
 	if not log_bytes:
 		raise ValidationError("The uploaded log file is empty.")
 	influx_metric("raw_power_log_upload_num_bytes", {"size": len(log_bytes)})
 	powerlog = StringIO(log_bytes.decode("utf-8"))
-	upload_event.file.close()
 
 	try:
 		parser = InfluxInstrumentedParser(upload_event.shortid, meta)
@@ -437,11 +445,19 @@ def update_global_players(global_game, entity_tree, meta):
 	return players
 
 
-def do_process_upload_event(upload_event):
+def update_scenario_ai_decks(global_game, players):
+	from hsreplaynet.scenarios.models import ScenarioAIDeckCard
+
+	for player in players.values():
+		if player.is_ai:
+			ScenarioAIDeckCard.objects.update_from_deck(global_game.scenario_id, player.deck_list_id)
+
+
+def do_process_upload_event(upload_event, log_bytes=None):
 	meta = json.loads(upload_event.metadata)
 
 	# Parse the UploadEvent's file
-	parser = parse_upload_event(upload_event, meta)
+	parser = parse_upload_event(upload_event, meta, log_bytes)
 	# Validate the resulting object and metadata
 	entity_tree = validate_parser(parser, meta)
 
@@ -454,4 +470,11 @@ def do_process_upload_event(upload_event):
 		parser, entity_tree, meta, upload_event, global_game, players
 	)
 
+	if not upload_event.test_data:
+		# Index the replay for related replay recommendations
+		RecentDeckReplay.objects.add_replay(replay, list(players.values()))
+
+		if global_game.scenario_id:
+			update_scenario_ai_decks(global_game, players)
+
 	return replay
@@ -1,8 +1,10 @@
 """A module for generating Replay recommendations."""
 from enum import IntEnum
-from itertools import chain, islice
+from itertools import chain
+from django.conf import settings
+from django.core.cache import cache
 from hearthstone.enums import BnetGameType
-from hsreplaynet.games.models import GameReplay, Visibility
+from hsreplaynet.games.models import GameReplay, RecentDeckReplay, Visibility
 
 
 class ReplayRecommendationReason(IntEnum):
@@ -27,8 +29,10 @@ class RecommendationGenerator:
 	"""Subclasses should supply a reason and populate recommendations during generate()"""
 	reason = None
 
-	def __init__(self, source_replay, max):
+	def __init__(self, source_replay, max, friendly_player, opposing_player):
 		self.source_replay = source_replay
+		self.friendly_player = friendly_player
+		self.opposing_player = opposing_player
 		self.recommendations = []
 		self.max = max
 
@@ -46,30 +50,44 @@ class RecommendationGenerator:
 		raise NotImplementedError("Must be implemented by subclasses.")
 
 
+def get_public_replays(ids):
+	"""
+	Return the public, non-deleted replays among `ids`, in the same order.
+	"""
+	replays = GameReplay.objects.filter(
+		visibility=Visibility.Public, is_deleted=False
+	).select_related("global_game").in_bulk(ids)
+	return [replays[id] for id in ids if id in replays]
+
+
 class DeckMatchGenerator(RecommendationGenerator):
 	def generate(self):
-		account_lo = self.source_replay.friendly_player.account_lo
-		query = GameReplay.objects.filter(
-			visibility=Visibility.Public,
-			global_game__players__deck_list=self.deck
-		).exclude(global_game__players__account_lo=account_lo)[:self.max]
-		self.recommendations += query
+		account_lo = self.friendly_player.account_lo
+		entries = RecentDeckReplay.objects.filter(deck_id=self.deck_id)
+		entries = entries.exclude(replay__global_game_id=self.source_replay.global_game_id)
+		if account_lo is not None:
+			entries = entries.exclude(account_lo=account_lo)
+			entries = entries.exclude(opponent_account_lo=account_lo)
+
+		# The index is bounded per deck, so this never reads more than a few rows
+		ids = list(entries.order_by("-match_start").values_list("replay_id", flat=True))
+		self.recommendations += get_public_replays(ids)[:self.max]
 
 
 class FriendlyDeckMatchGenerator(DeckMatchGenerator):
 	reason = ReplayRecommendationReason.FRIENDLY_DECK_MATCH
 
 	@property
-	def deck(self):
-		return self.source_replay.friendly_player.deck_list
+	def deck_id(self):
+		return self.friendly_player.deck_list_id
 
 
 class OpponentDeckMatchGenerator(DeckMatchGenerator):
 	reason = ReplayRecommendationReason.OPPONENT_DECK_MATCH
 
 	@property
-	def deck(self):
-		return self.source_replay.opposing_player.deck_list
+	def deck_id(self):
+		return self.opposing_player.deck_list_id
 
 
 # Generators are evaluated in order
@@ -89,13 +107,55 @@ GENERATORS = {
 }
 
 
+def generate_related_replays(replay, num):
+	game_type = replay.global_game.game_type
+	if not GENERATORS.get(game_type):
+		return []
+
+	# Fetch both players at once rather than once per generator
+	players = list(replay.global_game.players.all())
+	friendly_player = opposing_player = None
+	for player in players:
+		if player.player_id == replay.friendly_player_id:
+			friendly_player = player
+		else:
+			opposing_player = player
+	if friendly_player is None or opposing_player is None:
+		return []
+
+	generators = [
+		G(replay, num, friendly_player, opposing_player) for G in GENERATORS[game_type]
+	]
+
+	# The same replay can match on both decks; only recommend it once
+	seen = set()
+	recommendations = []
+	for recommendation in chain.from_iterable(generators):
+		if len(recommendations) >= num:
+			break
+		if recommendation.replay.id not in seen:
+			seen.add(recommendation.replay.id)
+			recommendations.append(recommendation)
+
+	return recommendations
+
+
 def recommend_related_replays(replay, num):
 	"""
 	Attempts to generate up to num RelatedReplayRecommendation objects
 	"""
-	game_type = replay.global_game.game_type
-	generators = [G(replay, num) for G in GENERATORS[game_type]]
-
-	if generators:
-		return list(islice(chain.from_iterable(generators), 0, num))
-	return []
+	cache_key = "related_replays:%i:%i" % (replay.id, num)
+	cached = cache.get(cache_key)
+
+	if cached is None:
+		recommendations = generate_related_replays(replay, num)
+		cached = [(r.replay.id, int(r.reason)) for r in recommendations]
+		cache.set(cache_key, cached, settings.RELATED_REPLAYS_CACHE_SECONDS)
+		return recommendations
+
+	# Visibility may have changed since the recommendations were cached
+	replays = {r.id: r for r in get_public_replays([id for id, reason in cached])}
+	return [
+		RelatedReplayRecommendation(replays[id], ReplayRecommendationReason(reason))
+		for id, reason in cached if id in replays
+	]
@@ -0,0 +1,395 @@
+"""
+Per-function deployment artifacts for the Lambda handlers.
+
+Rather than shipping every dependency to every function, the builder works
+out what each handler can import:
+
+- First party modules (handlers.py, hsreplaynet) are followed module by
+  module, starting from the handler's module, the settings and the models of
+  the apps installed on Lambda. Function level imports are followed too, and
+  so are the modules Django imports from dotted path settings.
+- Third party packages are included whole (Django and friends import a lot
+  by name), along with whatever they import themselves, as long as it is
+  found in `site_packages`. Anything else is expected to be in the runtime's
+  standard library. The apps of django.contrib are the exception: each of
+  them is only included when it is imported, as most are only used on the
+  web servers.
+
+Tests, C sources and translations are left out, and the modules are
+precompiled by the Lambda runtime's interpreter, since Lambda can't write the
+.pyc files itself. The zips are deterministic so that unchanged functions can
+be detected by comparing the artifact hash with the function's CodeSha256.
+"""
+import base64
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from hsreplaynet.utils import log
+
+
+IMPORT_RE = re.compile(
+	r"^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+([^#\n]+)"
+	r"|import[ \t]+([^#\n]+))",
+	re.MULTILINE
+)
+
+PARENTHESIZED_IMPORT_RE = re.compile(r"import[ \t]*\(([^)]*)\)")
+
+# Left out of the artifacts, wherever they are found
+EXCLUDED_DIRECTORIES = ("__pycache__", "tests", "docs", "examples")
+EXCLUDED_SUFFIXES = (
+	".pyc", ".pyo", ".c", ".h", ".cpp", ".pyx", ".pxd", ".po", ".mo",
+	".md", ".rst",
+)
+
+# Packages whose subpackages are included one by one, when they are imported
+SPLIT_PACKAGES = ("django.contrib", )
+
+# Third party modules whose imports are not followed, as nothing run on Lambda
+# imports them: the admin modules of the apps, which are imported by the admin's
+# autodiscovery, and the DRF schema generation, which pulls in the admin docs
+UNFOLLOWED_MODULES = ("admin.py", "rest_framework/schemas.py")
+
+# Settings naming modules or classes which Django imports by dotted path
+# outside of the request cycle, so the import scan can't see them
+DOTTED_PATH_SETTINGS = (
+	"DATABASE_ROUTERS", "DEFAULT_FILE_STORAGE", "EMAIL_BACKEND", "LOGGING_CONFIG",
+)
+
+# Zip entries get a fixed timestamp so that identical inputs give identical zips
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+SOURCE_MTIME = 315532800  # 1980-01-01
+
+
+def code_sha256(payload):
+	"""
+	Return the hash of a zip payload as reported by Lambda (CodeSha256).
+	"""
+	return base64.b64encode(hashlib.sha256(payload).digest()).decode("ascii")
+
+
+def scan_imports(path):
+	"""
+	Return (module, names, level) for every import statement in `path`.
+	`level` is the number of leading dots of relative imports.
+
+	A regex is used rather than the ast module, as the scanned code may not
+	be valid syntax for the interpreter running the build.
+	"""
+	with open(path, "rb") as f:
+		source = f.read().decode("utf-8", "replace")
+
+	# Join continuation lines and parenthesized import lists
+	source = source.replace("\\\n", " ")
+	source = PARENTHESIZED_IMPORT_RE.sub(
+		lambda m: "import " + m.group(1).replace("\n", " "), source
+	)
+
+	ret = []
+	for match in IMPORT_RE.finditer(source):
+		module, names, imports = match.groups()
+		if imports is not None:
+			for name in imports.split(","):
+				name = name.split(" as ")[0].strip()
+				if name:
+					ret.append((name, [], 0))
+		else:
+			level = len(module) - len(module.lstrip("."))
+			names = [n.split(" as ")[0].strip(" \t()\\") for n in names.split(",")]
+			ret.append((module.lstrip("."), [n for n in names if n and n != "*"], level))
+	return ret
+
+
+def get_package_name(module):
+	"""
+	Return the name of the third party package providing `module`: its top
+	level package, or its subpackage of one of the SPLIT_PACKAGES.
+	"""
+	for split_package in SPLIT_PACKAGES:
+		if module.startswith(split_package + "."):
+			return ".".join(module.split(".")[:split_package.count(".") + 2])
+	return module.split(".")[0]
+
+
+def get_settings_modules(settings):
+	"""
+	Return the modules Django may import by name for `settings`: the settings
+	module itself, its local_settings, and those named by dotted path settings.
+	A dotted path may name a module or a class, so both candidates are returned;
+	the resolver ignores the one that doesn't exist.
+	"""
+	settings_module = settings.SETTINGS_MODULE
+	paths = []
+	for name in DOTTED_PATH_SETTINGS:
+		value = getattr(settings, name, None)
+		if value:
+			paths += [value] if isinstance(value, str) else list(value)
+
+	for alias in ("DATABASES", "CACHES"):
+		for config in getattr(settings, alias, {}).values():
+			paths += [config.get("ENGINE"), config.get("BACKEND")]
+
+	logging_config = getattr(settings, "LOGGING", None) or {}
+	for section in ("formatters", "filters", "handlers"):
+		for config in logging_config.get(section, {}).values():
+			paths += [config.get("class"), config.get("()")]
+
+	ret = [settings_module, settings_module.rpartition(".")[0] + ".local_settings"]
+	for path in paths:
+		if path and isinstance(path, str):
+			ret += [path, path.rpartition(".")[0]]
+	return ret
+
+
+class LambdaArtifactBuilder(object):
+	"""
+	Builds the minimal zip for a set of entry modules.
+
+	- base_dir: the project directory (the root of the first party modules)
+	- site_packages: the site-packages directory of the Lambda environment
+	- python: the interpreter used to precompile the modules, which should
+	  match the Lambda runtime. If None, the modules are not precompiled.
+	- apps: the apps installed on Lambda
+	- extra_modules: other modules imported by name
+	- settings: the Django settings used on Lambda, for the modules they
+	  name (see get_settings_modules)
+	"""
+	def __init__(
+		self, base_dir, site_packages, python=None, apps=(), extra_modules=(), settings=None
+	):
+		self.base_dir = base_dir
+		self.site_packages = site_packages
+		self.python = python
+		self.apps = list(apps)
+		self.extra_modules = list(extra_modules)
+		if settings is not None:
+			self.extra_modules += get_settings_modules(settings)
+		self._cache = {}
+		self._packages = {}
+		self._site_packages_entries = None
+		self._split_package_dirs = [
+			os.path.join(site_packages, *name.split(".")) for name in SPLIT_PACKAGES
+		]
+
+	def _find_module(self, name):
+		"""
+		Return the path of the first party module `name`, or None.
+		"""
+		path = os.path.join(self.base_dir, *name.split("."))
+		for candidate in (path + ".py", os.path.join(path, "__init__.py")):
+			if os.path.isfile(candidate):
+				return candidate
+		return None
+
+	def _find_package(self, name):
+		"""
+		Return the paths in site-packages making up the package or module
+		`name`, as returned by get_package_name().
+		"""
+		if name in self._packages:
+			return self._packages[name]
+
+		if "." in name:
+			path = os.path.join(self.site_packages, *name.split("."))
+			paths = [p for p in (path, path + ".py") if os.path.exists(p)]
+			self._packages[name] = paths
+			return paths
+
+		if self._site_packages_entries is None:
+			self._site_packages_entries = sorted(os.listdir(self.site_packages))
+
+		paths = []
+		for entry in self._site_packages_entries:
+			path = os.path.join(self.site_packages, entry)
+			if entry in (name, name + ".libs") and os.path.isdir(path):
+				# .libs holds the shared libraries bundled by manylinux wheels
+				paths.append(path)
+			elif entry.split(".")[0] == name and entry.endswith((".py", ".so", ".pyd")):
+				paths.append(path)
+
+		self._packages[name] = paths
+		return paths
+
+	def _find_distributions(self, packages):
+		"""
+		Return the metadata directories of the distributions providing
+		`packages`, for the packages which look up their own version.
+		"""
+		ret = []
+		for entry in os.listdir(self.site_packages):
+			if not entry.endswith((".dist-info", ".egg-info")):
+				continue
+			path = os.path.join(self.site_packages, entry)
+			top_level = os.path.join(path, "top_level.txt")
+			if not os.path.isfile(top_level):
+				continue
+			with open(top_level) as f:
+				if packages.intersection(f.read().split()):
+					ret.append(path)
+		return ret
+
+	def _iter_files(self, path):
+		if os.path.isfile(path):
+			yield path
+			return
+
+		for root, dirs, files in os.walk(path):
+			if root in self._split_package_dirs:
+				# The subpackages are packages of their own
+				dirs[:] = []
+				files = [f for f in files if f == "__init__.py"]
+			dirs[:] = sorted(d for d in dirs if d not in EXCLUDED_DIRECTORIES)
+			for filename in sorted(files):
+				if not filename.endswith(EXCLUDED_SUFFIXES):
+					yield os.path.join(root, filename)
+
+	def get_entry_modules(self, handler_module):
+		modules = ["handlers", handler_module] + self.extra_modules
+		for app in self.apps:
+			modules += [app, app + ".models"]
+		return modules
+
+	def resolve(self, entry_modules):
+		"""
+		Return the files making up the import closure of `entry_modules`,
+		as a dict of {path in the zip: path on disk}.
+		"""
+		first_party = {}
+		third_party = set()
+		pending = []
+		pending_packages = []
+
+		def add_package(package):
+			# A subpackage can't be imported without its parent packages
+			while package and package not in third_party and self._find_package(package):
+				third_party.add(package)
+				pending_packages.append(package)
+				package = get_package_name(package.rpartition(".")[0])
+
+		def add(name):
+			if self._find_module(name) is None:
+				add_package(get_package_name(name))
+				return
+
+			# Importing a.b.c also runs a/__init__.py and a/b/__init__.py
+			parts = name.split(".")
+			for i in range(1, len(parts) + 1):
+				module = ".".join(parts[:i])
+				path = self._find_module(module)
+				if path and module not in first_party:
+					first_party[module] = path
+					pending.append(module)
+
+		for module in entry_modules:
+			add(module)
+
+		while pending:
+			module = pending.pop()
+			path = first_party[module]
+			package = module if path.endswith("__init__.py") else module.rpartition(".")[0]
+			for name, names, level in scan_imports(path):
+				if level:
+					base = package.split(".")
+					if level > 1:
+						base = base[:-(level - 1)]
+					name = ".".join(base + ([name] if name else []))
+
+				add(name)
+				# The imported names may be submodules
+				for submodule in names:
+					submodule = name + "." + submodule
+					if self._find_module(submodule) or name in SPLIT_PACKAGES:
+						add(submodule)
+
+		# Third party packages are followed at the package level
+		files = {}
+		while pending_packages:
+			for path in self._find_package(pending_packages.pop()):
+				for filename in self._iter_files(path):
+					relpath = os.path.relpath(filename, self.site_packages)
+					files[relpath] = filename
+					if not filename.endswith(".py"):
+						continue
+					if ("/" + relpath).endswith(tuple("/" + m for m in UNFOLLOWED_MODULES)):
+						continue
+
+					package = os.path.dirname(relpath).split(os.sep)
+					for name, names, level in scan_imports(filename):
+						if level:
+							base = package[:len(package) - (level - 1)]
+							name = ".".join(base + ([name] if name else []))
+						if not name:
+							continue
+						add_package(get_package_name(name))
+						if name in SPLIT_PACKAGES:
+							for submodule in names:
+								add_package(get_package_name(name + "." + submodule))
+
+		top_level = set(package.split(".")[0] for package in third_party)
+		for path in self._find_distributions(top_level):
+			for filename in self._iter_files(path):
+				files[os.path.relpath(filename, self.site_packages)] = filename
+
+		for module, path in first_party.items():
+			files[os.path.relpath(path, self.base_dir)] = path
+
+		return files
+
+	def _compile(self, staging):
+		subprocess.check_call([self.python, "-m", "compileall", "-q", "-f", staging])
+
+	def build(self, handler_module):
+		"""
+		Return the zip payload for the handlers of `handler_module`.
+		Artifacts are cached, as several functions share a module.
+		"""
+		if handler_module in self._cache:
+			return self._cache[handler_module]
+
+		files = self.resolve(self.get_entry_modules(handler_module))
+		staging = tempfile.mkdtemp()
+		try:
+			for arcname, path in files.items():
+				target = os.path.join(staging, arcname)
+				if not os.path.isdir(os.path.dirname(target)):
+					os.makedirs(os.path.dirname(target))
+				shutil.copyfile(path, target)
+				# The .pyc files embed the source mtime
+				os.utime(target, (SOURCE_MTIME, SOURCE_MTIME))
+
+			if self.python:
+				self._compile(staging)
+
+			payload = self._zip(staging)
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+
+		log.info(
+			"Built %s: %i files, %i bytes", handler_module, len(files), len(payload)
+		)
+		self._cache[handler_module] = payload
+		return payload
+
+	def _zip(self, staging):
+		tmp = tempfile.NamedTemporaryFile()
+		with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zf:
+			for root, dirs, files in os.walk(staging):
+				dirs.sort()
+				# Python 3 compiles to __pycache__ which Lambda's 2.7 would ignore
+				dirs[:] = [d for d in dirs if d != "__pycache__"]
+				for filename in sorted(files):
+					path = os.path.join(root, filename)
+					info = zipfile.ZipInfo(os.path.relpath(path, staging), ZIP_DATE_TIME)
+					info.compress_type = zipfile.ZIP_DEFLATED
+					info.external_attr = 0o644 << 16
+					with open(path, "rb") as f:
+						zf.writestr(info, f.read())
+
+		tmp.seek(0)
+		payload = tmp.read()
+		tmp.close()
+		return payload
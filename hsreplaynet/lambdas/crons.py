@@ -3,10 +3,12 @@
 The cron schedule for these must be setup via the AWS Web Console.
 """
 import re
+import threading
 from collections import defaultdict
 from datetime import datetime, date, timedelta
 from django.conf import settings
-from hsreplaynet.uploads.models import RawUpload, UploadEvent
+from django.db import connection
+from hsreplaynet.uploads.models import RawUpload, UploadEvent, _generate_upload_key
 from hsreplaynet.utils import instrumentation, log, aws
 from hsreplaynet.utils.influx import influx_metric
 
@@ -24,29 +26,162 @@ def reap_orphan_descriptors_handler(event, context):
 	log.info("Finished.")
 
 
-def reap_orphans_for_date(reaping_date):
-	inventory = get_reaping_inventory_for_date(reaping_date)
-
-	for hour, hour_inventory in inventory.items():
-		reaped_orphan_count = 0
-		for minute, minute_inventory in hour_inventory.items():
-			for shortid, keys in minute_inventory.items():
-				if is_safe_to_reap(shortid, keys):
-					log.info("Reaping Descriptor: %r", keys["descriptor"])
-					aws.S3.delete_object(
-						Bucket=settings.S3_RAW_LOG_UPLOAD_BUCKET,
-						Key=keys["descriptor"]
-					)
-					reaped_orphan_count += 1
-				else:
-					log.info("Skipping Descriptor: %r (Unsafe To Reap)", keys["descriptor"])
-
-		log.info(
-			"A total of %s descriptors reaped for hour: %s" % (
-				str(reaped_orphan_count),
-				str(hour)
-			)
-		)
+@instrumentation.lambda_handler(cpu_seconds=300, tracing=False)
+def archive_processed_raw_uploads_handler(event, context):
+	"""A periodic job to archive raw uploads which were processed with deferred archival."""
+	archival_delay = timedelta(minutes=settings.S3_RAW_LOG_ARCHIVAL_DELAY_MINUTES)
+	cutoff = datetime.now() - archival_delay
+	log.info("Archiving Processed Raw Uploads Before: %r", cutoff.isoformat())
+
+	archived_count = archive_processed_raw_uploads(cutoff)
+	influx_metric("raw_uploads_archived", {"count": archived_count})
+	log.info("Finished.")
+
+
+def archive_processed_raw_uploads(cutoff):
+	"""
+	Move every raw upload older than cutoff which already has an UploadEvent
+	to its permanent location, then delete the raw objects in bulk.
+	"""
+	inventory = get_raw_upload_inventory(cutoff)
+	processed_shortids = get_existing_upload_event_shortids(
+		shortid for shortid, keys in inventory.items() if "log" in keys
+	)
+	log.info("%i raw uploads are eligible for archival", len(processed_shortids))
+
+	source_bucket = settings.S3_RAW_LOG_UPLOAD_BUCKET
+	target_bucket = settings.AWS_STORAGE_BUCKET_NAME
+	keys_to_delete = []
+
+	for shortid in processed_shortids:
+		keys = inventory[shortid]
+		targets = [(keys["log"], _generate_upload_key(keys["timestamp"], shortid))]
+		if "descriptor" in keys:
+			descriptor_key = _generate_upload_key(keys["timestamp"], shortid, "descriptor.json")
+			targets.append((keys["descriptor"], descriptor_key))
+
+		try:
+			for source_key, target_key in targets:
+				aws.S3.copy_object(
+					Bucket=target_bucket,
+					Key=target_key,
+					CopySource="%s/%s" % (source_bucket, source_key)
+				)
+		except Exception as e:
+			# Leave the raw objects in place so the next run can try again
+			log.exception("Could not archive %r: %r", shortid, e)
+			continue
+
+		# The UploadEvent points at the raw objects until they are archived
+		fields = {"file": targets[0][1]}
+		if "descriptor" in keys:
+			fields["descriptor"] = descriptor_key
+		UploadEvent.objects.filter(shortid=shortid, file=keys["log"]).update(**fields)
+
+		keys_to_delete += [source_key for source_key, target_key in targets]
+
+	deleted_count = aws.delete_objects(source_bucket, keys_to_delete)
+	log.info("Deleted %i raw objects", deleted_count)
+
+	return len(processed_shortids)
+
+
+def parse_raw_upload_key(key):
+	"""
+	Return (shortid, timestamp, "descriptor" or "log") for a key of the
+	raw uploads bucket, or None if the key is not recognized.
+	"""
+	if key.endswith("descriptor.json"):
+		match = re.match(RawUpload.DESCRIPTOR_KEY_PATTERN, key)
+		key_type = "descriptor"
+	else:
+		match = re.match(RawUpload.RAW_LOG_KEY_PATTERN, key)
+		key_type = "log"
+
+	if not match:
+		return None
+
+	fields = match.groupdict()
+	timestamp = datetime.strptime(fields["ts"], RawUpload.TIMESTAMP_FORMAT)
+	return fields["shortid"], timestamp, key_type
+
+
+def get_raw_upload_inventory(cutoff):
+	inventory = defaultdict(dict)
+
+	for object in aws.list_all_objects_in(settings.S3_RAW_LOG_UPLOAD_BUCKET, prefix="raw"):
+		key = object["Key"]
+		parsed = parse_raw_upload_key(key)
+		if not parsed:
+			log.info("Skipping unrecognized key: %r", key)
+			continue
+
+		shortid, timestamp, key_type = parsed
+		if timestamp >= cutoff:
+			continue
+
+		keys = inventory[shortid]
+		keys["timestamp"] = timestamp
+		keys[key_type] = key
+
+	return inventory
+
+
+def get_existing_upload_event_shortids(shortids, chunk_size=1000):
+	"""Return the set of shortids which have an UploadEvent, querying in chunks."""
+	result = set()
+	chunk = []
+	for shortid in shortids:
+		chunk.append(shortid)
+		if len(chunk) == chunk_size:
+			result.update(_filter_existing_shortids(chunk))
+			chunk = []
+
+	if chunk:
+		result.update(_filter_existing_shortids(chunk))
+
+	return result
+
+
+def _filter_existing_shortids(shortids):
+	return UploadEvent.objects.filter(shortid__in=shortids).values_list("shortid", flat=True)
+
+
+def reap_orphans_for_date(reaping_date, workers=None):
+	"""
+	Delete the descriptors of `reaping_date` which have neither a log nor an
+	UploadEvent. The hours of the day are listed and reaped in parallel.
+
+	Returns the number of descriptors reaped.
+	"""
+	workers = workers or settings.LAMBDA_ORPHAN_REAPING_WORKERS
+	hours = list(range(24))
+	reaped_counts = {}
+	errors = []
+
+	def reap_hours(hours):
+		try:
+			for hour in hours:
+				try:
+					reaped_counts[hour] = reap_orphans_for_hour(reaping_date, hour)
+				except Exception as e:
+					log.exception("Could not reap the orphans of hour %i: %r", hour, e)
+					errors.append(e)
+		finally:
+			# Every thread gets its own database connection
+			connection.close()
+
+	threads = [
+		threading.Thread(target=reap_hours, args=(hours[i::workers], ))
+		for i in range(min(workers, len(hours)))
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	for hour, reaped_orphan_count in sorted(reaped_counts.items()):
+		log.info("A total of %i descriptors reaped for hour: %i", reaped_orphan_count, hour)
 
 		# Report count of orphans to Influx
 		fields = {
@@ -60,42 +195,42 @@ def reap_orphans_for_date(reaping_date):
 			hour=hour
 		)
 
+	if errors:
+		raise errors[0]
 
-def is_safe_to_reap(shortid, keys):
-	if "log" in keys:
-		# If a log for the shortid exists it's not an orphan descriptor
-		# It's more likely data we're having trouble processing
-		return False
-
-	if UploadEvent.objects.filter(shortid=shortid).count():
-		# If an upload event for the shortid exists it's not an orphan
-		return False
+	return sum(reaped_counts.values())
 
-	return True
 
+def reap_orphans_for_hour(reaping_date, hour):
+	bucket = settings.S3_RAW_LOG_UPLOAD_BUCKET
+	prefix = "raw/%s/%02i/" % (reaping_date.strftime("%Y/%m/%d"), hour)
+	inventory = defaultdict(dict)
 
-def get_reaping_inventory_for_date(date):
-	descriptors = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
-	key_prefix = date.strftime("raw/%Y/%m/%d")
-
-	for object in aws.list_all_objects_in(
-		settings.S3_RAW_LOG_UPLOAD_BUCKET,
-		prefix=key_prefix
-	):
+	for object in aws.list_all_objects_in(bucket, prefix=prefix):
 		key = object["Key"]
-
-		if key.endswith("descriptor.json"):
-			match = re.match(RawUpload.DESCRIPTOR_KEY_PATTERN, key)
-			fields = match.groupdict()
-			shortid = fields["shortid"]
-			timestamp = datetime.strptime(fields["ts"], RawUpload.TIMESTAMP_FORMAT)
-			descriptors[timestamp.hour][timestamp.minute][shortid]["descriptor"] = key
-		else:
-			match = re.match(RawUpload.RAW_LOG_KEY_PATTERN, key)
-			fields = match.groupdict()
-			shortid = fields["shortid"]
-			timestamp = datetime.strptime(fields["ts"], RawUpload.TIMESTAMP_FORMAT)
-
-			descriptors[timestamp.hour][timestamp.minute][shortid]["log"] = key
-
-	return descriptors
+		parsed = parse_raw_upload_key(key)
+		if not parsed:
+			log.info("Skipping unrecognized key: %r", key)
+			continue
+
+		shortid, timestamp, key_type = parsed
+		inventory[shortid][key_type] = key
+
+	# If a log for the shortid exists it's not an orphan descriptor
+	# It's more likely data we're having trouble processing
+	candidates = {
+		shortid: keys["descriptor"] for shortid, keys in inventory.items() if "log" not in keys
+	}
+
+	# If an upload event for the shortid exists it's not an orphan either
+	existing_shortids = get_existing_upload_event_shortids(candidates)
+	orphans = sorted(
+		descriptor for shortid, descriptor in candidates.items()
+		if shortid not in existing_shortids
+	)
+
+	log.info(
+		"Reaping %i of %i descriptors for hour %i (%i have an upload event)",
+		len(orphans), len(inventory), hour, len(existing_shortids)
+	)
+	return aws.delete_objects(bucket, orphans)
@@ -3,6 +3,7 @@ import time
 from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from hsreplaynet.lambdas.artifacts import LambdaArtifactBuilder, code_sha256
 from hsreplaynet.uploads.models import UploadEvent, UploadEventStatus
 from hsreplaynet.utils.aws import get_kinesis_stream_arn_from_name
 from hsreplaynet.utils.aws.clients import IAM, LAMBDA
@@ -13,7 +14,17 @@ class Command(BaseCommand):
 	def add_arguments(self, parser):
 		parser.add_argument("module", help="The comma separated modules to inspect")
 		parser.add_argument(
-			"artifact", default="hsreplay.zip", help="The path to the lambdas zip artifact"
+			"artifact", nargs="?", default="hsreplay.zip",
+			help="The path to the lambdas zip artifact"
+		)
+		parser.add_argument(
+			"--site-packages",
+			help="Build a minimal artifact per function from this site-packages directory "
+			"(of the Lambda environment) instead of using the zip artifact"
+		)
+		parser.add_argument(
+			"--python", default="python2.7",
+			help="The interpreter used to precompile the minimal artifacts"
 		)
 		parser.add_argument(
 			"--wait", action="store_true",
@@ -35,16 +46,32 @@ class Command(BaseCommand):
 		execution_role_arn = response["Role"]["Arn"]
 		self.stdout.write("Execution Role Arn: %r" % (execution_role_arn))
 
-		artifact_path = options["artifact"]
-		self.stdout.write("Using code at path: %r" % (artifact_path))
-
-		with open(artifact_path, "rb") as artifact:
-			code_payload_bytes = artifact.read()
-		self.stdout.write("Code Payload Bytes: %s" % (len(code_payload_bytes)))
+		if options["site_packages"]:
+			self.stdout.write("Building artifacts from: %r" % (options["site_packages"]))
+			builder = LambdaArtifactBuilder(
+				base_dir=settings.BASE_DIR,
+				site_packages=options["site_packages"],
+				python=options["python"],
+				apps=settings.INSTALLED_APPS_CORE,
+				settings=settings,
+			)
+		else:
+			builder = None
+			artifact_path = options["artifact"]
+			self.stdout.write("Using code at path: %r" % (artifact_path))
+
+			with open(artifact_path, "rb") as artifact:
+				code_payload_bytes = artifact.read()
 
 		for descriptor in descriptors:
 			self.stdout.write("About to deploy: %s" % (descriptor["name"]))
 
+			if builder:
+				handler_name = descriptor["handler"].split(".")[-1]
+				handler_module = self.get_handler_module(handler_name)
+				code_payload_bytes = builder.build(handler_module)
+			self.stdout.write("Code Payload Bytes: %s" % (len(code_payload_bytes)))
+
 			existing_lambda = None
 			for func in all_lambdas["Functions"]:
 				if func["FunctionName"] == descriptor["name"]:
@@ -61,10 +88,13 @@ class Command(BaseCommand):
 					MemorySize=descriptor["memory"],
 				)
 
-				LAMBDA.update_function_code(
-					FunctionName=descriptor["name"],
-					ZipFile=code_payload_bytes,
-				)
+				if existing_lambda["CodeSha256"] == code_sha256(code_payload_bytes):
+					self.stdout.write("Code is unchanged - skipping code update.")
+				else:
+					LAMBDA.update_function_code(
+						FunctionName=descriptor["name"],
+						ZipFile=code_payload_bytes,
+					)
 
 			else:
 				self.stdout.write("New Lambda - will create.")
@@ -148,6 +178,14 @@ class Command(BaseCommand):
 		if options["wait"]:
 			self.wait_for_complete_deployment(timeout=30)
 
+	def get_handler_module(self, handler_name):
+		"""
+		Return the module defining a handler, as listed in handlers.LAMBDA_HANDLERS.
+		"""
+		import handlers
+
+		return handlers.LAMBDA_HANDLERS[handler_name]
+
 	def wait_for_complete_deployment(self, timeout):
 		"""
 		Wait up to \a timeout seconds for the deployment to finish
@@ -1,7 +1,12 @@
 import time
 import sys
-from datetime import datetime, timedelta
+from calendar import timegm
+from datetime import timedelta
 from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from hsreplaynet.uploads.canary import (
+	ACCEPTABLE_STATUSES, PROMOTE, CanaryEvaluator, UploadEventListener
+)
 from hsreplaynet.uploads.models import UploadEvent, UploadEventStatus
 from hsreplaynet.uploads.processing import queue_upload_events_for_reprocessing
 from hsreplaynet.utils.aws import is_processing_disabled
@@ -25,6 +30,22 @@ class Command(BaseCommand):
 			"--min-canary-uploads", type=int, default=10,
 			help="Minimum amount of Canary uploads to wait for"
 		)
+		parser.add_argument(
+			"--max-latency-ratio", type=float, default=2.0,
+			help="Uploads slower than this multiple of the PROD p90 count as slow (0: off)"
+		)
+		parser.add_argument(
+			"--margin", type=float, default=.05,
+			help="How much higher the canary failure and slow upload rates may be"
+		)
+		parser.add_argument(
+			"--z-score", type=float, default=2.58,
+			help="The z score used to decide whether a difference is significant"
+		)
+		parser.add_argument(
+			"--baseline-minutes", type=int, default=60,
+			help="Compare the canary against the PROD uploads of the last N minutes"
+		)
 
 	def log(self, msg):
 		self.stdout.write(msg)
@@ -67,7 +88,7 @@ class Command(BaseCommand):
 		self.log("New version is: %s" % new_version_num)
 
 		# This causes the new code to start getting used on canary upload events.
-		canary_period_start = datetime.now()
+		canary_period_start = now()
 		self.set_canary_version(new_version_num)
 
 		if options["bypass_canary"]:
@@ -87,46 +108,28 @@ class Command(BaseCommand):
 			return
 
 		# If we did not exit already, then we are doing a canary deployment.
-		max_wait_seconds = options["max_wait_seconds"]
-		max_wait_time = datetime.now() + timedelta(seconds=max_wait_seconds)
-
-		min_canary_uploads = options["min_canary_uploads"]
+		evaluator = CanaryEvaluator(
+			timegm(canary_period_start.utctimetuple()),
+			min_canary_uploads=options["min_canary_uploads"],
+			margin=options["margin"],
+			max_latency_ratio=options["max_latency_ratio"],
+			z=options["z_score"],
+		)
 
-		wait_for_more_canary_uploads = True
 		try:
-			while wait_for_more_canary_uploads:
-				canary_uploads = UploadEvent.objects.filter(
-					canary=True,
-					created__gte=canary_period_start,
-				).exclude(status__in=UploadEventStatus.processing_statuses())
-
-				if canary_uploads.count() >= min_canary_uploads:
-					wait_for_more_canary_uploads = False
-				elif len(self.get_failed_canaries(canary_uploads.all())):
-					# Exit early since some canaries have already failed
-					wait_for_more_canary_uploads = False
-				else:
-					if datetime.now() > max_wait_time:
-						msg = "Waited too long for canary events. Exiting."
-						self.log(msg)
-						raise RuntimeError(msg)
-
-					self.log(
-						"Found %i uploads... sleeping 5 seconds" % (canary_uploads.count(),)
-					)
-					time.sleep(5)
-
-			self.log(
-				"%s canary upload events have been found" % canary_uploads.count()
+			decision, reason = self.wait_for_canary_decision(
+				evaluator, canary_period_start,
+				max_wait_seconds=options["max_wait_seconds"],
+				baseline_minutes=options["baseline_minutes"],
 			)
-
-			canary_failures = self.get_canary_failures_since(canary_period_start)
-
-			if canary_failures:
-				# We have canary failures, time to rollback.
-				self.log("The following canary uploads have failed:")
-				self.log(", ".join(u.shortid for u in canary_failures))
-				raise RuntimeError("Failed canary events detected. Rolling back.")
+			self.log(reason)
+
+			if decision != PROMOTE:
+				canary_failures = self.get_canary_failures_since(canary_period_start)
+				if canary_failures:
+					self.log("The following canary uploads have failed:")
+					self.log(", ".join(u.shortid for u in canary_failures))
+				raise RuntimeError("The canary version failed. Rolling back.")
 		except Exception:
 
 			# Revert the canary alias back to what PROD still points to
@@ -147,13 +150,7 @@ class Command(BaseCommand):
 		self.log("Finished.")
 
 	def get_failed_canaries(self, canaries):
-		acceptable_status = [
-			UploadEventStatus.SUCCESS,
-			UploadEventStatus.UNSUPPORTED_CLIENT,
-			UploadEventStatus.UNSUPPORTED
-		]
-
-		canary_failures = [c for c in canaries if c.status not in acceptable_status]
+		canary_failures = [c for c in canaries if c.status not in ACCEPTABLE_STATUSES]
 
 		return canary_failures
 
@@ -165,3 +162,49 @@ class Command(BaseCommand):
 
 		canaries = canary_uploads.all()
 		return self.get_failed_canaries(canaries)
+
+	def wait_for_canary_decision(
+		self, evaluator, canary_period_start, max_wait_seconds, baseline_minutes
+	):
+		"""
+		Feed the evaluator with the uploads completed since the canary started,
+		as they complete, until it reaches a decision or we run out of time.
+		"""
+		deadline = time.time() + max_wait_seconds
+		completed = UploadEvent.objects.exclude(
+			status__in=UploadEventStatus.processing_statuses()
+		).exclude(status=UploadEventStatus.UNKNOWN)
+		canary_uploads = completed.filter(canary=True, created__gte=canary_period_start)
+
+		# Listen before loading, so that no completion falls in between
+		listener = None
+		if UploadEventListener.is_supported():
+			listener = UploadEventListener()
+		else:
+			self.log("Upload event notifications are not supported, polling instead")
+
+		try:
+			baseline_start = canary_period_start - timedelta(minutes=baseline_minutes)
+			evaluator.load(completed.filter(canary=False, created__gte=baseline_start))
+			evaluator.load(canary_uploads)
+
+			last_log = time.time()
+			while True:
+				decision, reason = evaluator.decide(final=time.time() >= deadline)
+				if decision:
+					return decision, reason
+
+				timeout = max(0, min(5, deadline - time.time()))
+				if listener:
+					for status in listener.wait(timeout):
+						evaluator.add(**status)
+				else:
+					time.sleep(timeout)
+					evaluator.load(canary_uploads)
+
+				if time.time() - last_log >= 5:
+					self.log(evaluator.summary())
+					last_log = time.time()
+		finally:
+			if listener:
+				listener.close()
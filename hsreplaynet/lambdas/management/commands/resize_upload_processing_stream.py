@@ -10,11 +10,19 @@ class Command(BaseCommand):
 			type=int,
 			help="The number of shards to make the stream"
 		)
+		parser.add_argument(
+			"--predictive", action="store_true",
+			help="Size the stream for the backlog and the forecast upload rate instead"
+		)
 
 	def handle(self, *args, **options):
-		num_shards = options["shards"]
-		self.stdout.write("Resizing stream to size: %i" % num_shards)
 		try:
-			resize_upload_processing_stream(num_shards)
+			if options["predictive"]:
+				self.stdout.write("Resizing stream for the forecast upload rate")
+				resize_upload_processing_stream(predictive=True)
+			else:
+				num_shards = options["shards"]
+				self.stdout.write("Resizing stream to size: %i" % num_shards)
+				resize_upload_processing_stream(num_shards)
 		except Exception as e:
 			self.stdout.write("ERROR: %s" % str(e))
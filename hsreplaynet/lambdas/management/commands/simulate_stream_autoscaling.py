@@ -0,0 +1,70 @@
+from calendar import timegm
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from hsreplaynet.utils.aws.autoscaling import (
+	ReactiveAutoscaler, StreamAutoscaler, UploadRateForecaster,
+	get_upload_counts, simulate_autoscaling
+)
+
+
+class Command(BaseCommand):
+	help = "Replay the past uploads through the stream autoscaling strategies"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--days", type=int, default=7, help="Replay the uploads of the last N days"
+		)
+		parser.add_argument(
+			"--processing-seconds", type=float, default=3.0,
+			help="The time it takes to process an upload"
+		)
+		parser.add_argument(
+			"--step-minutes", type=int, default=5, help="The resolution of the simulation"
+		)
+		parser.add_argument(
+			"--resize-minutes", type=int, default=15,
+			help="How often the autoscalers are consulted"
+		)
+
+	def handle(self, *args, **options):
+		end = now()
+		start = end - timedelta(days=options["days"])
+		history_weeks = settings.KINESIS_AUTOSCALING_HISTORY_WEEKS
+		step_seconds = options["step_minutes"] * 60
+		sla_seconds = settings.KINESIS_STREAM_PROCESSING_THROUGHPUT_SLA_SECONDS
+		min_shards = settings.KINESIS_UPLOAD_PROCESSING_STREAM_MIN_SHARDS
+		max_shards = settings.KINESIS_UPLOAD_PROCESSING_STREAM_MAX_SHARDS
+
+		history_start = start - timedelta(weeks=history_weeks)
+		self.stdout.write("Loading the uploads since %s" % (history_start))
+		counts = get_upload_counts(history_start, end, bucket_seconds=step_seconds)
+
+		autoscalers = {
+			"reactive": ReactiveAutoscaler(sla_seconds, min_shards, max_shards),
+			"predictive": StreamAutoscaler(
+				UploadRateForecaster({}, weeks=history_weeks),
+				sla_seconds, min_shards, max_shards,
+				lookahead_hours=settings.KINESIS_AUTOSCALING_LOOKAHEAD_HOURS,
+			),
+		}
+
+		self.stdout.write("%-12s %10s %12s %8s %12s" % (
+			"strategy", "sla hits", "shard hours", "resizes", "max backlog"
+		))
+		for name, autoscaler in sorted(autoscalers.items()):
+			stats = simulate_autoscaling(
+				autoscaler, counts,
+				start=timegm(start.utctimetuple()) // step_seconds * step_seconds,
+				end=timegm(end.utctimetuple()),
+				processing_duration=options["processing_seconds"],
+				sla_seconds=sla_seconds,
+				initial_shards=min_shards,
+				step_seconds=step_seconds,
+				resize_every=max(1, options["resize_minutes"] * 60 // step_seconds),
+			)
+			self.stdout.write("%-12s %9.2f%% %12.1f %8i %12i" % (
+				name, stats["sla_hits"] * 100, stats["shard_hours"],
+				stats["resizes"], stats["max_backlog"]
+			))
@@ -3,7 +3,6 @@ import json
 from threading import Thread
 from django.conf import settings
 from hsreplaynet.api.models import APIKey, AuthToken
-from hsreplaynet.api.serializers import UploadEventSerializer
 from hsreplaynet.uploads.models import (
 	UploadEvent, RawUpload, UploadEventStatus, _generate_upload_key
 )
@@ -144,6 +143,10 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 
 		return
 
+	# Start downloading the descriptor and the log while we set up the UploadEvent.
+	# Not before the double put check, so that duplicate invocations don't download it.
+	raw_upload.prefetch()
+
 	obj.log_group_name = log_group_name
 	obj.log_stream_name = log_stream_name
 
@@ -157,7 +160,11 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 	new_bucket = settings.AWS_STORAGE_BUCKET_NAME
 
 	# Move power.log/descriptor.json to the other bucket if it's needed
-	raw_upload.prepare_upload_event_log_location(new_bucket, new_log_key, new_descriptor_key)
+	# When archival is deferred, the files stay in the raw bucket and are moved later
+	defer_archival = settings.S3_RAW_LOG_DEFERRED_ARCHIVAL
+	raw_upload.prepare_upload_event_log_location(
+		new_bucket, new_log_key, new_descriptor_key, defer=defer_archival
+	)
 
 	upload_metadata = descriptor["upload_metadata"]
 	gateway_headers = descriptor["gateway_headers"]
@@ -167,8 +174,8 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 	else:
 		logger.info("A User-Agent header was not provided.")
 
-	obj.file = new_log_key
-	obj.descriptor = new_descriptor_key
+	obj.file = raw_upload.upload_event_log_key
+	obj.descriptor = raw_upload.upload_event_descriptor_key
 	obj.upload_ip = descriptor["source_ip"]
 	obj.canary = "canary" in upload_metadata and upload_metadata["canary"]
 	obj.user_agent = gateway_headers.get("User-Agent", "")[:100]
@@ -230,6 +237,9 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 			logger.info("Exiting Without Processing - Unsupported Client")
 			return
 
+	# Imported here so that the stream fan-out handler does not load DRF
+	from hsreplaynet.api.serializers import UploadEventSerializer
+
 	serializer = UploadEventSerializer(obj, data=upload_metadata)
 	if serializer.is_valid():
 		logger.info("UploadEvent passed serializer validation")
@@ -237,7 +247,10 @@ def process_raw_upload(raw_upload, reprocess=False, log_group_name="", log_strea
 		serializer.save()
 
 		logger.info("Starting GameReplay processing for UploadEvent")
-		obj.process()
+		# Hand the log we already downloaded to the parser, rather than downloading it
+		# again from obj.file. The raw log may be deleted by now, so if the download
+		# failed, the parser reads obj.file instead.
+		obj.process(log_bytes=raw_upload.prefetched_log_bytes)
 	else:
 		obj.error = serializer.errors
 		logger.info("UploadEvent failed validation with errors: %r", obj.error)
@@ -0,0 +1,69 @@
+"""
+Caching for the scenario pages.
+
+Scenario data only changes when load_dbf imports a new build, so cache keys
+include a DBF version which load_dbf bumps. Computed scenario statistics
+are additionally keyed on the number of games played in the scenario,
+bucketed by settings.SCENARIO_CACHE_GAMES_THRESHOLD, so they are recomputed
+once enough new games have come in.
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+
+
+DBF_VERSION_CACHE_KEY = "scenarios:dbf_version"
+
+
+def get_dbf_version():
+	version = cache.get(DBF_VERSION_CACHE_KEY)
+	if version is None:
+		from .models import Scenario
+
+		build = Scenario.objects.aggregate(build=Max("build"))["build"] or 0
+		version = "%i" % (build)
+		cache.set(DBF_VERSION_CACHE_KEY, version, None)
+	return version
+
+
+def invalidate_scenario_cache(build):
+	"""
+	Invalidate all cached scenario data. Called by load_dbf.
+	"""
+	# Include the time, so reimporting the same build (--force) still invalidates
+	cache.set(DBF_VERSION_CACHE_KEY, "%i.%i" % (build, time.time()), None)
+
+
+def get_scenario_game_count(scenario_id):
+	"""
+	The number of games played in a scenario. Cached briefly, as this is
+	only used to decide when cached statistics are stale.
+	"""
+	from hsreplaynet.games.models import GlobalGame
+
+	cache_key = "scenarios:game_count:%s" % (scenario_id)
+	count = cache.get(cache_key)
+	if count is None:
+		count = GlobalGame.objects.filter(scenario_id=scenario_id).count()
+		cache.set(cache_key, count, settings.SCENARIO_GAME_COUNT_CACHE_SECONDS)
+	return count
+
+
+def cached_scenario_data(name, func, scenario_id=None):
+	"""
+	Return func(), cached under the current DBF version.
+	If a scenario_id is given, the cache also expires once enough new
+	games have been played in the scenario.
+	"""
+	cache_key = "scenarios:%s:%s" % (get_dbf_version(), name)
+	if scenario_id is not None:
+		games_count = get_scenario_game_count(scenario_id)
+		games_bucket = games_count // settings.SCENARIO_CACHE_GAMES_THRESHOLD
+		cache_key += ":%s:%i" % (scenario_id, games_bucket)
+
+	data = cache.get(cache_key)
+	if data is None:
+		data = func()
+		cache.set(cache_key, data, settings.SCENARIO_CACHE_SECONDS)
+	return data
@@ -2,7 +2,10 @@ import os
 from argparse import ArgumentTypeError
 from collections import OrderedDict
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 from hearthstone.dbf import Dbf
+from ...cache import invalidate_scenario_cache
 from ...models import Adventure, Scenario, Wing
 
 
@@ -25,6 +28,7 @@ class Command(BaseCommand):
 		parser.add_argument("--build", type=build_range, required=True)
 		parser.add_argument("--force", action="store_true")
 		parser.add_argument("--locale", default="enUS")
+		parser.add_argument("--batch-size", type=int, default=500)
 
 	def get_values(self, record, columns):
 		values = {"build": self.build}
@@ -51,22 +55,66 @@ class Command(BaseCommand):
 			return
 
 		cls = self.tables[dbf.name]
+		records = OrderedDict()
 		for record in dbf.records:
 			values = self.get_values(record, cls.dbf_columns)
-			try:
-				instance = cls.objects.get(id=record["ID"])
-			except cls.DoesNotExist:
-				instance = cls.objects.create(**values)
-				self.stdout.write("Created %r (build %r)" % (instance, self.build))
-			else:
-				if self.force or instance.build < self.build:
-					self.stdout.write("Updating %r to build %r" % (instance, self.build))
-					for k, v in values.items():
-						setattr(instance, k, v)
-					instance.save()
+			records[values["id"]] = values
+
+		with transaction.atomic():
+			created, updated, skipped = self.bulk_load(cls, records)
+
+		self.stdout.write("%s: %i created, %i updated, %i up to date (build %r)" % (
+			cls.__name__, created, updated, skipped, self.build
+		))
+
+	def bulk_load(self, cls, records):
+		"""
+		Create and update all the records of a table, diffing them against
+		the existing rows (fetched in a single query).
+		Returns a (created, updated, skipped) tuple of counts.
+		"""
+		existing = cls.objects.in_bulk()
+		now = timezone.now()
+
+		new_instances = []
+		changed = []
+		build_only = []
+		skipped = 0
+		for id, values in records.items():
+			instance = existing.get(id)
+			if instance is None:
+				new_instances.append(cls(**values))
+				if self.verbosity > 1:
+					self.stdout.write("Creating %r (build %r)" % (new_instances[-1], self.build))
+			elif self.force or instance.build < self.build:
+				changes = {
+					k: v for k, v in values.items() if k != "build" and getattr(instance, k) != v
+				}
+				if changes:
+					changed.append((id, changes))
 				else:
+					build_only.append(id)
+				if self.verbosity > 1:
+					self.stdout.write("Updating %r to build %r" % (instance, self.build))
+			else:
+				skipped += 1
+				if self.verbosity > 1:
 					self.stdout.write("Skipping %r (up to date)" % (instance))
 
+		cls.objects.bulk_create(new_instances, batch_size=self.batch_size)
+
+		# Django 1.10 has no bulk_update(), so rows with changed values are
+		# updated one query each; rows where only the build changed are
+		# updated together.
+		for id, changes in changed:
+			cls.objects.filter(id=id).update(build=self.build, updated=now, **changes)
+
+		for i in range(0, len(build_only), self.batch_size):
+			batch = build_only[i:i + self.batch_size]
+			cls.objects.filter(id__in=batch).update(build=self.build, updated=now)
+
+		return len(new_instances), len(changed) + len(build_only), skipped
+
 	def load_dbf_folder(self, path):
 		for dbf_name in self.tables:
 			filename = os.path.join(path, dbf_name + ".xml")
@@ -77,8 +125,12 @@ class Command(BaseCommand):
 		self.build = options["build"]
 		self.force = options["force"]
 		self.locale = options["locale"]
+		self.batch_size = options["batch_size"]
+		self.verbosity = options["verbosity"]
 
 		if os.path.isdir(path):
 			self.load_dbf_folder(path)
 		else:
 			self.load_dbf(path)
+
+		invalidate_scenario_cache(self.build)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BACKFILL_SCENARIO_AI_DECK_CARDS = """
+	INSERT INTO scenarios_scenarioaideckcard (scenario_id, card_id, count)
+	SELECT gg.scenario_id, ci.card_id, max(ci.count)
+	FROM games_globalgame gg
+	JOIN games_globalgameplayer gp ON gp.game_id = gg.id
+	JOIN cards_include ci ON ci.deck_id = gp.deck_list_id
+	WHERE gg.scenario_id IS NOT NULL
+	AND gp.is_ai = TRUE
+	GROUP BY gg.scenario_id, ci.card_id
+	ON CONFLICT DO NOTHING;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0004_deck_matchup_stats'),
+        ('games', '0013_recentdeckreplay'),
+        ('scenarios', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScenarioAIDeckCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scenario_id', models.IntegerField(db_index=True, help_text='ID from DBF/SCENARIO.xml or Scenario cache', verbose_name='Scenario ID')),
+                ('count', models.PositiveSmallIntegerField(default=0)),
+                ('card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cards.Card')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scenarioaideckcard',
+            unique_together=set([('scenario_id', 'card')]),
+        ),
+        migrations.RunSQL(
+            BACKFILL_SCENARIO_AI_DECK_CARDS,
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -1,9 +1,50 @@
-from collections import defaultdict
 from enum import IntEnum
-from django.db import models
+from django.db import connection, models
+from hsreplaynet.cards.models import Card, Deck
 from hsreplaynet.utils.fields import IntEnumField
 from hsreplaynet.games.models import GameReplay
-from hearthstone.enums import PlayState
+
+
+# Every won replay of a scenario with a complete deck, ranked by number of turns
+# within each deck. Returns (deck_id, num_wins, replay_id) rows, ordered by the
+# decks with the most wins first and then by fastest win.
+WINNING_DECKS_QUERY = """
+	WITH wins AS (
+		SELECT
+			r.id AS replay_id,
+			gp.deck_list_id,
+			gg.num_turns,
+			gg.match_start
+		FROM games_gamereplay r
+		JOIN games_globalgame gg ON gg.id = r.global_game_id
+		JOIN games_globalgameplayer gp
+			ON gp.game_id = gg.id AND gp.player_id = r.friendly_player_id
+		WHERE gg.scenario_id = %(scenario_id)s
+		AND gp.final_state = 4
+	), complete_decks AS (
+		SELECT ci.deck_id
+		FROM cards_include ci
+		WHERE ci.deck_id IN (SELECT deck_list_id FROM wins)
+		GROUP BY ci.deck_id
+		HAVING sum(ci.count) = 30
+	), ranked_wins AS (
+		SELECT
+			w.deck_list_id,
+			w.replay_id,
+			count(*) OVER (PARTITION BY w.deck_list_id) AS num_wins,
+			min(w.match_start) OVER (PARTITION BY w.deck_list_id) AS first_win,
+			row_number() OVER (
+				PARTITION BY w.deck_list_id
+				ORDER BY w.num_turns NULLS LAST, w.match_start, w.replay_id
+			) AS speed_rank
+		FROM wins w
+		JOIN complete_decks cd ON cd.deck_id = w.deck_list_id
+	)
+	SELECT deck_list_id, num_wins, replay_id
+	FROM ranked_wins
+	WHERE %(num_fastest_wins)s IS NULL OR speed_rank <= %(num_fastest_wins)s
+	ORDER BY num_wins DESC, first_win, deck_list_id, speed_rank
+"""
 
 
 class AdventureMode(IntEnum):
@@ -90,30 +131,19 @@ class Scenario(models.Model):
 	@staticmethod
 	def ai_deck_list(scenario_id):
 		""" Return the AIs card list as determined across all games played."""
-		deck = defaultdict(int)
-
-		# Only examine this many games to make it perform faster
-		sample_size = 20
-		replays = GameReplay.objects.filter(global_game__scenario_id=scenario_id)[:sample_size]
-		for replay in replays:
-			for include in replay.opposing_player.deck_list.includes.all():
-				card = include.card
-				current_count = deck[card]
-				if include.count > current_count:
-					deck[card] = include.count
-
-		alpha_sorted = sorted(deck.keys(), key=lambda c: c.name)
-		mana_sorted = sorted(alpha_sorted, key=lambda c: c.cost)
+		ai_cards = ScenarioAIDeckCard.objects.filter(scenario_id=scenario_id)
+		ai_cards = sorted(ai_cards.select_related("card"), key=lambda c: c.card.name)
+		mana_sorted = sorted(ai_cards, key=lambda c: c.card.cost)
 
 		result = []
-		for card in mana_sorted:
-			for i in range(0, deck[card]):
-				result.append(card)
+		for ai_card in mana_sorted:
+			for i in range(0, ai_card.count):
+				result.append(ai_card.card)
 
 		return result
 
 	@staticmethod
-	def winning_decks(scenario_id):
+	def winning_decks(scenario_id, num_fastest_wins=10):
 		""" Returns a list like:
 		[
 			{
@@ -133,47 +163,74 @@ class Scenario(models.Model):
 
 		The top level list elements are sorted by the deck with the most wins,
 		and the "fastest_wins" element is sorted in order of the wins which
-		took the least number of turns.
+		took the least number of turns (the earliest game first, for equal turns).
+		Only complete (30 card) decks are included, and at most
+		num_fastest_wins replays are returned per deck (all if None).
 		"""
-
-		complete_replays = []
-		for replay in GameReplay.objects.filter(global_game__scenario_id=scenario_id).all():
-			if replay.friendly_player.final_state == PlayState.WON:
-				if replay.friendly_player.deck_list.size() == 30:
-					complete_replays.append(replay)
-
-		all_decks = defaultdict(dict)
-
-		# Sort all the examples by match start so that the first example
-		# of a win is selected if there are many.
-		for replay in sorted(complete_replays, key=lambda r: r.global_game.match_start):
-
-			current_winning_deck = all_decks[replay.friendly_player.deck_list]
-			if "num_wins" in current_winning_deck:
-				current_winning_deck["num_wins"] += 1
-			else:
-				current_winning_deck["num_wins"] = 1
-
-			if "fastest_wins" in current_winning_deck:
-				fastest_wins = current_winning_deck["fastest_wins"]
-			else:
-				fastest_wins = defaultdict(list)
-				current_winning_deck["fastest_wins"] = fastest_wins
-
-			fastest_wins[replay.global_game.num_turns].append(replay)
+		cursor = connection.cursor()
+		cursor.execute(WINNING_DECKS_QUERY, {
+			"scenario_id": scenario_id,
+			"num_fastest_wins": num_fastest_wins,
+		})
+		rows = cursor.fetchall()
+
+		deck_ids = set(deck_id for deck_id, num_wins, replay_id in rows)
+		decks = Deck.objects.prefetch_related("includes__card").in_bulk(deck_ids)
+		replays = GameReplay.objects.select_related("global_game").in_bulk(
+			[replay_id for deck_id, num_wins, replay_id in rows]
+		)
 
 		result = []
+		for deck_id, num_wins, replay_id in rows:
+			if not result or result[-1]["deck"].id != deck_id:
+				result.append({
+					"deck": decks[deck_id],
+					"num_wins": num_wins,
+					"fastest_wins": [],
+				})
+			result[-1]["fastest_wins"].append(replays[replay_id])
 
-		for deck, meta in sorted(all_decks.items(), key=lambda t: t[1]["num_wins"], reverse=True):
-			current_result = {
-				"deck": deck,
-				"num_wins": meta["num_wins"],
-				"fastest_wins": []
-			}
+		return result
 
-			for turns, replays in sorted(meta["fastest_wins"].items(), key=lambda t: t[0]):
-				current_result["fastest_wins"].extend(replays)
 
-			result.append(current_result)
+class ScenarioAIDeckCardManager(models.Manager):
+	def update_from_deck(self, scenario_id, deck_id):
+		"""
+		Merge an AI deck seen in a game of the scenario into the scenario's AI deck,
+		keeping the highest count seen for each card.
+		"""
+		table = self.model._meta.db_table
+		# Rows are locked in card order, so that concurrent merges into the
+		# same scenario can't deadlock each other
+		with connection.cursor() as cursor:
+			cursor.execute("""
+				INSERT INTO %s (scenario_id, card_id, count)
+				SELECT %%s, ci.card_id, ci.count
+				FROM cards_include ci
+				WHERE ci.deck_id = %%s
+				ORDER BY ci.card_id
+				ON CONFLICT (scenario_id, card_id) DO UPDATE
+				SET count = EXCLUDED.count
+				WHERE %s.count < EXCLUDED.count
+			""" % (table, table), [scenario_id, deck_id])
+
+
+class ScenarioAIDeckCard(models.Model):
+	"""
+	The most copies of a card seen in the AI's deck across all games of a scenario.
+	Updated as games are processed, so the AI's full deck list is a single lookup.
+	"""
+	scenario_id = models.IntegerField(
+		"Scenario ID", db_index=True,
+		help_text="ID from DBF/SCENARIO.xml or Scenario cache",
+	)
+	card = models.ForeignKey(Card, on_delete=models.CASCADE, related_name="+")
+	count = models.PositiveSmallIntegerField(default=0)
+
+	objects = ScenarioAIDeckCardManager()
+
+	class Meta:
+		unique_together = ("scenario_id", "card")
 
-		return result
+	def __str__(self):
+		return "%s x %i" % (self.card, self.count)
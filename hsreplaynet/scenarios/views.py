@@ -1,12 +1,16 @@
+from django.http import Http404
 from django.shortcuts import render
 from django.views.generic import View
+from .cache import cached_scenario_data
 from .models import Scenario
 
 
 class ScenarioListView(View):
 	def get(self, request):
 		context = {
-			"scenarios": Scenario.objects.filter(adventure=10).all()
+			"scenarios": cached_scenario_data(
+				"list", lambda: list(Scenario.objects.filter(adventure=10).all())
+			)
 		}
 
 		return render(request, "scenarios/scenarios_list.html", context)
@@ -14,10 +18,22 @@ class ScenarioListView(View):
 
 class ScenarioDetailsView(View):
 	def get(self, request, scenario_id):
+		def get_scenario():
+			# Cache misses as False, so unknown ids are not looked up on every hit
+			return Scenario.objects.filter(pk=scenario_id).first() or False
+
+		scenario = cached_scenario_data("scenario:%s" % (scenario_id), get_scenario)
+		if not scenario:
+			raise Http404("No such scenario")
+
 		context = {
-			"scenario": Scenario.objects.get(pk=scenario_id),
-			"ai_deck_list": Scenario.ai_deck_list(scenario_id),
-			"winning_decks": Scenario.winning_decks(scenario_id)
+			"scenario": scenario,
+			"ai_deck_list": cached_scenario_data(
+				"ai_deck_list", lambda: Scenario.ai_deck_list(scenario_id), scenario_id
+			),
+			"winning_decks": cached_scenario_data(
+				"winning_decks", lambda: Scenario.winning_decks(scenario_id), scenario_id
+			),
 		}
 
 		return render(request, "scenarios/scenario_details.html", context)
@@ -24,6 +24,9 @@ ENV_DEV = not ENV_AWS or HOSTNAME == "dev.hsreplay.net"
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 BUILD_DIR = os.path.join(BASE_DIR, "build")
 
+# On-disk cache of the memory-mapped deck analytics matrices (cards.matrix)
+DECK_MATRIX_CACHE_DIR = os.path.join(BUILD_DIR, "deck_matrix")
+
 SITE_ID = 1
 ROOT_URLCONF = "hsreplaynet.urls"
 WSGI_APPLICATION = "wsgi.application"
@@ -42,16 +45,11 @@ else:
 INSTALLED_APPS_CORE = [
 	"django.contrib.auth",
 	"django.contrib.contenttypes",
-	"django.contrib.sessions",
-	"django.contrib.messages",
-	"django.contrib.staticfiles",
-	"django.contrib.sites",
 	"raven.contrib.django.raven_compat",
 	"rest_framework",
 	"hsreplaynet.accounts",
 	"hsreplaynet.api",
 	"hsreplaynet.cards",
-	"hsreplaynet.features",
 	"hsreplaynet.games",
 	"hsreplaynet.lambdas",
 	"hsreplaynet.scenarios",
@@ -60,7 +58,12 @@ INSTALLED_APPS_CORE = [
 ]
 
 # The following apps are not needed on Lambda
+# (the fewer apps, the less is imported by django.setup() on a cold start)
 INSTALLED_APPS_WEB = [
+	"django.contrib.sessions",
+	"django.contrib.messages",
+	"django.contrib.staticfiles",
+	"django.contrib.sites",
 	"django.contrib.admin",
 	"django.contrib.flatpages",
 	"django.contrib.humanize",
@@ -74,10 +77,12 @@ INSTALLED_APPS_WEB = [
 	"loginas",
 	"webpack_loader",
 	"hsreplaynet.admin",
+	"hsreplaynet.features",
 	"hsreplaynet.packs",
 ]
 
-INSTALLED_APPS = INSTALLED_APPS_CORE
+# A copy, so that adding apps doesn't change INSTALLED_APPS_CORE
+INSTALLED_APPS = list(INSTALLED_APPS_CORE)
 if not ENV_LAMBDA:
 	INSTALLED_APPS += INSTALLED_APPS_WEB
 
@@ -93,6 +98,7 @@ MIDDLEWARE_CLASSES = [
 	"django.middleware.gzip.GZipMiddleware",
 	"hsreplaynet.utils.middleware.DoNotTrackMiddleware",
 	"hsreplaynet.utils.middleware.SetRemoteAddrFromForwardedFor",
+	"hsreplaynet.utils.middleware.ReplicaPinningMiddleware",
 ]
 
 
@@ -268,10 +274,53 @@ KINESIS_UPLOAD_PROCESSING_STREAM_MAX_SHARDS = 256
 # The target maximum seconds it should take for kinesis to process a backlog of raw uploads
 # This value is used to periodically dynamically resize the stream capacity
 KINESIS_STREAM_PROCESSING_THROUGHPUT_SLA_SECONDS = 600
+# Predictive resizing (utils.aws.autoscaling) forecasts the upload rate from this
+# many weeks of uploads, and sizes the stream for the peak of the next hours.
+KINESIS_AUTOSCALING_HISTORY_WEEKS = 4
+KINESIS_AUTOSCALING_LOOKAHEAD_HOURS = 2
+# Assumed upload processing duration when there are no recent measurements (see utils.latency)
+UPLOAD_PROCESSING_SECONDS_DEFAULT = 5.0
 
 LAMBDA_DEFAULT_EXECUTION_ROLE_NAME = "iam_lambda_execution_role"
+# Keep DB connections open across warm Lambda invocations (see utils.instrumentation)
+LAMBDA_PERSISTENT_DB_CONNECTIONS = True
+# Connections are closed once they are this old, and checked before reuse once idle this long
+LAMBDA_DB_CONNECTION_MAX_AGE = 15 * 60
+LAMBDA_DB_CONNECTION_CHECK_IDLE_SECONDS = 30
 # Orphan descriptor.json files created this many days previously will be automatically reaped.
 LAMBDA_ORPHAN_REAPING_DELAY_DAYS = 3
+# The number of hours of the day reaped in parallel.
+LAMBDA_ORPHAN_REAPING_WORKERS = 8
+
+# When True, uploads are parsed directly from the raw bucket and the copy to the permanent
+# uploads/ location is left to the archive_processed_raw_uploads_handler cron.
+S3_RAW_LOG_DEFERRED_ARCHIVAL = False
+# Raw uploads are only archived once they are this old, to stay clear of in-flight lambdas.
+S3_RAW_LOG_ARCHIVAL_DELAY_MINUTES = 15
+
+# When True, canary upload events publish their final status over Postgres NOTIFY,
+# which promote_processing_lambda listens to in order to evaluate the canary.
+UPLOAD_EVENT_STATUS_NOTIFICATIONS = True
+
+# The number of recent public replays indexed per deck for related replay recommendations
+RECENT_DECK_REPLAYS_PER_DECK = 20
+# How long the related replays of a replay are cached for
+RELATED_REPLAYS_CACHE_SECONDS = 60 * 60
+# Scenario pages are cached per DBF build (see scenarios.cache) for this long
+SCENARIO_CACHE_SECONDS = 24 * 60 * 60
+# Computed scenario statistics are refreshed after this many new games in the scenario
+SCENARIO_CACHE_GAMES_THRESHOLD = 100
+SCENARIO_GAME_COUNT_CACHE_SECONDS = 5 * 60
+
+# Reads go to the primary for this long after a write (see utils.routers)
+DB_PRIMARY_PIN_SECONDS = 5
+# Read replicas lagging behind the primary by more than this are skipped
+DB_REPLICA_MAX_LAG_SECONDS = 10
+# How often each process measures the lag of the read replicas
+DB_REPLICA_LAG_CHECK_SECONDS = 5
+
+# How long each process keeps its snapshot of the Feature table (see features.cache)
+FEATURE_CACHE_SECONDS = 30
 
 JOUST_STATIC_URL = "https://joust.hearthsim.net/branches/master/"
 HEARTHSTONEJSON_URL = "https://api.hearthstonejson.com/v1/%(build)s/%(locale)s/cards.json"
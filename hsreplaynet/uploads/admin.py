@@ -1,7 +1,9 @@
 from django.contrib import admin
 from hsreplaynet.utils.admin import admin_urlify as urlify
 from .models import UploadEvent
-from .processing import queue_upload_events_for_reprocessing
+from .processing import (
+	queue_upload_events_for_reprocessing, queue_upload_events_for_reprocessing_async
+)
 
 
 def queue_for_reprocessing(admin, request, queryset):
@@ -9,16 +11,28 @@ def queue_for_reprocessing(admin, request, queryset):
 queue_for_reprocessing.short_description = "Queue for reprocessing"
 
 
+def queue_for_reprocessing_in_background(admin, request, queryset):
+	job = queue_upload_events_for_reprocessing_async(queryset)
+	admin.message_user(
+		request,
+		"Reprocessing job %s queued. Check its progress with "
+		"`manage.py show_reprocessing_progress %s`." % (job.id, job.id)
+	)
+queue_for_reprocessing_in_background.short_description = (
+	"Queue for reprocessing (background job)"
+)
+
+
 @admin.register(UploadEvent)
 class UploadEventAdmin(admin.ModelAdmin):
-	actions = (queue_for_reprocessing, )
+	actions = (queue_for_reprocessing, queue_for_reprocessing_in_background)
 	list_display = (
 		"__str__", "status", "tainted", urlify("token"),
 		urlify("game"), "upload_ip", "created", "file", "user_agent"
 	)
 	list_filter = ("status", "tainted", "canary")
 	raw_id_fields = ("token", "game")
-	readonly_fields = ("created", "cloudwatch_url")
+	readonly_fields = ("created", "log_url", "cloudwatch_url")
 	search_fields = ("shortid", )
 	show_full_result_count = False
 
@@ -0,0 +1,210 @@
+"""
+Canary evaluation for the upload processing Lambda.
+
+Canary upload events publish their final status on the
+UPLOAD_EVENT_STATUS_CHANNEL Postgres channel as they are saved (see
+models.notify_upload_event_status), so a deploy follows the canary uploads as
+they complete rather than polling the database. PROD uploads don't notify, to
+keep the processing path free of the extra query; their recent history is
+read from the database once as the baseline.
+
+CanaryEvaluator compares two rates between the canary and PROD uploads: the
+failure rate, and the fraction of successful uploads slower than a multiple of
+the PROD p90 latency. Each difference gets an Agresti-Caffo confidence
+interval. The canary is rolled back as soon as either rate is significantly
+higher than PROD's, and promoted as soon as both are significantly within
+`margin` of PROD's. The decision is re-evaluated on every completion, so the
+default z score is stricter than usual to make up for the repeated looks.
+
+If time runs out first, any failed canary upload causes a rollback.
+"""
+import json
+import select
+from calendar import timegm
+from math import sqrt
+from django.db import connection
+from hsreplaynet.utils.latency import LatencyHistogram
+from .models import UPLOAD_EVENT_STATUS_CHANNEL, UploadEventStatus
+
+
+PROMOTE = "promote"
+ROLLBACK = "rollback"
+
+ACCEPTABLE_STATUSES = (
+	UploadEventStatus.SUCCESS,
+	UploadEventStatus.UNSUPPORTED_CLIENT,
+	UploadEventStatus.UNSUPPORTED,
+)
+
+
+def proportion_difference_interval(x1, n1, x2, n2, z):
+	"""
+	Return the Agresti-Caffo interval of p1 - p2, for `x1` out of `n1`
+	and `x2` out of `n2`. Unlike the plain Wald interval, it stays sensible
+	with few samples or rates of zero.
+	"""
+	p1 = (x1 + 1.0) / (n1 + 2)
+	p2 = (x2 + 1.0) / (n2 + 2)
+	se = sqrt(p1 * (1 - p1) / (n1 + 2) + p2 * (1 - p2) / (n2 + 2))
+	return p1 - p2 - z * se, p1 - p2 + z * se
+
+
+class CanaryEvaluator(object):
+	"""
+	Decides whether to promote or roll back the canary version.
+
+	- canary_start: canary uploads created before this (unix time) were
+	  processed by the previous version and are ignored
+	- min_canary_uploads: the canary uploads needed to promote
+	- margin: how much higher than PROD's the canary rates may be
+	- max_latency_ratio: canary uploads slower than this multiple of the PROD
+	  p90 count as slow (0 disables the latency comparison)
+	- z: the z score of the confidence intervals
+	"""
+	def __init__(
+		self, canary_start, min_canary_uploads=10, margin=.05, max_latency_ratio=2.0, z=2.58
+	):
+		self.canary_start = canary_start
+		self.min_canary_uploads = min_canary_uploads
+		self.margin = margin
+		self.max_latency_ratio = max_latency_ratio
+		self.z = z
+		# {canary: {shortid: (status, seconds)}}
+		self.uploads = {True: {}, False: {}}
+
+	def add(self, shortid, canary, status, created, seconds):
+		if canary and created < self.canary_start:
+			return
+		self.uploads[bool(canary)][shortid] = (status, seconds)
+
+	def load(self, upload_events):
+		"""
+		Add the completed uploads of the `upload_events` queryset.
+		"""
+		fields = ("shortid", "canary", "status", "created", "updated")
+		for shortid, canary, status, created, updated in upload_events.values_list(*fields):
+			seconds = (updated - created).total_seconds()
+			self.add(shortid, canary, status, timegm(created.utctimetuple()), seconds)
+
+	@property
+	def canary_count(self):
+		return len(self.uploads[True])
+
+	def get_prod_p90(self):
+		histogram = LatencyHistogram()
+		for status, seconds in self.uploads[False].values():
+			if status == UploadEventStatus.SUCCESS:
+				histogram.add(seconds)
+		return histogram.percentile(90)
+
+	def compare(self):
+		"""
+		Return {name: (canary count, canary total, prod count, prod total)}
+		for the failures and, if enabled, the slow uploads.
+		"""
+		ret = {}
+		totals = {}
+		for canary, uploads in self.uploads.items():
+			failures = [s for s, seconds in uploads.values() if s not in ACCEPTABLE_STATUSES]
+			totals[canary] = (len(failures), len(uploads))
+		ret["failures"] = totals[True] + totals[False]
+
+		prod_p90 = self.get_prod_p90()
+		if self.max_latency_ratio and prod_p90:
+			threshold = prod_p90 * self.max_latency_ratio
+			for canary, uploads in self.uploads.items():
+				latencies = [
+					seconds for s, seconds in uploads.values() if s == UploadEventStatus.SUCCESS
+				]
+				totals[canary] = (len([s for s in latencies if s > threshold]), len(latencies))
+			ret["slow uploads"] = totals[True] + totals[False]
+
+		return ret
+
+	def summary(self):
+		ret = ["%i canary uploads" % (self.canary_count)]
+		for name, (x1, n1, x2, n2) in sorted(self.compare().items()):
+			ret.append("%s: CANARY %i/%i, PROD %i/%i" % (name, x1, n1, x2, n2))
+		return ", ".join(ret)
+
+	def decide(self, final=False):
+		"""
+		Return (PROMOTE or ROLLBACK, reason), or (None, None) while undecided.
+		With `final`, a decision is made even without a significant result:
+		the canary is only promoted if none of its uploads failed, and its
+		fraction of slow uploads is within `margin` of PROD's.
+		"""
+		comparisons = self.compare()
+		for name, (x1, n1, x2, n2) in sorted(comparisons.items()):
+			if not n1:
+				continue
+			low, high = proportion_difference_interval(x1, n1, x2, n2, self.z)
+			if low > 0:
+				return ROLLBACK, "The canary has significantly more %s (%i/%i vs %i/%i)" % (
+					name, x1, n1, x2, n2
+				)
+
+		if self.canary_count < self.min_canary_uploads:
+			if final:
+				return ROLLBACK, "Waited too long for canary events."
+			return None, None
+
+		within_margin = True
+		for name, (x1, n1, x2, n2) in comparisons.items():
+			if n1:
+				low, high = proportion_difference_interval(x1, n1, x2, n2, self.z)
+				within_margin = within_margin and high < self.margin
+
+		if within_margin:
+			return PROMOTE, "The canary is within the margin (%s)" % (self.summary())
+
+		if not final:
+			return None, None
+
+		x1, n1, x2, n2 = comparisons["failures"]
+		if x1:
+			return ROLLBACK, "%i of %i canary uploads failed (%i/%i in PROD)" % (x1, n1, x2, n2)
+
+		if "slow uploads" in comparisons:
+			x1, n1, x2, n2 = comparisons["slow uploads"]
+			prod_rate = float(x2) / n2 if n2 else 0.0
+			if n1 and float(x1) / n1 - prod_rate >= self.margin:
+				return ROLLBACK, "The canary has more slow uploads (%i/%i vs %i/%i)" % (
+					x1, n1, x2, n2
+				)
+
+		return PROMOTE, "No canary uploads failed (%s)" % (self.summary())
+
+
+class UploadEventListener(object):
+	"""
+	Receives the canary upload event statuses published on UPLOAD_EVENT_STATUS_CHANNEL.
+	Only available on Postgres; see is_supported().
+	"""
+	def __init__(self):
+		connection.ensure_connection()
+		self.connection = connection.connection
+		with connection.cursor() as cursor:
+			cursor.execute("LISTEN %s" % (UPLOAD_EVENT_STATUS_CHANNEL))
+
+	@staticmethod
+	def is_supported():
+		return connection.vendor == "postgresql"
+
+	def wait(self, timeout):
+		"""
+		Return the statuses received, waiting up to `timeout` seconds for one.
+		"""
+		if not self.connection.notifies:
+			if select.select([self.connection], [], [], timeout) == ([], [], []):
+				return []
+			self.connection.poll()
+
+		ret = []
+		while self.connection.notifies:
+			ret.append(json.loads(self.connection.notifies.pop(0).payload))
+		return ret
+
+	def close(self):
+		with connection.cursor() as cursor:
+			cursor.execute("UNLISTEN %s" % (UPLOAD_EVENT_STATUS_CHANNEL))
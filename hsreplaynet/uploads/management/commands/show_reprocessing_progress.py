@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from hsreplaynet.utils.redis import job_queue
+
+
+class Command(BaseCommand):
+	help = "Show the progress of a background UploadEvent reprocessing job."
+
+	def add_arguments(self, parser):
+		parser.add_argument("job_id", help="The RQ job id reported by the admin")
+
+	def handle(self, *args, **options):
+		try:
+			job = Job.fetch(options["job_id"], connection=job_queue.connection)
+		except NoSuchJobError:
+			raise CommandError("No such job: %r" % (options["job_id"]))
+
+		self.stdout.write("Status: %s" % (job.get_status()))
+
+		progress = job.meta.get("progress")
+		if not progress:
+			self.stdout.write("The job has not started yet.")
+			return
+
+		self.stdout.write("Progress: %i/%i" % (progress["done"], progress["total"]))
+		self.stdout.write("Rate: %s UploadEvents per second" % (progress["rate"]))
+		if progress["eta_seconds"] is not None:
+			self.stdout.write("ETA: %i seconds" % (progress["eta_seconds"]))
@@ -17,6 +17,9 @@ class Command(BaseCommand):
 		uploads = list(UploadEvent.objects.all())
 		self.stdout.write("Found %i UploadEvents" % (len(uploads)))
 		for upload in uploads:
+			if upload.is_awaiting_archival:
+				# In the raw uploads bucket, until archive_processed_raw_uploads moves it
+				continue
 			old_path = upload.file.name
 			new_path = upload_event_path(upload, old_path)
 			self._update_path(upload, old_path, new_path, field="file")
@@ -3,9 +3,11 @@ import re
 import json
 import base64
 import os
+from calendar import timegm
 from datetime import datetime, timedelta
+from threading import Thread
 from django.conf import settings
-from django.db import models
+from django.db import connections, models
 from django.dispatch.dispatcher import receiver
 from django.urls import reverse
 from hsreplaynet.utils.fields import IntEnumField, ShortUUIDField
@@ -47,7 +49,7 @@ class RawUpload(object):
 	HAS_UPLOAD_KEY_PATTERN = r"uploads/(?P<ts>[\d/]{16})/(?P<shortid>\w{22})\.power.log"
 	TIMESTAMP_FORMAT = "%Y/%m/%d/%H/%M"
 
-	def __init__(self, bucket, key):
+	def __init__(self, bucket, key, upload_event=None):
 		self.bucket = bucket
 		self._log_key = key
 		self._upload_event = None
@@ -76,7 +78,10 @@ class RawUpload(object):
 			self._shortid = fields["shortid"]
 			self._timestamp = datetime.strptime(fields["ts"], RawUpload.TIMESTAMP_FORMAT)
 
-			self._upload_event = UploadEvent.objects.get(shortid=self._shortid)
+			if upload_event is not None:
+				self._upload_event = upload_event
+			else:
+				self._upload_event = UploadEvent.objects.get(shortid=self._shortid)
 			self._descriptor_key = str(self._upload_event.descriptor)
 
 		else:
@@ -86,9 +91,12 @@ class RawUpload(object):
 		self._upload_event_log_key = None
 		self._upload_event_descriptor_key = None
 		self._upload_event_location_populated = False
+		self._archival_deferred = False
 
-		# These are loaded lazily from S3
+		# These are loaded lazily from S3, or concurrently by prefetch()
 		self._descriptor = None
+		self._log_bytes = None
+		self._prefetch_threads = {}
 
 		# If this is changed to True before this RawUpload is sent to a kinesis stream
 		# Then the kinesis lambda will attempt to reprocess instead of exiting early
@@ -100,11 +108,24 @@ class RawUpload(object):
 	def _create_raw_descriptor_key(self, ts_string, shortid):
 		return "raw/%s/%s.descriptor.json" % (ts_string, shortid)
 
-	def prepare_upload_event_log_location(self, bucket, key, descriptor):
+	def prepare_upload_event_log_location(self, bucket, key, descriptor, defer=False):
 		self._upload_event_log_bucket = bucket
 		self._upload_event_log_key = key
 		self._upload_event_descriptor_key = descriptor
 
+		if defer:
+			# The log will be parsed straight from the raw bucket. The archival cron
+			# copies the files to their final location, points the UploadEvent at
+			# them and deletes the raw objects. Until then, the UploadEvent points
+			# at the raw objects (see UploadEvent.is_awaiting_archival).
+			log.info("%r: Deferring archival to %r:%r" % (self, bucket, key))
+			self._upload_event_log_bucket = self.bucket
+			self._upload_event_log_key = self.log_key
+			self._upload_event_descriptor_key = self.descriptor_key
+			self._archival_deferred = True
+			self._upload_event_location_populated = True
+			return
+
 		if key != self.log_key:
 			copy_source = "%s/%s" % (self.bucket, self.log_key)
 			log.info("%r: Copying power.log %r to %r:%r" % (self, copy_source, bucket, key))
@@ -120,6 +141,10 @@ class RawUpload(object):
 	def delete(self):
 		# We only perform delete on NEW raw uploads because when we get to this point we have
 		# a copy of the log and descriptor attached to the UploadEvent
+		if self._archival_deferred:
+			log.info("Archival is deferred, leaving files in S3")
+			return
+
 		if self.state == RawUploadState.NEW:
 			log.info("Deleting files from S3")
 			aws.S3.delete_object(Bucket=self.bucket, Key=self.log_key)
@@ -132,12 +157,23 @@ class RawUpload(object):
 
 		return RawUpload(bucket, key)
 
+	@property
+	def upload_event_log_key(self):
+		return self._upload_event_log_key
+
+	@property
+	def upload_event_descriptor_key(self):
+		return self._upload_event_descriptor_key
+
 	@staticmethod
 	def from_upload_event(event):
-		bucket = settings.AWS_STORAGE_BUCKET_NAME
+		if event.is_awaiting_archival:
+			bucket = settings.S3_RAW_LOG_UPLOAD_BUCKET
+		else:
+			bucket = settings.AWS_STORAGE_BUCKET_NAME
 		log_key = str(event.file)
 
-		return RawUpload(bucket, log_key)
+		return RawUpload(bucket, log_key, upload_event=event)
 
 	@staticmethod
 	def from_kinesis_event(kinesis_event):
@@ -193,11 +229,66 @@ class RawUpload(object):
 
 	@property
 	def descriptor(self):
+		self._wait_for_prefetch("descriptor")
 		if self._descriptor is None:
-			self._descriptor = self._get_object(self._descriptor_key)
+			self._fetch_descriptor()
 
 		return self._descriptor
 
+	@property
+	def log_bytes(self):
+		self._wait_for_prefetch("log")
+		if self._log_bytes is None:
+			self._fetch_log_bytes()
+
+		return self._log_bytes
+
+	@property
+	def prefetched_log_bytes(self):
+		"""
+		The log downloaded by prefetch(), or None if the download failed.
+		Unlike log_bytes, it doesn't download the log again, for callers which
+		may have deleted it since.
+		"""
+		self._wait_for_prefetch("log")
+		return self._log_bytes
+
+	def prefetch(self):
+		"""
+		Start downloading the descriptor and the log at the same time.
+
+		The descriptor and log_bytes properties each wait for their own download
+		to finish. If it failed, they retry it synchronously on access, which
+		only works as long as the raw upload has not been deleted.
+		"""
+		if self._prefetch_threads:
+			return
+
+		self._prefetch_threads = {
+			"descriptor": Thread(target=self._prefetch, args=(self._fetch_descriptor, )),
+			"log": Thread(target=self._prefetch, args=(self._fetch_log_bytes, )),
+		}
+		for thread in self._prefetch_threads.values():
+			thread.daemon = True
+			thread.start()
+
+	def _prefetch(self, fetch):
+		try:
+			fetch()
+		except Exception as e:
+			log.warning("%r: Prefetching failed: %r" % (self, e))
+
+	def _wait_for_prefetch(self, name):
+		if name in self._prefetch_threads:
+			self._prefetch_threads[name].join()
+
+	def _fetch_descriptor(self):
+		self._descriptor = self._get_object(self._descriptor_key)
+
+	def _fetch_log_bytes(self):
+		obj = aws.S3.get_object(Bucket=self.bucket, Key=self.log_key)
+		self._log_bytes = obj["Body"].read()
+
 	def _get_object(self, key):
 		obj = aws.S3.get_object(Bucket=self.bucket, Key=key)
 		return json.loads(obj["Body"].read().decode("utf8"))
@@ -235,6 +326,15 @@ def _generate_upload_key(ts, shortid, suffix="power.log"):
 	return "uploads/%s/%s.%s" % (timestamp, shortid, suffix)
 
 
+def is_raw_upload_key(name):
+	"""
+	True if `name` is a key of the raw uploads bucket rather than a file of the
+	default storage, as is the case for the files of UploadEvents whose archival
+	was deferred.
+	"""
+	return str(name).startswith("raw/")
+
+
 class UploadEvent(models.Model):
 	"""
 	Represents a game upload, before the creation of the game itself.
@@ -276,6 +376,22 @@ class UploadEvent(models.Model):
 	def __str__(self):
 		return self.shortid
 
+	@property
+	def is_awaiting_archival(self):
+		"""
+		True if archival was deferred and the files are still in the raw uploads
+		bucket, rather than in the default storage.
+		"""
+		return is_raw_upload_key(self.file)
+
+	@property
+	def log_url(self):
+		if self.is_awaiting_archival:
+			return RawUpload.from_upload_event(self).log_url
+		if self.file:
+			return self.file.url
+		return ""
+
 	@property
 	def cloudwatch_url(self):
 		baseurl = "https://console.aws.amazon.com/cloudwatch/home"
@@ -297,10 +413,12 @@ class UploadEvent(models.Model):
 	def get_absolute_url(self):
 		return reverse("upload_detail", kwargs={"shortid": self.shortid})
 
-	def process(self):
+	def process(self, log_bytes=None):
 		from hsreplaynet.games.processing import process_upload_event
 
-		process_upload_event(self)
+		if log_bytes is None and self.is_awaiting_archival:
+			log_bytes = RawUpload.from_upload_event(self).log_bytes
+		process_upload_event(self, log_bytes)
 
 
 @receiver(models.signals.post_delete, sender=UploadEvent)
@@ -314,3 +432,37 @@ def cleanup_uploaded_log_file(sender, instance, **kwargs):
 	descriptor = instance.descriptor
 	if descriptor.name:
 		delete_file_async(descriptor.name)
+
+
+# Postgres channel on which the final status of upload events is published
+UPLOAD_EVENT_STATUS_CHANNEL = "upload_event_status"
+
+
+@receiver(models.signals.post_save, sender=UploadEvent)
+def notify_upload_event_status(sender, instance, using, **kwargs):
+	"""
+	Publish the status of canary upload events which are done processing, for
+	promote_processing_lambda to evaluate the canary (see uploads.canary).
+	Other upload events don't notify, so that they don't pay for the query.
+	NOTIFY is transactional: nothing is sent if the save is rolled back.
+	"""
+	if not instance.canary or not settings.UPLOAD_EVENT_STATUS_NOTIFICATIONS:
+		return
+
+	status = instance.status
+	if status in UploadEventStatus.processing_statuses() + [UploadEventStatus.UNKNOWN]:
+		return
+
+	connection = connections[using]
+	if connection.vendor != "postgresql":
+		return
+
+	payload = json.dumps({
+		"shortid": instance.shortid,
+		"canary": instance.canary,
+		"status": int(status),
+		"created": timegm(instance.created.utctimetuple()),
+		"seconds": (instance.updated - instance.created).total_seconds(),
+	})
+	with connection.cursor() as cursor:
+		cursor.execute("SELECT pg_notify(%s, %s)", [UPLOAD_EVENT_STATUS_CHANNEL, payload])
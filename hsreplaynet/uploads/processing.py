@@ -2,13 +2,18 @@
 A module for scheduling UploadEvents to be processed or reprocessed.
 """
 import logging
+import time
 from django.conf import settings
-from hsreplaynet.uploads.models import RawUpload
+from hsreplaynet.uploads.models import RawUpload, UploadEvent
 from hsreplaynet.utils import aws
 
 
 logger = logging.getLogger(__file__)
 
+REPROCESSING_CHUNK_SIZE = 500
+# Background reprocessing jobs can take hours for very large selections
+REPROCESSING_JOB_TIMEOUT = 60 * 60 * 12
+
 
 def queue_raw_uploads_for_processing(attempt_reprocessing, limit=None):
 	"""
@@ -84,3 +89,117 @@ def queue_upload_event_for_reprocessing(event):
 	else:
 		logger.info("Processing UploadEvent %r locally", event)
 		event.process()
+
+
+def queue_upload_events_for_reprocessing_async(queryset, use_kinesis=False):
+	"""
+	Enqueue a RQ job which requeues every UploadEvent in the queryset.
+
+	Returns the RQ job. Its progress is available in job.meta["progress"].
+	"""
+	from hsreplaynet.utils.redis import job_queue
+
+	# Pickling a QuerySet evaluates it, so we only send the query to the worker
+	return job_queue.enqueue(
+		reprocess_upload_events_job, queryset.query, use_kinesis,
+		timeout=REPROCESSING_JOB_TIMEOUT
+	)
+
+
+def reprocess_upload_events_job(
+	query, use_kinesis=False, chunk_size=REPROCESSING_CHUNK_SIZE
+):
+	"""
+	RQ job which walks the UploadEvents matched by the query in chunks
+	and queues each chunk for reprocessing.
+	"""
+	from rq import get_current_job
+
+	queryset = UploadEvent.objects.all()
+	queryset.query = query
+	use_kinesis = settings.ENV_AWS or use_kinesis
+
+	progress = ReprocessingProgress(get_current_job(), queryset.count())
+	logger.info("Reprocessing %i UploadEvents", progress.total)
+
+	if use_kinesis:
+		from hsreplaynet.utils.aws.streams import get_target_writes_per_second
+		stream_name = settings.KINESIS_UPLOAD_PROCESSING_STREAM_NAME
+		target_writes_per_second = get_target_writes_per_second(stream_name)
+
+	for events in iterate_upload_events_in_chunks(queryset, chunk_size):
+		start_time = time.time()
+		if use_kinesis:
+			raw_uploads = list(_generate_raw_uploads_from_events(events))
+			aws.publish_raw_uploads_to_processing_stream(raw_uploads)
+
+			# Stay within the write throughput the stream supports
+			sleep_duration = (len(events) / target_writes_per_second) - (time.time() - start_time)
+			if sleep_duration > 0:
+				time.sleep(sleep_duration)
+		else:
+			queue_upload_events_for_reprocessing(events)
+
+		progress.update(len(events))
+		logger.info("Reprocessing progress: %s", progress)
+
+	return progress.done
+
+
+def iterate_upload_events_in_chunks(queryset, chunk_size):
+	"""
+	Yield lists of UploadEvents from the queryset, paginating on the primary key
+	so that memory use stays flat and late chunks are as fast as early ones.
+	"""
+	last_id = 0
+	while True:
+		chunk = list(queryset.filter(id__gt=last_id).order_by("id")[:chunk_size])
+		if not chunk:
+			return
+		yield chunk
+		last_id = chunk[-1].id
+
+
+class ReprocessingProgress(object):
+	"""
+	Tracks the progress of a reprocessing job and publishes it to the
+	RQ job's meta, so it can be inspected from outside the worker.
+	"""
+	def __init__(self, job, total):
+		self.job = job
+		self.total = total
+		self.done = 0
+		self.start_time = time.time()
+		self.save()
+
+	def __str__(self):
+		return "%i/%i (%.1f/s, ETA %s)" % (
+			self.done, self.total, self.rate, self.eta_seconds
+		)
+
+	@property
+	def rate(self):
+		elapsed = time.time() - self.start_time
+		return self.done / elapsed if elapsed else 0.0
+
+	@property
+	def eta_seconds(self):
+		if not self.rate:
+			return None
+		return int(max(0, self.total - self.done) / self.rate)
+
+	def update(self, count):
+		self.done += count
+		self.save()
+
+	def save(self):
+		if self.job is None:
+			return
+
+		self.job.meta["progress"] = {
+			"total": self.total,
+			"done": self.done,
+			"rate": round(self.rate, 1),
+			"eta_seconds": self.eta_seconds,
+		}
+		self.job.save()
@@ -1,7 +1,9 @@
 import datetime
 import logging
+import threading
+from contextlib import contextmanager
 from dateutil.relativedelta import relativedelta
-from uuid import UUID
+from uuid import UUID, uuid4
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from . import checks  # noqa (needed to register the checks)
@@ -16,6 +18,12 @@ def get_logger(name="hsreplaynet", level=logging.DEBUG):
 log = get_logger()
 
 
+# The maximum number of files deleted by a single delete_files job
+DELETE_FILES_BATCH_SIZE = 1000
+
+_file_deletion = threading.local()
+
+
 def delete_file(name):
 	"""
 	Delete a file by name from the default storage
@@ -25,12 +33,78 @@ def delete_file(name):
 		default_storage.delete(name)
 
 
-def delete_file_async(name):
+def delete_files(names):
 	"""
-	Enqueue a RQ job to delete a file by name from the default storage
+	Delete files by name from the default storage.
+	Missing files are ignored, so this is safe to run more than once.
+
+	The raw upload keys of UploadEvents awaiting archival are deleted from
+	the raw uploads bucket instead.
+	"""
+	from django.conf import settings
+	from django.core.files.storage import default_storage
+	from hsreplaynet.uploads.models import is_raw_upload_key
+
+	raw_keys = [name for name in names if is_raw_upload_key(name)]
+	if raw_keys:
+		from hsreplaynet.utils.aws import delete_objects
+		delete_objects(settings.S3_RAW_LOG_UPLOAD_BUCKET, raw_keys)
+		names = [name for name in names if not is_raw_upload_key(name)]
+
+	if not names:
+		return
+	elif settings.AWS_STORAGE_BUCKET_NAME:
+		from hsreplaynet.utils.aws import delete_objects
+		delete_objects(settings.AWS_STORAGE_BUCKET_NAME, names)
+	else:
+		for name in names:
+			# FileSystemStorage.delete() ignores missing files
+			default_storage.delete(name)
+
+
+def delete_files_async(names):
+	"""
+	Enqueue RQ jobs to delete files by name from the default storage,
+	with up to DELETE_FILES_BATCH_SIZE files per job.
 	"""
 	from hsreplaynet.utils.redis import job_queue
-	job_queue.enqueue(delete_file, name)
+	names = list(names)
+	for i in range(0, len(names), DELETE_FILES_BATCH_SIZE):
+		job_queue.enqueue(delete_files, names[i:i + DELETE_FILES_BATCH_SIZE])
+
+
+def delete_file_async(name):
+	"""
+	Enqueue a RQ job to delete a file by name from the default storage.
+	Inside a batched_file_deletion() block, the deletion is deferred to the end of the block.
+	"""
+	pending = getattr(_file_deletion, "pending", None)
+	if pending is not None:
+		pending.append(name)
+	else:
+		delete_files_async([name])
+
+
+@contextmanager
+def batched_file_deletion():
+	"""
+	Collect the files deleted by delete_file_async() in the block (eg. from
+	post_delete signals) and delete them in bulk once the block succeeds.
+	If the block raises, the files are left alone.
+	"""
+	if getattr(_file_deletion, "pending", None) is not None:
+		# Nested blocks are flushed by the outermost one
+		yield
+		return
+
+	_file_deletion.pending = []
+	try:
+		yield
+		names = _file_deletion.pending
+	finally:
+		_file_deletion.pending = None
+
+	delete_files_async(names)
 
 
 def get_client_ip(request):
@@ -63,3 +137,24 @@ def get_uuid_object_or_404(cls, version=4, **kwargs):
 		except ValueError:
 			raise Http404
 	return get_object_or_404(cls, **kwargs)
+
+
+def iterate_server_side_cursor(query, params=None, itersize=10000):
+	"""
+	Run a query through a named (server-side) cursor and yield its rows,
+	fetching `itersize` rows from the database at a time.
+	"""
+	from django.db import connection, transaction
+
+	# Django 1.10 has no server-side cursor support, so use psycopg2 directly.
+	# Named cursors only live for the duration of a transaction.
+	with transaction.atomic():
+		connection.ensure_connection()
+		cursor = connection.connection.cursor(name="hsreplaynet_%s" % (uuid4().hex))
+		cursor.itersize = itersize
+		try:
+			cursor.execute(query, params)
+			for row in cursor:
+				yield row
+		finally:
+			cursor.close()
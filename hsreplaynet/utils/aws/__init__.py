@@ -1,7 +1,15 @@
+import time
 from django.conf import settings
+from hsreplaynet.utils import log
 from .clients import LAMBDA, KINESIS, S3
 
 
+# The maximum number of keys accepted by a single S3 delete_objects call
+S3_DELETE_OBJECTS_MAX_KEYS = 1000
+# The maximum number of records accepted by a single Kinesis put_records call
+KINESIS_PUT_RECORDS_MAX_RECORDS = 500
+
+
 def get_kinesis_stream_arn_from_name(name):
 	stream = KINESIS.describe_stream(
 		StreamName=name,
@@ -18,6 +26,42 @@ def publish_raw_upload_to_processing_stream(raw_upload):
 	)
 
 
+def publish_raw_uploads_to_processing_stream(raw_uploads, max_attempts=5):
+	"""
+	Publish raw uploads to the processing stream using as few put_records
+	calls as possible. Records rejected by Kinesis (eg. throttled) are retried.
+
+	Returns the number of records published.
+	"""
+	records = [{
+		"Data": raw_upload.kinesis_data,
+		"PartitionKey": raw_upload.kinesis_partition_key,
+	} for raw_upload in raw_uploads]
+
+	published_count = 0
+	for i in range(0, len(records), KINESIS_PUT_RECORDS_MAX_RECORDS):
+		batch = records[i:i + KINESIS_PUT_RECORDS_MAX_RECORDS]
+		attempts = 0
+		while batch:
+			attempts += 1
+			response = KINESIS.put_records(
+				StreamName=settings.KINESIS_UPLOAD_PROCESSING_STREAM_NAME,
+				Records=batch,
+			)
+			results = response["Records"]
+			failed = [r for r, result in zip(batch, results) if "ErrorCode" in result]
+			published_count += len(batch) - len(failed)
+			batch = failed
+
+			if batch:
+				if attempts >= max_attempts:
+					raise RuntimeError("Kinesis rejected %i records" % (len(batch)))
+				log.info("Kinesis rejected %i records, retrying", len(batch))
+				time.sleep(attempts)
+
+	return published_count
+
+
 def get_processing_stream_max_writes_per_second():
 	stream = KINESIS.describe_stream(
 		StreamName=settings.KINESIS_UPLOAD_PROCESSING_STREAM_NAME,
@@ -111,3 +155,41 @@ def list_all_objects_in(bucket, prefix=None):
 					ContinuationToken=list_response["NextContinuationToken"]
 				)
 				objects += list_response["Contents"]
+
+
+def delete_objects(bucket, keys):
+	"""
+	Delete an iterable of keys from the bucket, batching them into as few
+	delete_objects calls as possible. Deleting a missing key is not an error.
+
+	Returns the number of keys which were successfully deleted.
+	"""
+	deleted_count = 0
+	batch = []
+	for key in keys:
+		batch.append(key)
+		if len(batch) == S3_DELETE_OBJECTS_MAX_KEYS:
+			deleted_count += _delete_objects_batch(bucket, batch)
+			batch = []
+
+	if batch:
+		deleted_count += _delete_objects_batch(bucket, batch)
+
+	return deleted_count
+
+
+def _delete_objects_batch(bucket, keys):
+	response = S3.delete_objects(
+		Bucket=bucket,
+		Delete={
+			"Objects": [{"Key": k} for k in keys],
+			"Quiet": True,
+		}
+	)
+
+	# In quiet mode, only the keys which could not be deleted are returned
+	errors = response.get("Errors", [])
+	for error in errors:
+		log.error("Could not delete %r: %s", error["Key"], error["Message"])
+
+	return len(keys) - len(errors)
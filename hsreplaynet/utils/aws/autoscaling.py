@@ -0,0 +1,269 @@
+"""
+Predictive autoscaling for the upload processing stream.
+
+Uploads follow strong daily and weekly cycles, so the stream is sized for the
+upload rate forecast over the next hours rather than for the current backlog
+alone. The forecast is a seasonal profile (the upload counts at the same hour
+of the week over the past weeks, recent weeks weighing more) scaled by how the
+last few hours compare to it, which picks up growth and patch day spikes.
+
+To avoid thrashing between sizes, the stream scales up as soon as the
+forecast requires it, but only scales down once the smaller size would run
+below DOWNSCALE_HEADROOM of its capacity, and not within DOWNSCALE_COOLDOWN of
+the previous resize.
+
+simulate_autoscaling() replays historical upload counts offline to evaluate
+the SLA hits and cost of a strategy.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from math import ceil
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now
+from .streams import base_two_shard_target
+
+
+logger = logging.getLogger("hsreplaynet")
+
+LAST_RESIZE_CACHE_KEY = "upload_processing_stream:last_resize"
+
+UPLOAD_COUNTS_QUERY = """
+SELECT
+	floor(extract(epoch FROM created) / %(bucket_seconds)s) * %(bucket_seconds)s,
+	count(*)
+FROM uploads_uploadevent
+WHERE created >= %(start)s AND created < %(end)s
+GROUP BY 1
+"""
+
+
+def get_upload_counts(start, end, bucket_seconds=3600):
+	"""
+	Return {bucket start (unix time): number of UploadEvents created}
+	for the buckets between `start` and `end`. Empty buckets are left out.
+	"""
+	params = {"start": start, "end": end, "bucket_seconds": bucket_seconds}
+	with connection.cursor() as cursor:
+		cursor.execute(UPLOAD_COUNTS_QUERY, params)
+		return {int(bucket): count for bucket, count in cursor.fetchall()}
+
+
+def hour_start(timestamp):
+	return int(timestamp) // 3600 * 3600
+
+
+class UploadRateForecaster(object):
+	"""
+	Forecasts the hourly upload counts from `hourly_counts`
+	({hour start (unix time): count}, see get_upload_counts()).
+	"""
+	WEEK = 7 * 24 * 3600
+
+	def __init__(self, hourly_counts, weeks=4, decay=.5, level_hours=6, max_level=3.0):
+		self.hourly_counts = hourly_counts
+		self.weeks = weeks
+		self.decay = decay
+		self.level_hours = level_hours
+		self.max_level = max_level
+
+	def seasonal(self, hour, timestamp):
+		"""
+		The weighted mean of the counts at the same hour of the week, over the
+		weeks before `timestamp` (unix time). Returns None without history.
+		"""
+		total, weights = 0.0, 0.0
+		weight = 1.0
+		for week in range(1, self.weeks + 1):
+			past_hour = hour - week * self.WEEK
+			if past_hour >= timestamp:
+				continue
+			total += weight * self.hourly_counts.get(past_hour, 0)
+			weights += weight
+			weight *= self.decay
+		return total / weights if weights else None
+
+	def level(self, timestamp):
+		"""
+		How the last `level_hours` complete hours compare to their seasonal profile.
+		"""
+		current_hour = hour_start(timestamp)
+		actual, expected = 0.0, 0.0
+		for i in range(1, self.level_hours + 1):
+			hour = current_hour - i * 3600
+			seasonal = self.seasonal(hour, timestamp)
+			if seasonal is None:
+				return 1.0
+			actual += self.hourly_counts.get(hour, 0)
+			expected += seasonal
+		if not expected:
+			return 1.0
+		return min(self.max_level, max(1.0 / self.max_level, actual / expected))
+
+	def forecast(self, timestamp, hours):
+		"""
+		Return the forecast counts of the `hours` hours starting with the current one.
+		Without enough history, the count of the last complete hour is repeated.
+		"""
+		current_hour = hour_start(timestamp)
+		level = self.level(timestamp)
+		last_count = self.hourly_counts.get(current_hour - 3600, 0)
+
+		ret = []
+		for i in range(hours):
+			seasonal = self.seasonal(current_hour + i * 3600, timestamp)
+			ret.append(last_count if seasonal is None else seasonal * level)
+		return ret
+
+
+class StreamAutoscaler(object):
+	"""
+	Decides the number of shards of the upload processing stream.
+	"""
+	DOWNSCALE_HEADROOM = .75
+	DOWNSCALE_COOLDOWN = 3600
+
+	def __init__(
+		self, forecaster, sla_seconds, min_shards, max_shards,
+		lookahead_hours=2, last_resize=0
+	):
+		self.forecaster = forecaster
+		self.sla_seconds = sla_seconds
+		self.min_shards = min_shards
+		self.max_shards = max_shards
+		self.lookahead_hours = lookahead_hours
+		self.last_resize = last_resize
+
+	def required_shards(self, backlog, processing_duration, timestamp):
+		"""
+		The (fractional) number of shards needed to clear the backlog and
+		keep up with the peak forecast rate within the SLA.
+		"""
+		forecast = self.forecaster.forecast(timestamp, self.lookahead_hours)
+		peak_rate = max(forecast) / 3600.0
+		per_shard = self.sla_seconds / max(processing_duration, .001)
+		return (backlog + peak_rate * self.sla_seconds) / per_shard
+
+	def _clamp(self, shards):
+		return int(min(self.max_shards, max(self.min_shards, shards)))
+
+	def target_shards(self, current_shards, backlog, processing_duration, timestamp):
+		required = self.required_shards(backlog, processing_duration, timestamp)
+		target = self._clamp(base_two_shard_target(max(1, ceil(required))))
+
+		if target > current_shards:
+			return target
+
+		downscale_target = self._clamp(
+			base_two_shard_target(max(1, ceil(required / self.DOWNSCALE_HEADROOM)))
+		)
+		if downscale_target < current_shards:
+			if timestamp - self.last_resize >= self.DOWNSCALE_COOLDOWN:
+				return downscale_target
+			logger.info("Not scaling down to %i shards: cooling down", downscale_target)
+
+		return current_shards
+
+
+def get_upload_processing_stream_autoscaler(when=None):
+	from django.core.cache import cache
+
+	when = when or now()
+	history_start = when - timedelta(weeks=settings.KINESIS_AUTOSCALING_HISTORY_WEEKS)
+	forecaster = UploadRateForecaster(
+		get_upload_counts(history_start, when),
+		weeks=settings.KINESIS_AUTOSCALING_HISTORY_WEEKS,
+	)
+	return StreamAutoscaler(
+		forecaster,
+		sla_seconds=settings.KINESIS_STREAM_PROCESSING_THROUGHPUT_SLA_SECONDS,
+		min_shards=settings.KINESIS_UPLOAD_PROCESSING_STREAM_MIN_SHARDS,
+		max_shards=settings.KINESIS_UPLOAD_PROCESSING_STREAM_MAX_SHARDS,
+		lookahead_hours=settings.KINESIS_AUTOSCALING_LOOKAHEAD_HOURS,
+		last_resize=cache.get(LAST_RESIZE_CACHE_KEY, 0),
+	)
+
+
+def record_upload_processing_stream_resize(when):
+	from django.core.cache import cache
+
+	cache.set(LAST_RESIZE_CACHE_KEY, when, None)
+
+
+class ReactiveAutoscaler(object):
+	"""
+	The previous strategy, sizing the stream for the current backlog only.
+	Used as a baseline by simulate_autoscaling().
+	"""
+	def __init__(self, sla_seconds, min_shards, max_shards):
+		self.sla_seconds = sla_seconds
+		self.min_shards = min_shards
+		self.max_shards = max_shards
+
+	def target_shards(self, current_shards, backlog, processing_duration, timestamp):
+		required = max(1, ceil(backlog * max(1, processing_duration) / self.sla_seconds))
+		target = base_two_shard_target(required)
+		return int(min(self.max_shards, max(self.min_shards, target)))
+
+
+def simulate_autoscaling(
+	autoscaler, counts, start, end, processing_duration, sla_seconds,
+	initial_shards, step_seconds=300, resize_every=1
+):
+	"""
+	Replay the upload counts ({bucket start: count}, in buckets of
+	`step_seconds`) between `start` and `end` (unix times) through `autoscaler`.
+
+	Uploads are processed at `processing_duration` seconds each per shard.
+	The autoscaler is consulted at the start of every `resize_every` steps
+	and its decision applies to the whole step. If it has a forecaster, the forecaster only
+	sees the hours before the decision.
+
+	Returns a dict of statistics:
+	- sla_hits: the fraction of uploads processed within the SLA
+	- shard_hours: the cost of the stream
+	- resizes: the number of resizes
+	- max_backlog
+	"""
+	hourly_counts = defaultdict(int)
+	for bucket, count in counts.items():
+		hourly_counts[hour_start(bucket)] += count
+
+	forecaster = getattr(autoscaler, "forecaster", None)
+	shards = initial_shards
+	backlog = 0.0
+	uploads, uploads_within_sla = 0, 0.0
+	shard_seconds, resizes, max_backlog = 0, 0, 0.0
+
+	for i, step in enumerate(range(int(start), int(end), step_seconds)):
+		if i % resize_every == 0:
+			if forecaster is not None:
+				# Only the complete hours are known at this point
+				forecaster.hourly_counts = {
+					hour: count for hour, count in hourly_counts.items() if hour + 3600 <= step
+				}
+			target = autoscaler.target_shards(shards, backlog, processing_duration, step)
+			if target != shards:
+				shards = target
+				resizes += 1
+				autoscaler.last_resize = step
+
+		arrivals = counts.get(step, 0)
+		capacity = shards * step_seconds / float(processing_duration)
+		backlog = max(0.0, backlog + arrivals - capacity)
+		max_backlog = max(max_backlog, backlog)
+
+		# The uploads of this step wait for the backlog to drain
+		wait = backlog * processing_duration / shards
+		uploads += arrivals
+		if wait <= sla_seconds:
+			uploads_within_sla += arrivals
+		shard_seconds += shards * step_seconds
+
+	return {
+		"sla_hits": uploads_within_sla / uploads if uploads else 1.0,
+		"shard_hours": shard_seconds / 3600.0,
+		"resizes": resizes,
+		"max_backlog": max_backlog,
+	}
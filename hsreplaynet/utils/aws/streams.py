@@ -1,8 +1,10 @@
 import time
 import logging
+import re
 from math import ceil, log, pow
+from botocore.exceptions import ClientError
 from django.conf import settings
-from hsreplaynet.utils.influx import get_avg_upload_processing_seconds
+from hsreplaynet.utils.latency import get_upload_processing_seconds
 from hsreplaynet.uploads.processing import current_raw_upload_bucket_size
 from .clients import KINESIS
 
@@ -35,13 +37,18 @@ def publish_from_iterable_at_fixed_speed(iterable, publisher_func, times_per_sec
 			finished = True
 
 
+def get_target_writes_per_second(stream_name):
+	"""The number of records per second we can safely write to the stream."""
+	stream_size = current_stream_size(stream_name)
+	max_transactions_per_sec = stream_size * KINESIS_WRITES_PER_SEC
+	return ceil(max_transactions_per_sec * MAX_WRITES_SAFETY_LIMIT)
+
+
 def fill_stream_from_iterable(stream_name, iterable, publisher_func):
 	"""
 	Invoke func on the next item from iter at the maximum throughput the stream supports.
 	"""
-	stream_size = current_stream_size(stream_name)
-	max_transactions_per_sec = stream_size * KINESIS_WRITES_PER_SEC
-	target_writes_per_sec = ceil(max_transactions_per_sec * MAX_WRITES_SAFETY_LIMIT)
+	target_writes_per_sec = get_target_writes_per_second(stream_name)
 	logger.info(
 		"About to fill stream %s at a target of %s writes per second" %
 		(stream_name, target_writes_per_sec)
@@ -50,11 +57,12 @@ def fill_stream_from_iterable(stream_name, iterable, publisher_func):
 	publish_from_iterable_at_fixed_speed(iterable, publisher_func, target_writes_per_sec)
 
 
-def resize_upload_processing_stream(num_shards=None):
+def resize_upload_processing_stream(num_shards=None, predictive=False):
 	"""Entry point for periodic job to tune the upload processing stream size.
 
 	If num_shards is not provided this method will use the settings.SLA value to
-	calculate an appropriate number of shards.
+	calculate an appropriate number of shards. With predictive=True, the forecast
+	upload rate is taken into account as well (see utils.aws.autoscaling).
 	"""
 	min_shards = settings.KINESIS_UPLOAD_PROCESSING_STREAM_MIN_SHARDS
 	max_shards = settings.KINESIS_UPLOAD_PROCESSING_STREAM_MAX_SHARDS
@@ -72,7 +80,12 @@ def resize_upload_processing_stream(num_shards=None):
 	else:
 		sla_seconds = settings.KINESIS_STREAM_PROCESSING_THROUGHPUT_SLA_SECONDS
 		num_records = current_raw_upload_bucket_size()
-		processing_duration = get_avg_upload_processing_seconds()
+		# The tail matters for the SLA, not the typical upload
+		processing_duration = get_upload_processing_seconds(percentile=90)
+
+		if predictive:
+			resize_stream_predictively(stream_name, num_records, processing_duration)
+			return
 
 		resize_stream(
 			stream_name,
@@ -116,6 +129,23 @@ def resize_stream(
 	resize_stream_to_size(stream_name, new_shards_number)
 
 
+def resize_stream_predictively(stream_name, backlog_size, processing_duration):
+	from .autoscaling import (
+		get_upload_processing_stream_autoscaler, record_upload_processing_stream_resize
+	)
+
+	autoscaler = get_upload_processing_stream_autoscaler()
+	current_size = current_stream_size(stream_name)
+	new_shards_number = autoscaler.target_shards(
+		current_size, backlog_size, processing_duration, time.time()
+	)
+	logger.info("Predictive shard target for %s: %s", stream_name, new_shards_number)
+
+	if new_shards_number != current_size:
+		resize_stream_to_size(stream_name, new_shards_number)
+		record_upload_processing_stream_resize(time.time())
+
+
 def shards_required_for_sla(num_records, processing_duration, sla_seconds):
 	"""Calculate how many shards are required to hit the target SLA"""
 	# We make sure the inputs are at least 1 to prevent this from returning 0
@@ -186,76 +216,212 @@ def resize_stream_to_size(stream_name, target_num_shards):
 	# of the PartitionKey space easy to keep balanced.
 	assert is_base_two_compatible(target_num_shards)
 
-	current_size = current_stream_size(stream_name)
-	logger.info("The current size is: %s", current_size)
-
-	resizing_iterations = 1
-	while target_num_shards != current_size:
-		logger.info("Starting resizing iteration %s", resizing_iterations)
-
-		if target_num_shards > current_size:
-			logger.info("The shards will be split.")
-			split_shards(stream_name)
-		else:
-			logger.info("The shards will be merged.")
-			merge_shards(stream_name)
-
-		resizing_iterations += 1
-		current_size = current_stream_size(stream_name)
-		logger.info("The current size is: %s", current_size)
-
+	StreamResizer(KINESIS, stream_name).resize(target_num_shards)
 	logger.info("The stream is the correct target size. Finished.")
 
 
-def split_shards(stream_name):
-	shards = get_open_shards(stream_name)
-
-	logger.info("There are %s shards to split", len(shards))
-	while len(shards):
-		next_shard_to_split = shards.pop(0)
-		logger.info("The next shard to split is: %s", next_shard_to_split["ShardId"])
-		wait_for_stream_ready(stream_name)
-
-		starting_hash_key = int(next_shard_to_split["HashKeyRange"]["StartingHashKey"])
-		logger.info("Shard starting hash key: %s", str(starting_hash_key))
-
-		ending_hash_key = int(next_shard_to_split["HashKeyRange"]["EndingHashKey"])
-		logger.info("Shard ending hash key: %s", str(ending_hash_key))
-
-		combined_hash_key = starting_hash_key + ending_hash_key
-		logger.info("The combined hash key: %s", combined_hash_key)
-
-		split_point_hash_key = '{:.0f}'.format((combined_hash_key / 2))
-		logger.info("Shard split point hash key: %s", split_point_hash_key)
-
-		KINESIS.split_shard(
-			StreamName=stream_name,
-			ShardToSplit=next_shard_to_split["ShardId"],
-			NewStartingHashKey=str(split_point_hash_key)
-		)
-	logger.info("Splitting is complete")
-
-
-def merge_shards(stream_name):
-	shards = get_open_shards(stream_name)
-	mergable_shard_tuples = prepare_shards_for_merging(shards)
-
-	logger.info("There are %s merges to perform", len(mergable_shard_tuples))
-	while len(mergable_shard_tuples):
-		first_shard, second_shard = mergable_shard_tuples.pop(0)
-		logger.info(
-			"The next two shards to be merged are: (%s, %s)",
-			first_shard["ShardId"],
-			second_shard["ShardId"]
-		)
-		wait_for_stream_ready(stream_name)
+class StreamResizer(object):
+	"""
+	Resizes a Kinesis stream to a target number of open shards.
+
+	UpdateShardCount (uniform scaling) is used when the API supports it: it
+	doubles or halves the stream in a single call. Otherwise, or when its
+	daily limits are exhausted, the stream is resized one level at a time:
+	every split (or merge) of a level is planned from a single shard listing
+	and issued as soon as Kinesis accepts it. Kinesis only runs one resharding
+	operation per stream at a time, so an operation rejected because the
+	stream is UPDATING is retried once the stream is ACTIVE again, which is
+	checked with a one shard describe_stream call rather than a full listing.
+	"""
+	# Per account API limits
+	RESHARD_CALLS_PER_SECOND = 5
+	DESCRIBE_CALLS_PER_SECOND = 10
+
+	# UpdateShardCount has a daily quota per stream, which retrying won't get around
+	UPDATE_SHARD_COUNT_MAX_ATTEMPTS = 3
+	QUOTA_MESSAGE_RE = re.compile(r"24.hour|per day|rolling", re.IGNORECASE)
+
+	def __init__(self, kinesis, stream_name, timeout=600, sleep=time.sleep, clock=time.time):
+		self.kinesis = kinesis
+		self.stream_name = stream_name
+		self.timeout = timeout
+		self.sleep = sleep
+		self.clock = clock
+		self._last_calls = {}
+
+	@property
+	def can_update_shard_count(self):
+		# Only available in recent versions of botocore
+		return hasattr(self.kinesis, "update_shard_count")
+
+	def _throttle(self, kind, calls_per_second):
+		elapsed = self.clock() - self._last_calls.get(kind, 0)
+		if elapsed < 1.0 / calls_per_second:
+			self.sleep(1.0 / calls_per_second - elapsed)
+		self._last_calls[kind] = self.clock()
+
+	def _describe(self, **kwargs):
+		self._throttle("describe", self.DESCRIBE_CALLS_PER_SECOND)
+		return self.kinesis.describe_stream(StreamName=self.stream_name, **kwargs)
+
+	def get_status(self):
+		# Limit=1 keeps this to a single small page
+		return self._describe(Limit=1)["StreamDescription"]["StreamStatus"]
+
+	def wait_until_active(self):
+		deadline = self.clock() + self.timeout
+		delay = 0.5
+		while self.get_status() != "ACTIVE":
+			if self.clock() > deadline:
+				raise Exception("The stream %s never became active!" % (self.stream_name))
+			self.sleep(delay)
+			delay = min(delay * 2, 8)
+
+	def list_open_shards(self):
+		"""
+		Return the open shards, sorted by hash key.
+		"""
+		shards = []
+		kwargs = {}
+		while True:
+			description = self._describe(**kwargs)["StreamDescription"]
+			shards += description["Shards"]
+			if not description["HasMoreShards"] or not description["Shards"]:
+				break
+			kwargs["ExclusiveStartShardId"] = shards[-1]["ShardId"]
+
+		open_shards = [shard for shard in shards if shard_is_open(shard)]
+		return sorted(open_shards, key=lambda s: int(s["HashKeyRange"]["StartingHashKey"]))
+
+	def _reshard(self, method, max_limit_attempts=None, **kwargs):
+		"""
+		Call a resharding API method, retrying while the stream is busy
+		with a previous operation or the call is throttled.
+
+		If `max_limit_attempts` is given, LimitExceededException is only
+		retried that many times, and not at all if it names a daily quota.
+		"""
+		deadline = self.clock() + self.timeout
+		delay = 0.5
+		limit_attempts = 0
+		while True:
+			self._throttle("reshard", self.RESHARD_CALLS_PER_SECOND)
+			try:
+				return getattr(self.kinesis, method)(StreamName=self.stream_name, **kwargs)
+			except ClientError as e:
+				code = e.response["Error"]["Code"]
+				if code not in ("ResourceInUseException", "LimitExceededException"):
+					raise
+				if self.clock() > deadline:
+					raise
+				if code == "LimitExceededException" and max_limit_attempts is not None:
+					limit_attempts += 1
+					message = e.response["Error"].get("Message", "")
+					if limit_attempts >= max_limit_attempts or self.QUOTA_MESSAGE_RE.search(message):
+						raise
+				logger.debug("%s: %s, retrying", method, code)
+				if code == "ResourceInUseException":
+					self.wait_until_active()
+				else:
+					self.sleep(delay)
+					delay = min(delay * 2, 8)
+
+	def plan_splits(self, shards, count):
+		"""
+		Return (shard_id, new_starting_hash_key) for splitting the `count`
+		widest shards in two halves.
+		"""
+		def width(shard):
+			keys = shard["HashKeyRange"]
+			return int(keys["EndingHashKey"]) - int(keys["StartingHashKey"])
+
+		ret = []
+		for shard in sorted(shards, key=width, reverse=True)[:count]:
+			keys = shard["HashKeyRange"]
+			split_point = (int(keys["StartingHashKey"]) + int(keys["EndingHashKey"]) + 1) // 2
+			ret.append((shard["ShardId"], str(split_point)))
+		return ret
+
+	def plan_merges(self, shards, count):
+		"""
+		Return up to `count` disjoint (shard_id, adjacent_shard_id) pairs of
+		adjacent shards to merge, starting with the narrowest pairs.
+		`shards` must be sorted by hash key.
+		"""
+		def width(pair):
+			return (
+				int(pair[1]["HashKeyRange"]["EndingHashKey"]) -
+				int(pair[0]["HashKeyRange"]["StartingHashKey"])
+			)
 
-		KINESIS.merge_shards(
-			StreamName=stream_name,
-			ShardToMerge=first_shard["ShardId"],
-			AdjacentShardToMerge=second_shard["ShardId"]
-		)
-	logger.info("The merging is complete")
+		pairs = [
+			(first, second) for first, second in zip(shards[::2], shards[1::2])
+			if shards_are_mergable(first, second)
+		]
+		pairs = sorted(pairs, key=width)[:count]
+		return [(first["ShardId"], second["ShardId"]) for first, second in pairs]
+
+	def _resize_uniformly(self, current, target):
+		while current != target:
+			# UpdateShardCount can at most double or halve the stream per call
+			if target > current:
+				step = min(target, current * 2)
+			else:
+				step = max(target, (current + 1) // 2)
+			logger.info("Updating the shard count of %s: %i -> %i", self.stream_name, current, step)
+			self._reshard(
+				"update_shard_count", max_limit_attempts=self.UPDATE_SHARD_COUNT_MAX_ATTEMPTS,
+				TargetShardCount=step, ScalingType="UNIFORM_SCALING"
+			)
+			self.wait_until_active()
+			current = step
+
+	def resize(self, target, progress=None):
+		"""
+		Resize the stream to `target` open shards.
+		`progress`, if given, is called with (operations done, operations planned)
+		after every split or merge.
+		"""
+		self.wait_until_active()
+		shards = self.list_open_shards()
+		logger.info("The current size is: %s", len(shards))
+		if len(shards) == target:
+			return
+
+		if self.can_update_shard_count:
+			try:
+				return self._resize_uniformly(len(shards), target)
+			except ClientError as e:
+				if e.response["Error"]["Code"] != "LimitExceededException":
+					raise
+				logger.warning("UpdateShardCount is unavailable (%s), splitting/merging instead", e)
+				self.wait_until_active()
+				shards = self.list_open_shards()
+
+		while len(shards) != target:
+			if target > len(shards):
+				operations = [
+					("split_shard", {"ShardToSplit": shard_id, "NewStartingHashKey": key})
+					for shard_id, key in self.plan_splits(shards, target - len(shards))
+				]
+			else:
+				operations = [
+					("merge_shards", {"ShardToMerge": first, "AdjacentShardToMerge": second})
+					for first, second in self.plan_merges(shards, len(shards) - target)
+				]
+
+			if not operations:
+				raise Exception("Cannot resize %s to %i shards" % (self.stream_name, target))
+
+			logger.info("Resharding %s: %i operations", self.stream_name, len(operations))
+			for i, (method, kwargs) in enumerate(operations):
+				self._reshard(method, **kwargs)
+				if progress:
+					progress(i + 1, len(operations))
+
+			self.wait_until_active()
+			shards = self.list_open_shards()
+			logger.info("The current size is: %s", len(shards))
 
 
 def shard_is_open(s):
@@ -266,32 +432,3 @@ def shards_are_mergable(first, second):
 	first_end_range = int(first["HashKeyRange"]["EndingHashKey"])
 	second_start_range = int(second["HashKeyRange"]["StartingHashKey"])
 	return (first_end_range + 1) == second_start_range
-
-
-def prepare_shards_for_merging(shards):
-	logger.info("The shards are being prepared for merging")
-	sorted_shards = sorted(shards, key=lambda s: int(s["HashKeyRange"]["EndingHashKey"]))
-
-	less_than_two_shards = len(sorted_shards) < 2
-	uneven_number_of_shards = len(sorted_shards) % 2 != 0
-	if less_than_two_shards or uneven_number_of_shards:
-		# Don't attempt to return a result if we have less than 2 shards
-		# Or if we don't have an event number of shards
-
-		if less_than_two_shards:
-			logger.info("There are less than 2 shards. No merging will be done.")
-
-		if uneven_number_of_shards:
-			logger.info("There are an uneven number of shards. No merging will be done.")
-
-		return []
-
-	result = []
-	it = iter(sorted_shards)
-	for x in it:
-		first_shard = x
-		second_shard = next(it)
-		assert shards_are_mergable(first_shard, second_shard)
-		result.append((first_shard, second_shard))
-
-	return result
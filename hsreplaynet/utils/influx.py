@@ -9,35 +9,47 @@ from . import log
 
 
 if settings.INFLUX_ENABLED:
-	from influxdb import InfluxDBClient
-
 	dbs = getattr(settings, "INFLUX_DATABASES", None)
 	if not dbs or "hsreplaynet" not in dbs:
 		raise ImproperlyConfigured('settings.INFLUX_DATABASES["hsreplaynet"] setting is not set')
 
-	influx_settings = settings.INFLUX_DATABASES["hsreplaynet"]
+_influx = None
 
-	kwargs = {
-		"host": influx_settings["HOST"],
-		"port": influx_settings.get("PORT", 8086),
-		"username": influx_settings["USER"],
-		"password": influx_settings["PASSWORD"],
-		"database": influx_settings["NAME"],
-		"ssl": influx_settings.get("SSL", False),
-		"timeout": influx_settings.get("TIMEOUT", 2)
-	}
 
-	udp_port = influx_settings.get("UDP_PORT", 0)
-	if udp_port:
-		kwargs["use_udp"] = True
-		kwargs["udp_port"] = udp_port
+def get_influx_client():
+	"""
+	Return the InfluxDBClient, or None if Influx is disabled.
+	The client (and the influxdb package) is only loaded on first use.
+	"""
+	global _influx
+
+	if _influx is None and settings.INFLUX_ENABLED:
+		from influxdb import InfluxDBClient
+
+		influx_settings = settings.INFLUX_DATABASES["hsreplaynet"]
+
+		kwargs = {
+			"host": influx_settings["HOST"],
+			"port": influx_settings.get("PORT", 8086),
+			"username": influx_settings["USER"],
+			"password": influx_settings["PASSWORD"],
+			"database": influx_settings["NAME"],
+			"ssl": influx_settings.get("SSL", False),
+			"timeout": influx_settings.get("TIMEOUT", 2)
+		}
 
-	influx = InfluxDBClient(**kwargs)
-else:
-	influx = None
+		udp_port = influx_settings.get("UDP_PORT", 0)
+		if udp_port:
+			kwargs["use_udp"] = True
+			kwargs["udp_port"] = udp_port
+
+		_influx = InfluxDBClient(**kwargs)
+
+	return _influx
 
 
 def influx_write_payload(payload):
+	influx = get_influx_client()
 	if influx is None:
 		return
 
@@ -98,20 +110,3 @@ def influx_timer(measure, timestamp=None, cloudwatch_url=None, **kwargs):
 		if exception_raised and cloudwatch_url:
 			payload["fields"]["cloudwatch"] = cloudwatch_url
 		influx_write_payload([payload])
-
-
-def get_avg_upload_processing_seconds():
-	ms = get_current_lambda_average_duration_millis("process_replay_upload_stream_handler")
-	return round(ms / 1000.0, 1)
-
-
-def get_current_lambda_average_duration_millis(lambda_name, lookback_hours=1):
-	metric_name = "%s_duration_ms" % (lambda_name)
-	raw_query = """
-		select mean(value) from %s
-		where exception_thrown = 'False'
-		and time > now() - %sh
-	"""
-	full_query = raw_query % (metric_name, lookback_hours)
-	result = influx.query(full_query).raw
-	return round(result["series"][0]["values"][0][1])
@@ -1,12 +1,16 @@
 import os
+import time
 from datetime import datetime, timedelta
 from functools import wraps
 from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
 from django.utils.timezone import now
 from raven.contrib.django.raven_compat.models import client as sentry
 from hsreplaynet.uploads.models import RawUpload
 from . import log
-from .influx import influx_timer
+from .influx import influx_metric, influx_timer
+from .routers import reset_primary_pin
 
 
 def error_handler(e):
@@ -42,6 +46,89 @@ def get_tracing_id(event):
 	return UNKNOWN_ID
 
 
+# When each open DB connection (by alias) was created and last released
+_db_connection_opened_at = {}
+_db_connection_released_at = {}
+
+
+@receiver(connection_created)
+def _track_db_connection(sender, connection, **kwargs):
+	_db_connection_opened_at[connection.alias] = time.time()
+
+
+def prepare_db_connections():
+	"""
+	Called at the start of a Lambda invocation to vet the DB connections
+	kept open by the previous invocations of a warm container.
+
+	Connections older than LAMBDA_DB_CONNECTION_MAX_AGE are closed, so that
+	they are eventually rebalanced (eg. by a pgbouncer style pooler).
+	Connections idle for longer than LAMBDA_DB_CONNECTION_CHECK_IDLE_SECONDS
+	may have been dropped by the server or the pooler while the container was
+	frozen, so they are checked with a cheap query first. Closed connections
+	are reopened lazily by Django.
+
+	Returns the number of connections closed.
+	"""
+	from django.db import connections
+
+	closed = 0
+	current_time = time.time()
+	for connection in connections.all():
+		if connection.connection is None:
+			continue
+
+		opened_at = _db_connection_opened_at.get(connection.alias, 0)
+		released_at = _db_connection_released_at.get(connection.alias, 0)
+		if current_time - opened_at > settings.LAMBDA_DB_CONNECTION_MAX_AGE:
+			connection.close()
+			closed += 1
+		elif current_time - released_at > settings.LAMBDA_DB_CONNECTION_CHECK_IDLE_SECONDS:
+			if not connection.is_usable():
+				connection.close()
+				closed += 1
+
+	return closed
+
+
+def release_db_connections(invocation_start):
+	"""
+	Called at the end of a Lambda invocation. Without persistent connections,
+	the connections are closed. Otherwise, they are kept open for the next
+	invocation, unless they are unusable.
+
+	Returns (reused, opened), the number of connections that were reused
+	from a previous invocation and that were opened by this one.
+	"""
+	from django.db import connections
+
+	reused, opened = 0, 0
+	for connection in connections.all():
+		if connection.connection is None:
+			continue
+
+		if _db_connection_opened_at.get(connection.alias, 0) < invocation_start:
+			reused += 1
+		else:
+			opened += 1
+
+		if not settings.LAMBDA_PERSISTENT_DB_CONNECTIONS:
+			connection.close()
+			continue
+
+		if connection.in_atomic_block:
+			# An exception escaped a transaction without rolling it back.
+			# Behind a transaction pooler, the server connection would not
+			# be returned to the pool.
+			connection.close()
+		elif connection.errors_occurred and not connection.is_usable():
+			connection.close()
+		else:
+			_db_connection_released_at[connection.alias] = time.time()
+
+	return reused, opened
+
+
 _lambda_descriptors = []
 
 
@@ -76,7 +163,8 @@ def lambda_handler(
 	The following standard lifecycle services are provided:
 		- Sentry reporting for all Exceptions that propagate
 		- Capturing a standard set of metrics for Influx
-		- Making sure all connections to the DB are closed
+		- Reusing DB connections across warm invocations (or closing them,
+		  if settings.LAMBDA_PERSISTENT_DB_CONNECTIONS is False)
 		- Capturing metadata to facilitate deployment
 
 	Args:
@@ -103,6 +191,10 @@ def lambda_handler(
 
 		@wraps(func)
 		def wrapper(event, context):
+			# Reads only go to the primary after this invocation's own writes
+			reset_primary_pin()
+			invocation_start = time.time()
+			recycled_connections = prepare_db_connections()
 			tracing_id = get_tracing_id(event) if tracing else ""
 			os.environ["TRACING_REQUEST_ID"] = tracing_id
 			if sentry:
@@ -139,8 +231,13 @@ def lambda_handler(
 				if not trap_exceptions:
 					raise
 			finally:
-				from django.db import connection
-				connection.close()
+				reused, opened = release_db_connections(invocation_start)
+				if reused or opened or recycled_connections:
+					influx_metric("lambda_db_connections", {
+						"reused": reused,
+						"opened": opened,
+						"recycled": recycled_connections,
+					}, function=func.__name__)
 
 		return wrapper
 
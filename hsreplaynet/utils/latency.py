@@ -0,0 +1,138 @@
+"""
+Latency statistics for capacity planning.
+
+Percentiles are used rather than means: a few huge logs skew the mean, and a
+fast majority hides the slow tail the SLA depends on. Statistics are read
+from the Influx duration series written by instrumentation.lambda_handler,
+or computed locally with a LatencyHistogram (eg. from UploadEvent timings).
+"""
+import math
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from . import log
+from .influx import get_influx_client
+
+
+PERCENTILES = (50, 90, 99)
+
+UPLOAD_PROCESSING_MEASUREMENT = "process_replay_upload_stream_handler_duration_ms"
+UPLOAD_PROCESSING_SECONDS_CACHE_KEY = "latency:upload_processing_seconds:p%i"
+
+
+# count: the number of samples
+# throughput: samples per second over the period
+# p50, p90, p99: percentiles, in the unit of the samples
+LatencyStats = namedtuple("LatencyStats", ("count", "throughput", "p50", "p90", "p99"))
+
+
+class LatencyHistogram(object):
+	"""
+	A histogram with logarithmic buckets, so that percentiles are accurate
+	to `precision` (relative) whatever the range of the samples, in constant
+	memory. Samples <= 0 are counted in their own bucket.
+	"""
+	def __init__(self, precision=.01):
+		self.precision = precision
+		self._log_base = math.log(1 + 2 * precision)
+		self.buckets = {}
+		self.zeros = 0
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def _bucket(self, value):
+		return int(math.floor(math.log(value) / self._log_base))
+
+	def add(self, value, count=1):
+		if value <= 0:
+			self.zeros += count
+		else:
+			bucket = self._bucket(value)
+			self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+		self.count += count
+
+	def update(self, other):
+		for bucket, count in other.buckets.items():
+			self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+		self.zeros += other.zeros
+		self.count += other.count
+
+	def percentile(self, p):
+		"""
+		Return the `p`th percentile (0-100), or None if there are no samples.
+		"""
+		if not self.count:
+			return None
+
+		rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+		seen = self.zeros
+		if seen >= rank:
+			return 0.0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				# The middle of the bucket
+				return math.exp((bucket + .5) * self._log_base)
+
+	def stats(self, period_seconds):
+		if not self.count:
+			return None
+		p50, p90, p99 = [self.percentile(p) for p in PERCENTILES]
+		return LatencyStats(self.count, self.count / float(period_seconds), p50, p90, p99)
+
+
+def get_influx_latency_stats(measurement, lookback_hours=1):
+	"""
+	Return the LatencyStats of the successful invocations recorded in
+	`measurement` over the last `lookback_hours`, or None if Influx is
+	unavailable or has no data.
+	"""
+	influx = get_influx_client()
+	if influx is None:
+		return None
+
+	condition = "WHERE exception_thrown = 'False' AND time > now() - %ih" % (lookback_hours)
+	queries = ["SELECT count(value) FROM %s %s" % (measurement, condition)]
+	for p in PERCENTILES:
+		queries.append("SELECT percentile(value, %i) FROM %s %s" % (p, measurement, condition))
+
+	try:
+		results = influx.query("; ".join(queries))
+	except Exception as e:
+		log.exception("Could not query the latency of %s: %r", measurement, e)
+		return None
+
+	values = []
+	for result in results:
+		points = list(result.get_points())
+		if not points:
+			return None
+		values.append([v for k, v in points[0].items() if k != "time"][0])
+
+	count = values[0]
+	if not count:
+		return None
+	return LatencyStats(count, count / (lookback_hours * 3600.0), *values[1:])
+
+
+def get_upload_processing_seconds(percentile=90, lookback_hours=1):
+	"""
+	Return the `percentile` upload processing duration, in seconds.
+
+	Falls back to the last known value when there is no recent data (eg.
+	processing was paused), then to settings.UPLOAD_PROCESSING_SECONDS_DEFAULT.
+	"""
+	cache_key = UPLOAD_PROCESSING_SECONDS_CACHE_KEY % (percentile)
+	stats = get_influx_latency_stats(UPLOAD_PROCESSING_MEASUREMENT, lookback_hours)
+	if stats is not None:
+		seconds = getattr(stats, "p%i" % (percentile)) / 1000.0
+		cache.set(cache_key, seconds, None)
+		return seconds
+
+	seconds = cache.get(cache_key)
+	if seconds is None:
+		seconds = settings.UPLOAD_PROCESSING_SECONDS_DEFAULT
+	log.warning("No recent upload processing durations, using %.1fs", seconds)
+	return seconds
@@ -54,3 +54,36 @@ class SetRemoteAddrFromForwardedFor:
 			# client's IP will be the first one.
 			real_ip = real_ip.split(",")[0].strip()
 			request.META["REMOTE_ADDR"] = real_ip
+
+
+class ReplicaPinningMiddleware:
+	"""
+	Middleware that keeps the reads of a client on the primary database for
+	a few seconds after one of its requests wrote to it, so that eg. the page
+	a form redirects to does not read stale data from a lagging replica.
+	See utils.routers.
+	"""
+
+	COOKIE_NAME = "primary_pin"
+
+	def process_request(self, request):
+		from .routers import reset_primary_pin
+
+		try:
+			until = float(request.COOKIES.get(self.COOKIE_NAME, 0))
+		except ValueError:
+			until = 0
+		request._primary_pin = until
+		reset_primary_pin(until)
+
+	def process_response(self, request, response):
+		from django.conf import settings
+		from .routers import get_primary_pin
+
+		until = get_primary_pin()
+		if until > getattr(request, "_primary_pin", 0):
+			response.set_cookie(
+				self.COOKIE_NAME, "%.3f" % (until),
+				max_age=settings.DB_PRIMARY_PIN_SECONDS, httponly=True
+			)
+		return response
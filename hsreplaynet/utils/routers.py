@@ -1,32 +1,150 @@
+"""
+Database routers.
+
+Reads are load balanced over the read replicas, with two exceptions:
+- Replicas lagging behind the primary by more than DB_REPLICA_MAX_LAG_SECONDS
+  are skipped until they catch up.
+- After a write, reads go to the primary for DB_PRIMARY_PIN_SECONDS so that
+  the writer sees its own writes. The pin is thread local; it is reset at the
+  start of each request (see ReplicaPinningMiddleware, which carries it over
+  to the next request with a cookie) and of each Lambda invocation.
+
+Writes are detected from the model signals rather than from db_for_write,
+which is also consulted for reads (eg. the lookup of get_or_create). Code
+writing with QuerySet.update() or raw SQL should call pin_to_primary() itself.
+"""
+import random
+import threading
+import time
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import signals
+from django.dispatch import receiver
+from . import log
+
+
+# Postgres 9.x function names (pg_last_wal_* from 10 onwards).
+# A replica which has replayed everything it received is not lagging,
+# even if the primary has not written anything for a while.
+REPLICA_LAG_QUERY = """
+SELECT CASE
+	WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() THEN 0
+	ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+_pin = threading.local()
+_replica_lag = {}
+
+
+def get_read_replicas():
+	replicas = getattr(settings, "DB_READ_REPLICAS", None)
+	if replicas is None:
+		read_replica = getattr(settings, "DB_READ_REPLICA_NAME", None)
+		replicas = [read_replica] if read_replica else []
+
+	for replica in replicas:
+		if replica not in settings.DATABASES:
+			raise ImproperlyConfigured("%s was not found in settings.DATABASES" % (replica))
+
+	return replicas
+
+
+def pin_to_primary(seconds=None):
+	"""
+	Send the reads of the current thread to the primary for `seconds`.
+	"""
+	if seconds is None:
+		seconds = settings.DB_PRIMARY_PIN_SECONDS
+	_pin.until = max(get_primary_pin(), time.time() + seconds)
+
+
+@receiver(signals.post_save)
+@receiver(signals.post_delete)
+def _pin_after_write(sender, using, **kwargs):
+	if using == "default":
+		pin_to_primary()
+
+
+@receiver(signals.m2m_changed)
+def _pin_after_m2m_write(sender, action, using, **kwargs):
+	if using == "default" and action in ("post_add", "post_remove", "post_clear"):
+		pin_to_primary()
+
+
+def get_primary_pin():
+	"""
+	Return the timestamp until which the current thread is pinned to the primary.
+	"""
+	return getattr(_pin, "until", 0)
+
+
+def reset_primary_pin(until=0):
+	_pin.until = until
+
+
+def measure_replica_lag(alias):
+	"""
+	Return the replication lag of `alias` in seconds, or None if it could
+	not be measured.
+	"""
+	try:
+		with connections[alias].cursor() as cursor:
+			cursor.execute(REPLICA_LAG_QUERY)
+			lag = cursor.fetchone()[0]
+	except Exception as e:
+		log.warning("Could not measure the replication lag of %s: %r", alias, e)
+		return None
+
+	# NULL when the replica has not replayed anything since it started
+	return float(lag) if lag is not None else None
+
+
+def get_replica_lag(alias):
+	"""
+	Return the last measured lag of `alias`, measuring it again when it is
+	older than DB_REPLICA_LAG_CHECK_SECONDS. Replicas whose lag can't be
+	measured are considered infinitely lagging.
+	"""
+	now = time.time()
+	lag, checked_at = _replica_lag.get(alias, (None, 0))
+	if now - checked_at >= settings.DB_REPLICA_LAG_CHECK_SECONDS:
+		lag = measure_replica_lag(alias)
+		if lag is None:
+			lag = float("inf")
+		_replica_lag[alias] = (lag, now)
+	return lag
 
 
 class ReadReplicaRouter(object):
 	def db_for_read(self, model, **hints):
-		read_replica = getattr(settings, "DB_READ_REPLICA_NAME", None)
+		replicas = get_read_replicas()
+		if not replicas or get_primary_pin() > time.time():
+			return "default"
 
-		if not read_replica:
+		max_lag = settings.DB_REPLICA_MAX_LAG_SECONDS
+		healthy = [r for r in replicas if get_replica_lag(r) <= max_lag]
+		if not healthy:
 			return "default"
-		elif read_replica not in settings.DATABASES:
-			raise ImproperlyConfigured("%s was not found in settings.DATABASES" % (read_replica))
-		else:
-			return read_replica
+
+		return random.choice(healthy)
 
 	def db_for_write(self, model, **hints):
 		return "default"
 
 	def allow_relation(self, obj1, obj2, **hints):
+		# All the databases hold the same data
+		databases = ["default"] + get_read_replicas()
+		if obj1._state.db in databases and obj2._state.db in databases:
+			return True
 		# None indicates the router has no opinion
 		return None
 
 	def allow_migrate(self, db, app_label, model_name=None, **hints):
-		read_replica = getattr(settings, "DB_READ_REPLICA_NAME", None)
-		if read_replica:
-
-			# Tell Django not to apply migrations to the read replica
-			# They will be replicated when they are applied to the master
-			if db == read_replica:
-				return False
+		# Tell Django not to apply migrations to the read replicas
+		# They will be replicated when they are applied to the master
+		if db in get_read_replicas():
+			return False
 
 		return True
@@ -0,0 +1,130 @@
+"""
+Measure the cold start import time of each Lambda handler.
+
+Every handler is loaded in a fresh interpreter (as on a Lambda cold start)
+and the time taken by `import handlers` and loading the handler is reported.
+With --top, the slowest modules are listed from `python -X importtime`
+(Python 3.7+).
+
+Exits with status 1 if any handler takes longer than --max-ms to load, so
+that it can be used as a gate in CI:
+
+	python scripts/lambda_import_times.py --max-ms 1500
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_CODE = """
+import sys, time
+start = time.time()
+import handlers
+handlers.load_handler(sys.argv[1])
+sys.stdout.write("%f" % ((time.time() - start) * 1000))
+"""
+
+
+def get_handler_names():
+	"""
+	Read handlers.LAMBDA_HANDLERS without importing (and timing) it here.
+	"""
+	with open(os.path.join(BASE_DIR, "handlers.py")) as f:
+		tree = ast.parse(f.read())
+
+	for node in tree.body:
+		if isinstance(node, ast.Assign) and node.targets[0].id == "LAMBDA_HANDLERS":
+			return sorted(ast.literal_eval(node.value))
+
+	raise RuntimeError("LAMBDA_HANDLERS was not found in handlers.py")
+
+
+def parse_importtime(output):
+	"""
+	Return (self_us, module) pairs from `python -X importtime` output.
+	"""
+	ret = []
+	for line in output.splitlines():
+		if not line.startswith("import time:"):
+			continue
+		fields = line[len("import time:"):].split("|")
+		try:
+			ret.append((int(fields[0]), fields[2].strip()))
+		except ValueError:
+			# The header line
+			continue
+	return ret
+
+
+def measure(python, name, importtime=False, lambda_env=True):
+	env = os.environ.copy()
+	if lambda_env:
+		# Load the settings as they are on Lambda (see settings.ENV_LAMBDA)
+		env["AWS_LAMBDA_FUNCTION_NAME"] = name
+
+	args = [python]
+	if importtime:
+		args += ["-X", "importtime"]
+	args += ["-c", CHILD_CODE, name]
+
+	proc = subprocess.Popen(
+		args, cwd=BASE_DIR, env=env,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+	)
+	stdout, stderr = proc.communicate()
+	if proc.returncode:
+		raise RuntimeError("Could not load %s:\n%s" % (name, stderr))
+
+	return float(stdout), parse_importtime(stderr) if importtime else []
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure Lambda handler import times.")
+	parser.add_argument(
+		"handlers", nargs="*", help="The handlers to measure (default: all of them)"
+	)
+	parser.add_argument(
+		"--python", default=sys.executable, help="The interpreter to measure with"
+	)
+	parser.add_argument(
+		"--runs", type=int, default=3, help="Runs per handler; the fastest one is kept"
+	)
+	parser.add_argument(
+		"--top", type=int, default=0, help="List the N slowest modules of each handler"
+	)
+	parser.add_argument(
+		"--max-ms", type=float, help="Fail if a handler takes longer than this to load"
+	)
+	parser.add_argument(
+		"--no-lambda-env", action="store_true",
+		help="Do not set AWS_LAMBDA_FUNCTION_NAME (measure with the web settings)"
+	)
+	args = parser.parse_args()
+
+	names = args.handlers or get_handler_names()
+	failed = []
+	for name in names:
+		results = [
+			measure(args.python, name, args.top > 0, not args.no_lambda_env)
+			for i in range(max(args.runs, 1))
+		]
+		ms, modules = min(results, key=lambda result: result[0])
+		print("%-48s %8.1f ms" % (name, ms))
+
+		for self_us, module in sorted(modules, reverse=True)[:args.top]:
+			print("    %-44s %8.1f ms" % (module, self_us / 1000.0))
+
+		if args.max_ms is not None and ms > args.max_ms:
+			failed.append(name)
+
+	if failed:
+		print("Over the %.0f ms budget: %s" % (args.max_ms, ", ".join(failed)))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -48,3 +48,122 @@ def s3_create_object_event():
 			}
 		}]
 	}
+
+
+class FakeKinesis:
+	"""
+	An in-memory stand-in for the parts of the Kinesis API used to resize
+	streams. The stream stays UPDATING for `updating_describes` describe_stream
+	calls after each resharding operation, during which resharding fails
+	like it does on AWS.
+	"""
+	MAX_HASH_KEY = 2 ** 128 - 1
+	PAGE_SIZE = 100
+
+	def __init__(self, num_shards, updating_describes=2):
+		self.shards = []
+		self.status = "ACTIVE"
+		self.updating_describes = updating_describes
+		self._remaining_updating = 0
+		self.calls = []
+		self._create_uniform_shards(num_shards)
+
+	def _create_shard(self, start, end):
+		self.shards.append({
+			"ShardId": "shardId-%012i" % (len(self.shards)),
+			"HashKeyRange": {"StartingHashKey": str(start), "EndingHashKey": str(end)},
+			"SequenceNumberRange": {"StartingSequenceNumber": "0"},
+		})
+
+	def _create_uniform_shards(self, num_shards):
+		width = (self.MAX_HASH_KEY + 1) // num_shards
+		for i in range(num_shards):
+			end = self.MAX_HASH_KEY if i == num_shards - 1 else (i + 1) * width - 1
+			self._create_shard(i * width, end)
+
+	def _close(self, shard_id):
+		for shard in self.open_shards():
+			if shard["ShardId"] == shard_id:
+				shard["SequenceNumberRange"]["EndingSequenceNumber"] = "1"
+				return shard
+		raise self._error("ResourceNotFoundException", shard_id)
+
+	def _error(self, code, operation, message=None):
+		from botocore.exceptions import ClientError
+		return ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+	def _start_update(self, operation):
+		if self.status != "ACTIVE":
+			raise self._error("ResourceInUseException", operation)
+		self.calls.append(operation)
+		self.status = "UPDATING"
+		self._remaining_updating = self.updating_describes
+
+	def open_shards(self):
+		return [s for s in self.shards if "EndingSequenceNumber" not in s["SequenceNumberRange"]]
+
+	def describe_stream(self, StreamName, Limit=None, ExclusiveStartShardId=None):
+		self.calls.append("describe_stream")
+		if self._remaining_updating:
+			self._remaining_updating -= 1
+		elif self.status == "UPDATING":
+			self.status = "ACTIVE"
+
+		shards = self.shards
+		if ExclusiveStartShardId:
+			ids = [s["ShardId"] for s in shards]
+			shards = shards[ids.index(ExclusiveStartShardId) + 1:]
+		limit = min(Limit or self.PAGE_SIZE, self.PAGE_SIZE)
+		return {"StreamDescription": {
+			"StreamStatus": self.status,
+			"Shards": shards[:limit],
+			"HasMoreShards": len(shards) > limit,
+		}}
+
+	def split_shard(self, StreamName, ShardToSplit, NewStartingHashKey):
+		self._start_update("split_shard")
+		shard = self._close(ShardToSplit)
+		keys = shard["HashKeyRange"]
+		self._create_shard(keys["StartingHashKey"], int(NewStartingHashKey) - 1)
+		self._create_shard(NewStartingHashKey, keys["EndingHashKey"])
+
+	def merge_shards(self, StreamName, ShardToMerge, AdjacentShardToMerge):
+		self._start_update("merge_shards")
+		first, second = self._close(ShardToMerge), self._close(AdjacentShardToMerge)
+		self._create_shard(
+			first["HashKeyRange"]["StartingHashKey"], second["HashKeyRange"]["EndingHashKey"]
+		)
+
+
+class FakeKinesisUniformScaling(FakeKinesis):
+	"""
+	FakeKinesis for a botocore version with UpdateShardCount.
+	Once `update_quota` updates have been made, they fail with `quota_message`.
+	"""
+	update_quota = None
+	quota_message = (
+		"Shard count update for stream exceeded the limit of 10 updates per rolling 24 hours"
+	)
+
+	def update_shard_count(self, StreamName, TargetShardCount, ScalingType):
+		if self.update_quota is not None:
+			if self.calls.count("update_shard_count") >= self.update_quota:
+				self.calls.append("update_shard_count_limited")
+				raise self._error(
+					"LimitExceededException", "update_shard_count", self.quota_message
+				)
+		current = len(self.open_shards())
+		if not current / 2 <= TargetShardCount <= current * 2:
+			raise self._error("ValidationException", "update_shard_count")
+		self._start_update("update_shard_count")
+		for shard in self.open_shards():
+			self._close(shard["ShardId"])
+		self._create_uniform_shards(TargetShardCount)
+
+
+@pytest.fixture
+def fake_kinesis():
+	def make(num_shards, uniform_scaling=False):
+		cls = FakeKinesisUniformScaling if uniform_scaling else FakeKinesis
+		return cls(num_shards)
+	return make
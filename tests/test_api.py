@@ -84,3 +84,84 @@ def test_auth_token_request(client, settings):
 	assert token
 	assert str(token.creation_apikey.api_key) == api_key
 	assert token.user == real_user
+
+
+@pytest.mark.django_db
+def test_api_key_data_remover(monkeypatch):
+	from hearthstone import cardxml, enums
+	from hsreplaynet.api import deletion
+	from hsreplaynet.api.models import APIKey
+	from hsreplaynet.cards.models import Card, Deck
+	from hsreplaynet.games.models import GameReplay, GlobalGame, GlobalGamePlayer
+	from hsreplaynet.uploads.models import UploadEvent, UploadEventStatus
+
+	deleted_files = []
+	monkeypatch.setattr(deletion, "delete_files_async", deleted_files.extend)
+
+	hero = Card.from_cardxml(cardxml.load()[0]["HERO_01"], save=True)
+	deck = Deck.objects.create(digest="deck")
+	api_key = APIKey.objects.create(full_name="Removed", email="removed@example.org")
+	other_api_key = APIKey.objects.create(full_name="Kept", email="kept@example.org")
+	# Enough tokens and uploads to span several chunks
+	tokens = [AuthToken.objects.create(creation_apikey=api_key) for i in range(3)]
+	other_token = AuthToken.objects.create(creation_apikey=other_api_key)
+
+	def create_game(*tokens):
+		game = GlobalGame.objects.create(game_type=enums.BnetGameType.BGT_RANKED_STANDARD)
+		GlobalGamePlayer.objects.create(
+			game=game, player_id=1, is_first=True, hero=hero, deck_list=deck
+		)
+		replays = []
+		for token in tokens:
+			replay = GameReplay.objects.create(
+				global_game=game, upload_token=token, hsreplay_version="1.0",
+				replay_xml="replays/%s.xml" % (token.key),
+			)
+			replays.append(replay)
+		return game, replays
+
+	def upload(token, status=UploadEventStatus.SUCCESS, replay=None):
+		return UploadEvent.objects.create(
+			token=token, status=status, game=replay, file="uploads/%s.log" % (token.key)
+		)
+
+	# Shared with another API key's replay, so the global game stays
+	shared_game, (replay, other_replay) = create_game(tokens[0], other_token)
+	upload(tokens[0], replay=replay)
+	upload(tokens[0], status=UploadEventStatus.PARSING_ERROR)
+	upload(tokens[0], status=UploadEventStatus.VALIDATION_ERROR)
+	other_upload = upload(other_token, replay=other_replay)
+
+	# Only replayed through this API key, so the global game goes
+	own_game, (own_replay, ) = create_game(tokens[1])
+	upload(tokens[1], replay=own_replay)
+
+	# Still processing, so the replay is kept
+	processing_game, (processing_replay, ) = create_game(tokens[2])
+	upload(tokens[2], status=UploadEventStatus.PROCESSING, replay=processing_replay)
+
+	remover = deletion.APIKeyDataRemover(api_key, chunk_size=2, token_chunk_size=2)
+	remover.run()
+
+	assert remover.deleted_tokens == 3
+	assert remover.deleted_uploads == 5
+	assert remover.deleted_replays == 2
+	assert remover.deleted_global_games == 1
+	assert remover.skipped_replays == 1
+
+	assert list(AuthToken.objects.all()) == [other_token]
+	assert list(UploadEvent.objects.all()) == [other_upload]
+	assert set(GameReplay.objects.all()) == {other_replay, processing_replay}
+	assert set(GlobalGame.objects.all()) == {shared_game, processing_game}
+	assert not GlobalGamePlayer.objects.filter(game=own_game).exists()
+	assert GlobalGamePlayer.objects.filter(game=shared_game).exists()
+
+	# The kept replay no longer points at the deleted token
+	processing_replay.refresh_from_db()
+	assert processing_replay.upload_token is None
+
+	assert sorted(deleted_files) == sorted(
+		["uploads/%s.log" % (tokens[0].key)] * 3 +
+		["uploads/%s.log" % (token.key) for token in tokens[1:]] +
+		["replays/%s.xml" % (token.key) for token in tokens[:2]]
+	)
@@ -1,3 +1,4 @@
+import pytest
 from hearthstone import cardxml, enums
 from hsreplaynet.cards.models import Card
 
@@ -43,3 +44,153 @@ def test_load_velens_chosen():
 	assert obj.card_class == enums.CardClass.PRIEST
 	assert obj.card_set == enums.CardSet.GVG
 	assert not obj.spell_damage
+
+
+def test_export_format_deck_list():
+	from hsreplaynet.cards.export import format_deck_list
+
+	assert format_deck_list(["CS2_029", "EX1_277"], [2, 1]) == "CS2_029, CS2_029, EX1_277"
+	assert format_deck_list([], []) == ""
+
+
+def _make_deck_matrix():
+	import numpy as np
+	from hsreplaynet.cards.matrix import DeckMatrix
+
+	# Game 1: deck 10 beats deck 11; game 2: deck 12 beats deck 10
+	# Deck 10: 2x A, 1x B; deck 11: 1x A; deck 12: 2x C
+	return DeckMatrix({
+		"deck_ids": np.array([10, 11, 12]),
+		"card_ids": np.array(["A", "B", "C"]),
+		"data": np.array([2, 1, 1, 2], dtype=np.uint8),
+		"indices": np.array([0, 1, 0, 2]),
+		"indptr": np.array([0, 2, 3, 4]),
+		"game_ids": np.array([1, 1, 2, 2]),
+		"player_decks": np.array([0, 1, 0, 2]),
+		"won": np.array([True, False, False, True]),
+		"player_classes": np.array([2, 3, 2, 4], dtype=np.uint8),
+		"game_types": np.array([7, 7, 2, -1], dtype=np.int16),
+		"ranks": np.array([5, -1, 0, 3], dtype=np.int8),
+	})
+
+
+def test_deck_matrix_statistics():
+	import numpy as np
+
+	matrix = _make_deck_matrix()
+
+	assert list(matrix.deck_games()) == [2, 1, 1]
+	assert list(matrix.deck_win_rates()) == [0.5, 0.0, 1.0]
+	assert list(matrix.card_popularity()) == [0.75, 0.5, 0.25]
+	assert np.allclose(matrix.card_win_rates(), [1 / 3, 0.5, 1.0])
+	assert matrix.card_cooccurrence().toarray().tolist() == [[3, 2, 0], [2, 2, 0], [0, 0, 1]]
+
+	mask = matrix.player_mask(game_type=7)
+	assert list(matrix.deck_games(mask)) == [1, 1, 0]
+	assert list(matrix.player_mask(max_rank=5)) == [True, False, True, True]
+
+
+def test_matchup_expected_win_rates():
+	import numpy as np
+	from hsreplaynet.cards.matchups import MatchupMatrix
+
+	matchups = MatchupMatrix.from_deck_matrix(_make_deck_matrix())
+
+	assert list(matchups.archetypes) == [10, 11, 12]
+	assert list(matchups.frequencies()) == [0.5, 0.25, 0.25]
+	assert matchups.win_rates().tolist() == [[0.5, 1.0, 0.0], [0.0, 0.5, 0.5], [1.0, 0.5, 0.5]]
+	assert np.allclose(matchups.expected_win_rates(), [0.5, 0.25, 0.75])
+
+	by_class = MatchupMatrix.from_deck_matrix(_make_deck_matrix(), by="class")
+	assert list(by_class.archetypes) == [2, 3, 4]
+	assert by_class.index(4) == 2
+
+	# Only the first game is a standard ranked (7) game
+	mask = _make_deck_matrix().player_mask(game_type=7)
+	ranked = MatchupMatrix.from_deck_matrix(_make_deck_matrix(), mask)
+	assert list(ranked.archetypes) == [10, 11]
+
+
+@pytest.mark.django_db
+def test_valid_deck_list_card_set_invalidation(monkeypatch):
+	from django.core.cache.backends.locmem import LocMemCache
+	from hsreplaynet.cards import cache
+	from hsreplaynet.cards.models import CardManager
+
+	monkeypatch.setattr(cache, "cache", LocMemCache("cards", {}))
+	# The card sets cached by two different processes
+	loader, worker = CardManager(), CardManager()
+	assert "NEW1_010" not in worker.get_valid_deck_list_card_set()
+
+	Card.from_cardxml(carddb["NEW1_010"]).save()
+	assert "NEW1_010" not in worker.get_valid_deck_list_card_set()
+
+	loader.clear_cache()
+	assert "NEW1_010" in worker.get_valid_deck_list_card_set()
+
+
+def _get_deck_matchup_stats():
+	from django.db import connection
+
+	with connection.cursor() as cursor:
+		cursor.execute("""
+			SELECT loser_deck_id, winner_deck_id, sum(games)
+			FROM deck_matchup_stats
+			GROUP BY loser_deck_id, winner_deck_id
+			HAVING sum(games) != 0
+			ORDER BY loser_deck_id, winner_deck_id
+		""")
+		return cursor.fetchall()
+
+
+@pytest.mark.django_db
+def test_deck_matchup_stats_trigger():
+	from datetime import datetime
+	from django.db import connection
+	from django.utils import timezone
+	from hsreplaynet.cards.models import Deck
+	from hsreplaynet.games.models import GlobalGame, GlobalGamePlayer
+
+	hero = Card.from_cardxml(carddb["HERO_01"], save=True)
+	winner = Deck.objects.create(digest="winner")
+	loser = Deck.objects.create(digest="loser")
+
+	def play_game():
+		game = GlobalGame.objects.create(
+			match_start=datetime(2016, 10, 1, 12, tzinfo=timezone.utc),
+			game_type=enums.BnetGameType.BGT_RANKED_STANDARD,
+		)
+		players = ((1, winner, enums.PlayState.WON), (2, loser, enums.PlayState.LOST))
+		for player_id, deck, state in players:
+			GlobalGamePlayer.objects.create(
+				game=game, player_id=player_id, is_first=player_id == 1, hero=hero,
+				deck_list=deck, final_state=state, rank=5,
+			)
+		return game
+
+	games = [play_game() for i in range(4)]
+	assert _get_deck_matchup_stats() == [(loser.id, winner.id, 4)]
+
+	# A rank change moves the game to another rank bucket
+	games[0].players.update(rank=4)
+	assert _get_deck_matchup_stats() == [(loser.id, winner.id, 4)]
+
+	# A single player
+	games[0].players.get(player_id=1).delete()
+	assert _get_deck_matchup_stats() == [(loser.id, winner.id, 3)]
+
+	# Both players in one statement, like api.deletion does
+	with connection.cursor() as cursor:
+		cursor.execute(
+			"DELETE FROM games_globalgameplayer WHERE game_id = ANY(%s)", [[games[1].id]]
+		)
+	assert _get_deck_matchup_stats() == [(loser.id, winner.id, 2)]
+
+	# Both players through the collector's cascade
+	games[2].delete()
+	assert _get_deck_matchup_stats() == [(loser.id, winner.id, 1)]
+
+	# A changed outcome moves the game over
+	games[3].players.filter(player_id=1).update(final_state=enums.PlayState.LOST)
+	games[3].players.filter(player_id=2).update(final_state=enums.PlayState.WON)
+	assert _get_deck_matchup_stats() == [(winner.id, loser.id, 1)]
@@ -0,0 +1,116 @@
+import pytest
+from hsreplaynet.features import cache
+from hsreplaynet.features.models import Feature, FeatureStatus
+
+
+class FakeRedis(object):
+	"""
+	An in-memory stand-in for Redis pub/sub, shared by all the caches of a test.
+	"""
+	def __init__(self):
+		self.subscriptions = []
+		self.down = False
+
+	def _check(self):
+		if self.down:
+			raise ConnectionError("Redis is down")
+
+	def publish(self, channel, message):
+		self._check()
+		for pubsub in self.subscriptions:
+			if channel in pubsub.channels:
+				pubsub.messages.append({"type": "message", "channel": channel, "data": message})
+
+	def pubsub(self):
+		self._check()
+		return FakePubSub(self)
+
+
+class FakePubSub(object):
+	def __init__(self, redis):
+		self.redis = redis
+		self.channels = set()
+		self.messages = []
+
+	def subscribe(self, channel):
+		self.redis._check()
+		self.channels.add(channel)
+		self.redis.subscriptions.append(self)
+		self.messages.append({"type": "subscribe", "channel": channel, "data": 1})
+
+	def get_message(self):
+		self.redis._check()
+		return self.messages.pop(0) if self.messages else None
+
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 1000.0
+
+	def time(self):
+		return self.now
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+	redis = FakeRedis()
+	monkeypatch.setattr(cache, "_get_redis", lambda: redis)
+	yield redis
+
+
+@pytest.mark.django_db
+def test_feature_cache_ttl(fake_redis, monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(cache, "time", clock)
+	feature_cache = cache.FeatureSnapshotCache(ttl=60)
+
+	Feature.objects.create(name="winrates", status=FeatureStatus.OFF)
+	assert feature_cache.get("winrates").status == FeatureStatus.OFF
+	with pytest.raises(Feature.DoesNotExist):
+		feature_cache.get("counters")
+
+	# Changes which don't go through the model aren't announced...
+	Feature.objects.filter(name="winrates").update(status=FeatureStatus.PUBLIC)
+	clock.now += 59
+	assert feature_cache.get("winrates").status == FeatureStatus.OFF
+
+	# ... but the snapshot expires
+	clock.now += 1
+	assert feature_cache.get("winrates").status == FeatureStatus.PUBLIC
+
+
+@pytest.mark.django_db
+def test_feature_cache_invalidation(fake_redis, monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(cache, "time", clock)
+	# The caches of two different processes
+	web, worker = cache.FeatureSnapshotCache(ttl=60), cache.FeatureSnapshotCache(ttl=60)
+
+	feature = Feature.objects.create(name="winrates", status=FeatureStatus.PUBLIC)
+	assert worker.get("winrates").status == FeatureStatus.PUBLIC
+
+	# Saving a feature reaches every process without waiting for the TTL
+	monkeypatch.setattr(cache, "feature_cache", web)
+	feature.status = FeatureStatus.OFF
+	feature.save()
+	assert worker.get("winrates").status == FeatureStatus.OFF
+
+	feature.delete()
+	with pytest.raises(Feature.DoesNotExist):
+		worker.get("winrates")
+
+	# Without Redis, the snapshots still expire
+	fake_redis.down = True
+	with pytest.raises(Feature.DoesNotExist):
+		worker.get("counters")
+	Feature.objects.create(name="counters", status=FeatureStatus.PUBLIC)
+	with pytest.raises(Feature.DoesNotExist):
+		worker.get("counters")
+	clock.now += 60
+	assert worker.get("counters").status == FeatureStatus.PUBLIC
+
+	# Once it's back, the processes resubscribe and reload
+	fake_redis.down = False
+	Feature.objects.filter(name="counters").update(status=FeatureStatus.OFF)
+	clock.now += cache.REDIS_RETRY_SECONDS
+	assert worker.get("counters").status == FeatureStatus.OFF
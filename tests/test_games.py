@@ -0,0 +1,86 @@
+import pytest
+from datetime import datetime, timedelta
+from django.utils import timezone
+from hearthstone import cardxml, enums
+from hsreplaynet.cards.models import Card, Deck
+from hsreplaynet.games.models import (
+	GameReplay, GlobalGame, GlobalGamePlayer, RecentDeckReplay, Visibility
+)
+
+
+def _create_replay(hero, decks, hours, visibility=Visibility.Public):
+	game = GlobalGame.objects.create(
+		match_start=datetime(2016, 10, 1, tzinfo=timezone.utc) + timedelta(hours=hours),
+		game_type=enums.BnetGameType.BGT_RANKED_STANDARD,
+	)
+	players = [
+		GlobalGamePlayer.objects.create(
+			game=game, player_id=i + 1, is_first=i == 0, hero=hero, deck_list=deck,
+			account_lo=hours * 10 + i,
+		) for i, deck in enumerate(decks)
+	]
+	replay = GameReplay.objects.create(
+		global_game=game, friendly_player_id=1, visibility=visibility,
+		replay_xml="replays/%i.xml" % (hours), hsreplay_version="1.0",
+	)
+	RecentDeckReplay.objects.add_replay(replay, players)
+	return replay
+
+
+@pytest.mark.django_db
+def test_recent_deck_replays(settings):
+	settings.RECENT_DECK_REPLAYS_PER_DECK = 2
+	hero = Card.from_cardxml(cardxml.load()[0]["HERO_01"], save=True)
+	deck1 = Deck.objects.create(digest="deck1")
+	deck2 = Deck.objects.create(digest="deck2")
+	deck3 = Deck.objects.create(digest="deck3")
+
+	replays = [_create_replay(hero, (deck1, deck2), hours) for hours in (1, 3, 2)]
+	replays.append(_create_replay(hero, (deck1, deck3), 0))
+	_create_replay(hero, (deck1, deck3), 4, visibility=Visibility.Unlisted)
+
+	def indexed(deck):
+		entries = RecentDeckReplay.objects.filter(deck=deck).order_by("-match_start")
+		return list(entries.values_list("replay_id", flat=True))
+
+	# Only the most recent replays are kept for each deck, whatever the order
+	# they are added in, and only public replays are indexed
+	assert indexed(deck1) == [replays[1].id, replays[2].id]
+	assert indexed(deck2) == [replays[1].id, replays[2].id]
+	assert indexed(deck3) == [replays[3].id]
+
+
+@pytest.mark.django_db
+def test_recommend_related_replays(monkeypatch):
+	from django.core.cache.backends.locmem import LocMemCache
+	from hsreplaynet.games import recommendations
+
+	monkeypatch.setattr(recommendations, "cache", LocMemCache("related_replays", {}))
+	generated = []
+
+	def generate_related_replays(replay, num):
+		ret = generate(replay, num)
+		generated.append([r.replay for r in ret])
+		return ret
+
+	generate = recommendations.generate_related_replays
+	monkeypatch.setattr(recommendations, "generate_related_replays", generate_related_replays)
+
+	hero = Card.from_cardxml(cardxml.load()[0]["HERO_01"], save=True)
+	deck1 = Deck.objects.create(digest="deck1")
+	deck2 = Deck.objects.create(digest="deck2")
+	related = [_create_replay(hero, (deck1, deck2), hours) for hours in range(3)]
+	source = _create_replay(hero, (deck1, deck2), 3)
+
+	def recommend():
+		return [r.replay for r in recommendations.recommend_related_replays(source, 2)]
+
+	# Most recent first, without the same replay twice for both decks
+	assert recommend() == [related[2], related[1]]
+	assert generated == [[related[2], related[1]]]
+
+	# Cached, but replays which are no longer public are left out
+	related[2].visibility = Visibility.Unlisted
+	related[2].save()
+	assert recommend() == [related[1]]
+	assert len(generated) == 1
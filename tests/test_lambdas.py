@@ -1,4 +1,5 @@
 import json
+import os
 import shortuuid
 from datetime import datetime
 from unittest.mock import MagicMock
@@ -63,3 +64,309 @@ def test_process_s3_object(s3_create_object_event, upload_context, monkeypatch):
 
 	# Invoke code under test
 	# result = process_s3_object(s3_create_object_event, upload_context)
+
+
+def test_double_put_does_not_download_the_log(monkeypatch):
+	from hsreplaynet.lambdas import uploads
+
+	raw_upload = MagicMock(shortid=shortuuid.uuid())
+	monkeypatch.setattr(
+		uploads.UploadEvent.objects, "get_or_create", lambda **kwargs: (MagicMock(), False)
+	)
+	monkeypatch.setattr(uploads, "influx_metric", lambda *args, **kwargs: None)
+
+	uploads.process_raw_upload(raw_upload, reprocess=False)
+	assert not raw_upload.prefetch.called
+
+
+def test_lambda_handlers_are_registered():
+	import handlers
+	from hsreplaynet.utils.instrumentation import get_lambda_descriptors
+
+	for name in handlers.LAMBDA_HANDLERS:
+		assert handlers.load_handler(name).__name__ == name
+
+	for descriptor in get_lambda_descriptors():
+		module, name = descriptor["handler"].split(".")
+		assert module == "handlers"
+		assert name in handlers.LAMBDA_HANDLERS
+
+
+def test_lambda_artifact_builder(settings):
+	import django
+	from hsreplaynet.lambdas.artifacts import LambdaArtifactBuilder
+
+	settings.DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
+	settings.DATABASE_ROUTERS = ["hsreplaynet.utils.routers.ReadReplicaRouter"]
+	site_packages = os.path.dirname(os.path.dirname(django.__file__))
+	builder = LambdaArtifactBuilder(
+		settings.BASE_DIR, site_packages, apps=settings.INSTALLED_APPS_CORE, settings=settings
+	)
+	files = builder.resolve(builder.get_entry_modules("hsreplaynet.lambdas.uploads"))
+
+	for path in (
+		"handlers.py",
+		"hsreplaynet/lambdas/uploads.py",
+		"hsreplaynet/settings.py",
+		"hsreplaynet/local_settings.py",
+		"hsreplaynet/uploads/models.py",
+		"hsreplaynet/utils/routers.py",
+		"storages/backends/s3boto3.py",
+		"django/core/files/storage.py",
+	):
+		assert path in files
+
+	# Only the Lambda handlers' imports are shipped, without the web apps
+	assert "hsreplaynet/uploads/views.py" not in files
+	assert not any(path.startswith("tests/") for path in files)
+	assert not any(path.startswith(("allauth/", "django/contrib/admin/")) for path in files)
+	assert "django/contrib/auth/models.py" in files
+
+	# Artifacts are deterministic
+	payload = builder.build("hsreplaynet.lambdas.uploads")
+	builder._cache.clear()
+	assert builder.build("hsreplaynet.lambdas.uploads") == payload
+
+
+class FakeDBConnection(object):
+	def __init__(self, alias, usable=True):
+		self.alias = alias
+		self.connection = None
+		self.usable = usable
+		self.in_atomic_block = False
+		self.errors_occurred = False
+		self.checks = 0
+
+	def is_usable(self):
+		self.checks += 1
+		return self.usable
+
+	def close(self):
+		self.connection = None
+
+
+def test_db_connection_reuse(settings, monkeypatch):
+	import django.db
+	from types import SimpleNamespace
+	from hsreplaynet.utils import instrumentation
+
+	settings.LAMBDA_PERSISTENT_DB_CONNECTIONS = True
+	settings.LAMBDA_DB_CONNECTION_MAX_AGE = 900
+	settings.LAMBDA_DB_CONNECTION_CHECK_IDLE_SECONDS = 30
+
+	clock = SimpleNamespace(now=1000.0)
+	monkeypatch.setattr(instrumentation, "time", SimpleNamespace(time=lambda: clock.now))
+	monkeypatch.setattr(instrumentation, "_db_connection_opened_at", {})
+	monkeypatch.setattr(instrumentation, "_db_connection_released_at", {})
+
+	default, replica = FakeDBConnection("default"), FakeDBConnection("replica")
+	monkeypatch.setattr(
+		django.db, "connections", SimpleNamespace(all=lambda: [default, replica])
+	)
+
+	def invoke(open_connections=()):
+		start = clock.now
+		closed = instrumentation.prepare_db_connections()
+		for connection in open_connections:
+			connection.connection = object()
+			instrumentation._track_db_connection(None, connection)
+		return closed, instrumentation.release_db_connections(start)
+
+	assert invoke([default, replica]) == (0, (0, 2))
+
+	# Reused as is by a quick invocation
+	clock.now += 10
+	assert invoke() == (0, (2, 0))
+	assert default.checks == 0
+
+	# Checked after being idle, and closed if the server dropped them
+	clock.now += 60
+	replica.usable = False
+	assert invoke() == (1, (1, 0))
+	assert default.checks == replica.checks == 1
+	assert replica.connection is None
+
+	# Closed once too old, even if usable
+	clock.now += 10
+	replica.usable = True
+	assert invoke([replica]) == (0, (1, 1))
+	clock.now += 901
+	assert invoke() == (2, (0, 0))
+	assert default.connection is None
+
+	# Connections left in a transaction or broken are not kept
+	assert invoke([default, replica]) == (0, (0, 2))
+	default.in_atomic_block = True
+	replica.errors_occurred = True
+	replica.usable = False
+	clock.now += 1
+	assert invoke() == (0, (2, 0))
+	assert default.connection is None and replica.connection is None
+
+	# Nor are any connections, without persistent connections
+	settings.LAMBDA_PERSISTENT_DB_CONNECTIONS = False
+	assert invoke([default]) == (0, (0, 1))
+	assert default.connection is None
+
+
+def test_stream_resizer(fake_kinesis):
+	from hsreplaynet.utils.aws.streams import StreamResizer
+
+	def resize(kinesis, target):
+		resizer = StreamResizer(kinesis, "stream", sleep=lambda seconds: None)
+		resizer.resize(target)
+		shards = resizer.list_open_shards()
+		assert len(shards) == target
+		# The hash key space is still covered, evenly
+		assert shards[0]["HashKeyRange"]["StartingHashKey"] == "0"
+		assert shards[-1]["HashKeyRange"]["EndingHashKey"] == str(2 ** 128 - 1)
+		widths = {
+			int(s["HashKeyRange"]["EndingHashKey"]) - int(s["HashKeyRange"]["StartingHashKey"])
+			for s in shards
+		}
+		assert max(widths) - min(widths) <= 1
+
+	kinesis = fake_kinesis(32, uniform_scaling=True)
+	resize(kinesis, 256)
+	assert kinesis.calls.count("update_shard_count") == 3
+	resize(kinesis, 64)
+	assert kinesis.calls.count("update_shard_count") == 5
+
+	kinesis = fake_kinesis(4)
+	resize(kinesis, 16)
+	assert kinesis.calls.count("split_shard") == 12
+	resize(kinesis, 2)
+	assert kinesis.calls.count("merge_shards") == 14
+
+	# Out of UpdateShardCount quota: fall back to splitting without retrying
+	kinesis = fake_kinesis(4, uniform_scaling=True)
+	kinesis.update_quota = 0
+	resize(kinesis, 8)
+	assert kinesis.calls.count("update_shard_count_limited") == 1
+	assert kinesis.calls.count("split_shard") == 4
+
+	# Throttled without naming the quota: only retried a few times
+	kinesis = fake_kinesis(4, uniform_scaling=True)
+	kinesis.update_quota, kinesis.quota_message = 0, "Rate exceeded"
+	resize(kinesis, 8)
+	assert kinesis.calls.count("update_shard_count_limited") == 3
+	assert kinesis.calls.count("split_shard") == 4
+
+
+def test_stream_autoscaling():
+	from math import cos, pi
+	from hsreplaynet.utils.aws.autoscaling import (
+		ReactiveAutoscaler, StreamAutoscaler, UploadRateForecaster, simulate_autoscaling
+	)
+
+	# Five weeks of uploads in 5 minute buckets, peaking every day
+	step = 300
+	counts = {}
+	for bucket in range(0, 5 * 7 * 24 * 3600, step):
+		day = (bucket % (24 * 3600)) / (24 * 3600.0)
+		counts[bucket] = int(200 + 180 * cos(2 * pi * day))
+
+	start, end = 4 * 7 * 24 * 3600, 5 * 7 * 24 * 3600
+	kwargs = {
+		"processing_duration": 3, "sla_seconds": 600, "initial_shards": 1,
+		"step_seconds": step, "resize_every": 3,
+	}
+	reactive = simulate_autoscaling(
+		ReactiveAutoscaler(600, 1, 256), counts, start, end, **kwargs
+	)
+	predictive = simulate_autoscaling(
+		StreamAutoscaler(UploadRateForecaster({}), 600, 1, 256), counts, start, end, **kwargs
+	)
+
+	assert predictive["sla_hits"] == 1.0
+	assert predictive["sla_hits"] > reactive["sla_hits"]
+	# No thrashing between sizes
+	assert predictive["resizes"] <= 5 * 7
+	assert predictive["resizes"] < reactive["resizes"]
+
+
+def test_latency_histogram():
+	from hsreplaynet.utils.latency import LatencyHistogram
+
+	histogram = LatencyHistogram()
+	assert histogram.percentile(90) is None
+	assert histogram.stats(60) is None
+
+	# A fast majority and a slow tail: the mean (~14s) describes neither
+	for i in range(1, 91):
+		histogram.add(i / 10.0)
+	for i in range(10):
+		histogram.add(100.0)
+	histogram.add(0)
+
+	assert abs(histogram.percentile(50) - 5.0) <= 5.0 * .02
+	assert abs(histogram.percentile(90) - 8.9) <= 8.9 * .02
+	assert abs(histogram.percentile(99) - 100.0) <= 100.0 * .02
+
+	other = LatencyHistogram()
+	other.update(histogram)
+	stats = other.stats(101)
+	assert stats.count == 101
+	assert stats.throughput == 1.0
+	assert stats.p99 == histogram.percentile(99)
+
+
+def test_canary_evaluator():
+	from hsreplaynet.uploads.canary import PROMOTE, ROLLBACK, CanaryEvaluator
+	from hsreplaynet.uploads.models import UploadEventStatus
+
+	SUCCESS, ERROR = UploadEventStatus.SUCCESS, UploadEventStatus.SERVER_ERROR
+
+	def evaluator(**kwargs):
+		ret = CanaryEvaluator(canary_start=1000, **kwargs)
+		for i in range(1000):
+			status = ERROR if i % 100 == 0 else SUCCESS
+			ret.add("prod%i" % (i), False, status, 0, 2.0 + i % 10 / 10.0)
+		return ret
+
+	# Healthy canaries: promoted as soon as the difference is significantly small
+	healthy = evaluator(min_canary_uploads=10)
+	decisions = []
+	for i in range(500):
+		healthy.add("canary%i" % (i), True, SUCCESS, 1000, 2.5)
+		decisions.append(healthy.decide()[0])
+	assert decisions[0] is None
+	assert PROMOTE in decisions
+	assert set(decisions[decisions.index(PROMOTE):]) == {PROMOTE}
+
+	# Canaries processed by the previous version are ignored
+	healthy.add("old", True, ERROR, 999, 2.5)
+	assert "old" not in healthy.uploads[True]
+
+	# Failing canaries are rolled back well before reaching the minimum
+	failing = evaluator(min_canary_uploads=100)
+	for i in range(10):
+		failing.add("canary%i" % (i), True, ERROR if i % 2 else SUCCESS, 1000, 2.5)
+	assert failing.decide()[0] == ROLLBACK
+
+	# Slow canaries too, even if they succeed
+	slow = evaluator(max_latency_ratio=2.0)
+	for i in range(10):
+		slow.add("canary%i" % (i), True, SUCCESS, 1000, 10.0)
+	decision, reason = slow.decide()
+	assert decision == ROLLBACK
+	assert "slow uploads" in reason
+
+	# Without enough canaries by the deadline
+	few = evaluator(min_canary_uploads=10)
+	few.add("canary", True, SUCCESS, 1000, 2.5)
+	assert few.decide() == (None, None)
+	assert few.decide(final=True)[0] == ROLLBACK
+
+	# At the deadline, a single failed canary is enough to roll back
+	unlucky = evaluator(min_canary_uploads=10)
+	for i in range(20):
+		unlucky.add("canary%i" % (i), True, ERROR if i == 0 else SUCCESS, 1000, 2.5)
+	assert unlucky.decide() == (None, None)
+	assert unlucky.decide(final=True)[0] == ROLLBACK
+
+	clean = evaluator(min_canary_uploads=10)
+	for i in range(20):
+		clean.add("canary%i" % (i), True, SUCCESS, 1000, 2.5)
+	assert clean.decide() == (None, None)
+	assert clean.decide(final=True)[0] == PROMOTE
@@ -1,9 +1,12 @@
 import pytest
 import os
 import json
+import threading
+import time
 from datetime import datetime
 from django.core.files.storage import default_storage
-from hsreplaynet.uploads.models import _generate_upload_key
+from hsreplaynet.uploads.models import RawUpload, _generate_upload_key
+from hsreplaynet.utils import aws
 from hsreplaynet.api.models import APIKey, AuthToken
 from hsreplaynet.lambdas.uploads import process_raw_upload
 from hsreplaynet.uploads.models import UploadEvent
@@ -49,6 +52,7 @@ class MockRawUpload(object):
 
 		self._upload_event_log_bucket = None
 		self._upload_event_log_key = None
+		self._upload_event_descriptor = None
 		self._reason = None
 		self._delete_was_called = False
 
@@ -60,6 +64,17 @@ class MockRawUpload(object):
 	def descriptor(self):
 		return self._descriptor
 
+	@property
+	def log_bytes(self):
+		return self._log.encode("utf-8")
+
+	@property
+	def prefetched_log_bytes(self):
+		return self.log_bytes
+
+	def prefetch(self):
+		pass
+
 	@property
 	def api_key(self):
 		return self._api_key
@@ -100,11 +115,19 @@ class MockRawUpload(object):
 	def upload_http_method(self):
 		return "put"
 
-	def prepare_upload_event_log_location(self, bucket, key, descriptor):
+	def prepare_upload_event_log_location(self, bucket, key, descriptor, defer=False):
 		self._upload_event_log_bucket = bucket
 		self._upload_event_log_key = key
 		self._upload_event_descriptor = descriptor
 
+	@property
+	def upload_event_log_key(self):
+		return self._upload_event_log_key
+
+	@property
+	def upload_event_descriptor_key(self):
+		return self._upload_event_descriptor
+
 	def make_failed(self, reason):
 		self._reason = reason
 
@@ -112,6 +135,296 @@ class MockRawUpload(object):
 		self._delete_was_called = True
 
 
+class LocalS3(object):
+	"""A stand-in for the S3 client which simulates a fixed round trip latency."""
+	def __init__(self, latency=0.02, keys=()):
+		self.latency = latency
+		self.keys = sorted(keys)
+		self.calls = []
+		# The most calls seen in flight at the same time
+		self.max_concurrent_calls = 0
+		self._concurrent_calls = 0
+		self._lock = threading.Lock()
+
+	def _call(self, name, **kwargs):
+		with self._lock:
+			self._concurrent_calls += 1
+			self.max_concurrent_calls = max(self.max_concurrent_calls, self._concurrent_calls)
+		time.sleep(self.latency)
+		with self._lock:
+			self._concurrent_calls -= 1
+			self.calls.append((name, kwargs))
+		return {}
+
+	def copy_object(self, **kwargs):
+		return self._call("copy_object", **kwargs)
+
+	def delete_object(self, **kwargs):
+		return self._call("delete_object", **kwargs)
+
+	def delete_objects(self, **kwargs):
+		return self._call("delete_objects", **kwargs)
+
+	def list_objects_v2(self, **kwargs):
+		self._call("list_objects_v2", **kwargs)
+		keys = [k for k in self.keys if k.startswith(kwargs["Prefix"])]
+		return {
+			"KeyCount": len(keys),
+			"Contents": [{"Key": k} for k in keys],
+			"IsTruncated": False,
+		}
+
+
+def test_raw_upload_prefetch(monkeypatch):
+	import io
+
+	class SlowLogS3(object):
+		"""Serves the descriptor at once, and the log once `log_ready` is set."""
+		def __init__(self):
+			self.log_ready = threading.Event()
+			self.log_error = None
+
+		def get_object(self, Bucket, Key):
+			if Key.endswith(".descriptor.json"):
+				return {"Body": io.BytesIO(b'{"source_ip": "127.0.0.1"}')}
+			assert self.log_ready.wait(5)
+			if self.log_error:
+				raise self.log_error
+			return {"Body": io.BytesIO(b"power.log")}
+
+	s3 = SlowLogS3()
+	monkeypatch.setattr(aws, "S3", s3)
+	key = "raw/2016/07/20/10/37/hUHupxzE9GfBGoEE8ECQiN.power.log"
+
+	# The descriptor doesn't wait for the log
+	raw_upload = RawUpload("hsreplaynet-uploads", key)
+	raw_upload.prefetch()
+	assert raw_upload.descriptor == {"source_ip": "127.0.0.1"}
+	s3.log_ready.set()
+	assert raw_upload.prefetched_log_bytes == b"power.log"
+
+	# A failed log download is not retried by prefetched_log_bytes
+	s3.log_error = Exception("NoSuchKey")
+	raw_upload = RawUpload("hsreplaynet-uploads", key)
+	raw_upload.prefetch()
+	assert raw_upload.prefetched_log_bytes is None
+
+
+def _time_archival_round_trips(defer):
+	raw_upload = RawUpload(
+		"hsreplaynet-uploads", "raw/2016/07/20/10/37/hUHupxzE9GfBGoEE8ECQiN.power.log"
+	)
+	log_key = _generate_upload_key(raw_upload.timestamp, raw_upload.shortid)
+	descriptor_key = _generate_upload_key(
+		raw_upload.timestamp, raw_upload.shortid, "descriptor.json"
+	)
+
+	start = time.time()
+	raw_upload.prepare_upload_event_log_location(
+		"hsreplaynet-replays", log_key, descriptor_key, defer=defer
+	)
+	raw_upload.delete()
+	return time.time() - start, raw_upload
+
+
+def test_deferred_archival_latency(monkeypatch):
+	s3 = LocalS3()
+	monkeypatch.setattr(aws, "S3", s3)
+
+	copy_duration, raw_upload = _time_archival_round_trips(defer=False)
+	assert [name for name, kwargs in s3.calls] == [
+		"copy_object", "copy_object", "delete_object", "delete_object"
+	]
+	assert raw_upload.upload_event_log_key.startswith("uploads/")
+
+	s3.calls = []
+	deferred_duration, raw_upload = _time_archival_round_trips(defer=True)
+	assert s3.calls == []
+	# Until it is archived, the UploadEvent points at the raw objects
+	assert raw_upload.upload_event_log_key == raw_upload.log_key
+	assert raw_upload.upload_event_descriptor_key == raw_upload.descriptor_key
+
+	# Wall-clock timings are too noisy to assert on, only report them
+	print("Deferring archival saved %.1fms (S3 latency: %ims per call)" % (
+		(copy_duration - deferred_duration) * 1000, s3.latency * 1000
+	))
+
+
+def test_upload_event_awaiting_archival(settings):
+	upload_event = UploadEvent(
+		file="raw/2016/07/20/10/37/hUHupxzE9GfBGoEE8ECQiN.power.log",
+		descriptor="raw/2016/07/20/10/37/hUHupxzE9GfBGoEE8ECQiN.descriptor.json",
+	)
+	assert upload_event.is_awaiting_archival
+	raw_upload = RawUpload.from_upload_event(upload_event)
+	assert raw_upload.bucket == settings.S3_RAW_LOG_UPLOAD_BUCKET
+	assert raw_upload.log_key == str(upload_event.file)
+	assert raw_upload.descriptor_key == str(upload_event.descriptor)
+
+	upload_event.file = "uploads/2016/07/20/10/37/hUHupxzE9GfBGoEE8ECQiN.power.log"
+	assert not upload_event.is_awaiting_archival
+
+
+@pytest.mark.django_db
+def test_delete_upload_event_awaiting_archival(monkeypatch, settings):
+	from hsreplaynet.utils import redis
+
+	class ImmediateQueue(object):
+		def enqueue(self, func, *args, **kwargs):
+			func(*args, **kwargs)
+
+	deleted = []
+	monkeypatch.setattr(redis, "job_queue", ImmediateQueue())
+	monkeypatch.setattr(aws, "delete_objects", lambda bucket, keys: deleted.extend(
+		(bucket, key) for key in keys
+	))
+	settings.AWS_STORAGE_BUCKET_NAME = "hsreplaynet-replays"
+
+	ts = "2016/07/20/10/37"
+	archived = UploadEvent.objects.create(
+		file="uploads/%s/oc6zBNVKFzMMgMhHVdsYJn.power.log" % (ts),
+		descriptor="uploads/%s/oc6zBNVKFzMMgMhHVdsYJn.descriptor.json" % (ts),
+	)
+	awaiting_archival = UploadEvent.objects.create(
+		file="raw/%s/hUHupxzE9GfBGoEE8ECQiN.power.log" % (ts),
+		descriptor="raw/%s/hUHupxzE9GfBGoEE8ECQiN.descriptor.json" % (ts),
+	)
+	assert awaiting_archival.is_awaiting_archival
+
+	archived.delete()
+	awaiting_archival.delete()
+
+	# The raw objects are not in the default storage until they are archived
+	assert deleted == [
+		("hsreplaynet-replays", str(archived.file)),
+		("hsreplaynet-replays", str(archived.descriptor)),
+		(settings.S3_RAW_LOG_UPLOAD_BUCKET, str(awaiting_archival.file)),
+		(settings.S3_RAW_LOG_UPLOAD_BUCKET, str(awaiting_archival.descriptor)),
+	]
+
+
+def test_reap_orphans_for_date(monkeypatch):
+	from datetime import date
+	from hsreplaynet.lambdas import crons
+
+	shortid = "%02i%02iorphanAAAAAAAAAAAA"
+	orphans, keys = [], []
+	for hour in range(24):
+		for minute in range(0, 60, 10):
+			ts = "raw/2016/07/20/%02i/%02i/" % (hour, minute)
+			orphan = shortid % (hour, minute)
+			orphans.append(ts + orphan + ".descriptor.json")
+			keys += [
+				ts + orphan + ".descriptor.json",
+				# Being processed
+				ts + orphan.replace("orphan", "inlogs") + ".descriptor.json",
+				ts + orphan.replace("orphan", "inlogs") + ".power.log",
+				# Processed
+				ts + orphan.replace("orphan", "upload") + ".descriptor.json",
+			]
+
+	s3 = LocalS3(keys=keys)
+	monkeypatch.setattr(aws, "S3", s3)
+	monkeypatch.setattr(crons, "influx_metric", lambda *args, **kwargs: None)
+	monkeypatch.setattr(crons, "get_existing_upload_event_shortids", lambda shortids: {
+		s for s in shortids if "upload" in s
+	})
+
+	assert crons.reap_orphans_for_date(date(2016, 7, 20), workers=8) == len(orphans)
+
+	deleted = []
+	for name, kwargs in s3.calls:
+		assert name in ("list_objects_v2", "delete_objects")
+		if name == "delete_objects":
+			deleted += [o["Key"] for o in kwargs["Delete"]["Objects"]]
+	assert sorted(deleted) == sorted(orphans)
+
+	# One listing and one batched delete per hour, several hours at a time
+	assert len(s3.calls) == 2 * 24
+	assert s3.max_concurrent_calls > 1
+
+
+def test_publish_raw_uploads_to_processing_stream(monkeypatch):
+	from unittest.mock import MagicMock
+
+	class FakeKinesis(object):
+		def __init__(self, rejected):
+			# The data of the records to reject, once each
+			self.rejected = set(rejected)
+			self.batches = []
+
+		def put_records(self, StreamName, Records):
+			self.batches.append([record["Data"] for record in Records])
+			results = []
+			for record in Records:
+				if record["Data"] in self.rejected:
+					self.rejected.remove(record["Data"])
+					results.append({"ErrorCode": "ProvisionedThroughputExceededException"})
+				else:
+					results.append({"SequenceNumber": "1", "ShardId": "shardId-000000000000"})
+			failed = len([result for result in results if "ErrorCode" in result])
+			return {"FailedRecordCount": failed, "Records": results}
+
+	monkeypatch.setattr(aws.time, "sleep", lambda seconds: None)
+	raw_uploads = [
+		MagicMock(kinesis_data=i, kinesis_partition_key=str(i)) for i in range(502)
+	]
+
+	# Split at the put_records limit, with only the rejected records retried
+	kinesis = FakeKinesis(rejected=[3, 501])
+	monkeypatch.setattr(aws, "KINESIS", kinesis)
+	assert aws.publish_raw_uploads_to_processing_stream(raw_uploads) == 502
+	assert [len(batch) for batch in kinesis.batches] == [500, 1, 2, 1]
+	assert kinesis.batches[1] == [3]
+	assert kinesis.batches[3] == [501]
+
+	kinesis = FakeKinesis(rejected=[0])
+	monkeypatch.setattr(aws, "KINESIS", kinesis)
+	with pytest.raises(RuntimeError):
+		aws.publish_raw_uploads_to_processing_stream(raw_uploads[:1], max_attempts=1)
+
+
+@pytest.mark.django_db
+def test_reprocess_upload_events_job(monkeypatch):
+	import pickle
+	import rq
+	from hsreplaynet.uploads import processing
+	from hsreplaynet.uploads.models import UploadEventStatus
+	from hsreplaynet.utils import redis
+
+	class FakeJob(object):
+		def __init__(self):
+			self.meta = {}
+			self.saved = []
+
+		def save(self):
+			self.saved.append(dict(self.meta["progress"]))
+
+	class FakeQueue(object):
+		def enqueue(self, func, *args, **kwargs):
+			self.func, self.args = func, pickle.loads(pickle.dumps(args))
+
+	job, queue, chunks = FakeJob(), FakeQueue(), []
+	monkeypatch.setattr(rq, "get_current_job", lambda: job)
+	monkeypatch.setattr(redis, "job_queue", queue)
+	monkeypatch.setattr(processing, "queue_upload_events_for_reprocessing", chunks.append)
+
+	for i in range(5):
+		UploadEvent.objects.create(status=UploadEventStatus.SERVER_ERROR)
+	UploadEvent.objects.create(status=UploadEventStatus.SUCCESS)
+	errors = UploadEvent.objects.filter(status=UploadEventStatus.SERVER_ERROR)
+
+	# Only the query is sent to the worker, which evaluates it itself
+	processing.queue_upload_events_for_reprocessing_async(errors)
+	assert queue.func == processing.reprocess_upload_events_job
+	assert processing.reprocess_upload_events_job(*queue.args, chunk_size=2) == 5
+
+	assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+	assert [e.id for chunk in chunks for e in chunk] == sorted(e.id for e in errors)
+	assert [progress["done"] for progress in job.saved] == [0, 2, 4, 5]
+	assert job.meta["progress"]["total"] == 5
+
+
 upload_regression_suite = pytest.mark.skipif(
 	not pytest.config.getoption("--all"),
 	reason="need --all option to run"
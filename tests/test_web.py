@@ -1,3 +1,4 @@
+import pytest
 from allauth.socialaccount.providers import registry
 
 
@@ -5,3 +6,31 @@ def test_battlenet_auth_loaded():
 	assert registry.loaded
 	provider = registry.by_id("battlenet")
 	assert provider.id == "battlenet"
+
+
+@pytest.mark.django_db
+def test_read_replica_router_pins_to_primary_after_write(settings, monkeypatch):
+	from hsreplaynet.api.models import APIKey
+	from hsreplaynet.utils import routers
+
+	settings.DATABASES = dict(settings.DATABASES, replica=settings.DATABASES["default"])
+	settings.DB_READ_REPLICAS = ["replica"]
+	monkeypatch.setattr(routers, "measure_replica_lag", lambda alias: 0)
+	monkeypatch.setattr(routers, "_replica_lag", {})
+	router = routers.ReadReplicaRouter()
+
+	# Routing a write doesn't pin by itself, as it may only read
+	routers.reset_primary_pin()
+	assert router.db_for_read(None) == "replica"
+	assert router.db_for_write(None) == "default"
+	assert router.db_for_read(None) == "replica"
+
+	APIKey.objects.create(full_name="Test Client", email="test@example.org")
+	assert router.db_for_read(None) == "default"
+
+	routers.reset_primary_pin()
+	settings.DB_REPLICA_MAX_LAG_SECONDS = 10
+	monkeypatch.setattr(routers, "measure_replica_lag", lambda alias: 60)
+	monkeypatch.setattr(routers, "_replica_lag", {})
+	assert router.db_for_read(None) == "default"
+	routers.reset_primary_pin()